@@ -1,22 +1,26 @@
-import os
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import pprint
-
-from elasticsearch import Elasticsearch
-from flask import Flask, session, request, current_app, redirect
+from flask import Flask, session, request, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from flask_login import LoginManager, current_user
+from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel
-from flask_admin import Admin, BaseView, expose
-from flask_admin.contrib.sqla import ModelView
 
 
 from config import Config
-from app.search import get_mappings, insert_mapping, delete_mapping
+from app.search import create_client
+from app.logs import configure_logging
+from app.querystats import QueryStats
+from app.cache import FragmentCache, SearchCache
+from app.assets import Assets
+from app.pagecache import PageCache
+from app.catalog import Catalog
+from app.usercache import UserCache
+from app.mailpool import MailPool
+from app.ratelimit import RateLimiter
+from app.profiler import Profiler
+from app.metrics import Metrics
+from app.searchlog import SearchLog
 
 
 # Turn off autoflush to let review editing to be saved in session.dirty
@@ -27,12 +31,27 @@ login.login_view = 'auth.login'
 mail = Mail()
 moment = Moment()
 babel = Babel()
-admin = Admin()
+query_stats = QueryStats()
+fragment_cache = FragmentCache()
+search_cache = SearchCache()
+assets = Assets()
+page_cache = PageCache()
+catalog = Catalog()
+user_cache = UserCache()
+mail_pool = MailPool()
+rate_limiter = RateLimiter()
+profiler = Profiler()
+metrics = Metrics()
+search_log = SearchLog()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                                x_proto=app.config['TRUSTED_PROXIES'])
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -40,8 +59,22 @@ def create_app(config_class=Config):
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
-    admin.init_app(app)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    if app.config['ADMIN_ENABLED']:
+        from app.admin import admin
+        admin.init_app(app)
+    query_stats.init_app(app)
+    fragment_cache.init_app(app)
+    search_cache.init_app(app)
+    assets.init_app(app)
+    page_cache.init_app(app)
+    catalog.init_app(app)
+    user_cache.init_app(app)
+    mail_pool.init_app(app)
+    rate_limiter.init_app(app)
+    profiler.init_app(app)
+    metrics.init_app(app)
+    search_log.init_app(app)
+    app.elasticsearch = create_client(app.config['ELASTICSEARCH_URL']) if app.config['ELASTICSEARCH_URL'] else None
 
     from app.errors.handlers import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -52,36 +85,10 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='Whisky Blog failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-        if app.config['LOG_TO_STDOUT']:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/WhiskyBlog.logs', maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
-        app.logger.info('Whisky Blog startup')
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    configure_logging(app)
 
     return app
 
@@ -98,64 +105,4 @@ def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 
-from app import models
-
-
-"""Create custom admin views for `User`, `Review` and `Tag` models"""
-
-
-class BaseModelView(ModelView):
-    def is_accessible(self):
-        return current_user.is_authenticated and current_user.id == 1
-
-
-class UserView(BaseModelView):
-    column_exclude_list = ['password_hash']
-    can_create = False
-    can_edit = True
-
-
-class ReviewView(BaseModelView):
-    can_create = False
-    can_edit = False
-
-
-class TagView(BaseModelView):
-    @expose('/bulk/')
-    def bulk_view(self):
-        from app.main.info import all_tags
-        for t in all_tags:
-            tag = self.model.query.filter_by(name=t[0]).first()
-            if not tag:
-                self.session.add(self.model(name=t[0]))
-        self.session.commit()
-        return redirect('/admin/tag')
-
-
-class SearchView(BaseView):
-    @expose('/')
-    def index(self):
-        maps = get_mappings()
-        return self.render('admin/search.html', mapping=pprint.pformat(maps))
-
-    @expose('/insert/')
-    def insert(self):
-        # insert elasticsearch mapping
-        insert_mapping('review')
-        return redirect('/admin/search')
-
-    @expose('/delete/')
-    def delete(self):
-        # delete elasticsearch mapping
-        delete_mapping('review')
-        return redirect('/admin/search')
-
-    def is_accessible(self):
-        return current_user.is_authenticated and current_user.id == 1
-
-
-admin.add_view(UserView(models.User, db.session))
-admin.add_view(ReviewView(models.Review, db.session))
-admin.add_view(TagView(models.Tag, db.session))
-admin.add_view(SearchView(name='Search', endpoint='search'))
-
+from app import models, jobs
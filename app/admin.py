@@ -0,0 +1,177 @@
+"""Flask-Admin views, imported by `create_app` only when `ADMIN_ENABLED` is set."""
+
+import pprint
+from datetime import datetime
+
+from flask import request, redirect, url_for, abort, Response
+from flask_admin import Admin, BaseView, expose
+from flask_admin.actions import action
+from flask_admin.contrib.sqla import ModelView
+from flask_login import current_user
+
+from app import db, models, fragment_cache, page_cache, user_cache, search_cache, mail_pool, profiler, \
+    search_log
+from app.profiler import HEADER as PROFILE_HEADER
+from app.search import get_mappings, insert_mapping, delete_mapping
+from app.searchlog import top_queries
+
+
+admin = Admin()
+
+
+class BaseModelView(ModelView):
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.id == 1
+
+
+class UserView(BaseModelView):
+    column_exclude_list = ['password_hash']
+    can_create = False
+    can_edit = True
+
+
+class ReviewView(BaseModelView):
+    can_create = False
+    can_edit = False
+
+
+class TagView(BaseModelView):
+    @expose('/bulk/')
+    def bulk_view(self):
+        from app.jobs import enqueue
+        enqueue('create_tags', dedup_key='create_tags')
+        self.session.commit()
+        return redirect('/admin/tag')
+
+
+class JobView(BaseModelView):
+    can_create = False
+    can_edit = False
+    column_list = ['id', 'name', 'status', 'attempts', 'run_at', 'created', 'finished', 'worker']
+    column_filters = ['name', 'status']
+    column_default_sort = ('id', True)
+    column_details_list = ['id', 'name', 'args', 'dedup_key', 'status', 'attempts', 'max_attempts', 'run_at',
+                           'created', 'started', 'heartbeat', 'finished', 'worker', 'error']
+    can_view_details = True
+    list_template = 'admin/jobs.html'
+
+    def render(self, template, **kwargs):
+        if template == self.list_template:
+            from app.jobs import counts
+            kwargs['counts'] = counts()
+        return super().render(template, **kwargs)
+
+    @action('retry', 'Retry', 'Run the selected jobs again?')
+    def action_retry(self, ids):
+        self.model.query.filter(self.model.id.in_(ids), self.model.status != 'running').update(
+            {'status': 'queued', 'attempts': 0, 'run_at': datetime.utcnow()}, synchronize_session=False)
+        self.session.commit()
+
+
+class SearchView(BaseView):
+    @expose('/')
+    def index(self):
+        maps = get_mappings()
+        return self.render('admin/search.html', mapping=pprint.pformat(maps))
+
+    @expose('/insert/')
+    def insert(self):
+        # insert elasticsearch mapping
+        insert_mapping('review')
+        return redirect('/admin/search')
+
+    @expose('/delete/')
+    def delete(self):
+        # delete elasticsearch mapping
+        delete_mapping('review')
+        return redirect('/admin/search')
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.id == 1
+
+
+class SearchLogView(BaseView):
+    @expose('/')
+    def index(self):
+        days = request.args.get('days', 7, type=int)
+        order = request.args.get('sort', 'searches')
+        return self.render('admin/searches.html', queries=top_queries(days, 200, order), days=days,
+                           dropped=search_log.dropped)
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.id == 1
+
+
+class CacheView(BaseView):
+    @expose('/')
+    def index(self):
+        caches = {'Fragments': fragment_cache.stats, 'Pages': page_cache.stats, 'Users': user_cache.stats,
+                  'Search results': search_cache.stats}
+        return self.render('admin/cache.html', caches=caches)
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.id == 1
+
+
+class MailView(BaseView):
+    @expose('/')
+    def index(self):
+        return self.render('admin/mail.html', depth=mail_pool.depth, stats=mail_pool.stats)
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.id == 1
+
+
+class ProfilerView(BaseView):
+    endpoint_sorts = {'endpoint': lambda p: p.name, 'requests': lambda p: p.requests, 'avg': lambda p: p.avg_ms,
+                      'samples': lambda p: p.samples}
+    function_sorts = {'function': 0, 'self': 1, 'total': 2}
+
+    @expose('/')
+    def index(self):
+        sort = request.args.get('sort', 'samples')
+        endpoints = profiler.store.snapshot()
+        profiles = sorted(endpoints.values(), key=self.endpoint_sorts.get(sort, lambda p: p.samples),
+                          reverse=sort != 'endpoint')
+        selected = endpoints.get(request.args.get('name'))
+        functions = []
+        if selected is not None:
+            fsort = request.args.get('fsort', 'self')
+            column = self.function_sorts.get(fsort, 1)
+            functions = sorted(selected.functions(), key=lambda f: f[column], reverse=fsort != 'function')[:200]
+        return self.render('admin/profiler.html', profiles=profiles, selected=selected, functions=functions,
+                           token=profiler.token(), header=PROFILE_HEADER)
+
+    @expose('/folded/')
+    @expose('/folded/<name>')
+    def folded(self, name=None):
+        endpoints = profiler.store.snapshot()
+        if name is None:
+            # Every endpoint in one flame graph, under a frame of its own
+            body = ''.join(p.folded(prefix=p.name) for p in endpoints.values())
+        elif name in endpoints:
+            body = endpoints[name].folded()
+        else:
+            abort(404)
+        return Response(body, mimetype='text/plain', headers={
+            'Content-Disposition': f'attachment; filename={name or "all"}.folded'})
+
+    @expose('/reset/', methods=['POST'])
+    def reset(self):
+        profiler.store.reset()
+        return redirect(url_for('.index'))
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.id == 1
+
+
+admin.add_view(UserView(models.User, db.session))
+admin.add_view(ReviewView(models.Review, db.session))
+admin.add_view(TagView(models.Tag, db.session))
+admin.add_view(JobView(models.Job, db.session, name='Jobs'))
+admin.add_view(SearchView(name='Search', endpoint='search'))
+admin.add_view(SearchLogView(name='Searches', endpoint='searches'))
+admin.add_view(ProfilerView(name='Profiler', endpoint='profiler'))
+admin.add_view(CacheView(name='Cache', endpoint='cache'))
+admin.add_view(MailView(name='Mail', endpoint='mail'))
+
@@ -0,0 +1,14 @@
+from werkzeug.http import HTTP_STATUS_CODES
+
+from app.api.serialize import json_response
+
+
+def error_response(status_code, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    return json_response(payload, status_code)
+
+
+def bad_request(message):
+    return error_response(400, message)
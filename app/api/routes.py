@@ -0,0 +1,132 @@
+from datetime import datetime
+
+from flask import request, current_app
+
+from app import db
+from app.api import bp
+from app.api.errors import bad_request, error_response
+from app.api.serialize import review_fields, whisky_fields, distillery_fields, select_fields, needed_relations, \
+    eager_options, serialize, encode_cursor, decode_cursor, json_response
+from app.models import Review, Whisky, Distillery
+from app.search import query_index, query_advanced, parse_query, advanced_args
+
+
+def get_limit():
+    limit = request.args.get('limit', current_app.config['POSTS_PER_PAGE'], type=int)
+    return max(1, min(limit, current_app.config['API_MAX_LIMIT']))
+
+
+def get_fields(available):
+    return select_fields(available, request.args.get('fields'))
+
+
+def get_one(model, available, id):
+    try:
+        names = get_fields(available)
+    except ValueError as e:
+        return bad_request(str(e))
+    obj = model.query.options(*eager_options(model, needed_relations(available, names))).get(id)
+    if obj is None:
+        return error_response(404)
+    return json_response(serialize([obj], available, names)[0])
+
+
+def list_by_id(model, available, query=None):
+    """Lists `model` in id order, using the last id of a page as the cursor for the next."""
+    try:
+        names = get_fields(available)
+        after = decode_cursor(request.args['cursor'], int)[0] if 'cursor' in request.args else None
+    except ValueError as e:
+        return bad_request(str(e))
+    limit = get_limit()
+    query = (query or model.query).options(*eager_options(model, needed_relations(available, names)))
+    if after is not None:
+        query = query.filter(model.id > after)
+    objs = query.order_by(model.id.asc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(objs[limit - 1].id) if len(objs) > limit else None
+    return json_response({'items': serialize(objs[:limit], available, names), 'next': next_cursor})
+
+
+"""Reviews, newest first, paginated by a (timestamp, id) keyset cursor"""
+
+
+@bp.route('/reviews')
+def get_reviews():
+    try:
+        names = get_fields(review_fields)
+        cursor = decode_cursor(request.args['cursor'], str, int) if 'cursor' in request.args else None
+        if cursor is not None:
+            timestamp, last_id = datetime.fromisoformat(cursor[0].rstrip('Z')), cursor[1]
+    except ValueError as e:
+        return bad_request(str(e))
+    limit = get_limit()
+    query = Review.query.options(*eager_options(Review, needed_relations(review_fields, names)))
+    whisky_id = request.args.get('whisky_id', type=int)
+    if whisky_id is not None:
+        query = query.filter(Review.whisky_id == whisky_id)
+    if cursor is not None:
+        query = query.filter(db.or_(Review.timestamp < timestamp,
+                                    db.and_(Review.timestamp == timestamp, Review.id < last_id)))
+    reviews = query.order_by(Review.timestamp.desc(), Review.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(reviews) > limit:
+        next_cursor = encode_cursor(reviews[limit - 1].timestamp, reviews[limit - 1].id)
+    return json_response({'items': serialize(reviews[:limit], review_fields, names), 'next': next_cursor})
+
+
+@bp.route('/reviews/<int:id>')
+def get_review(id):
+    return get_one(Review, review_fields, id)
+
+
+@bp.route('/whiskies')
+def get_whiskies():
+    query = None
+    distillery_id = request.args.get('distillery_id', type=int)
+    if distillery_id is not None:
+        query = Whisky.query.filter(Whisky.distillery_id == distillery_id)
+    return list_by_id(Whisky, whisky_fields, query)
+
+
+@bp.route('/whiskies/<int:id>')
+def get_whisky(id):
+    return get_one(Whisky, whisky_fields, id)
+
+
+@bp.route('/distilleries')
+def get_distilleries():
+    return list_by_id(Distillery, distillery_fields)
+
+
+@bp.route('/distilleries/<int:id>')
+def get_distillery(id):
+    return get_one(Distillery, distillery_fields, id)
+
+
+"""Search, using the same syntax as `main.search`: `q` for a simple search, otherwise the advanced arguments"""
+
+
+@bp.route('/search')
+def search():
+    try:
+        names = get_fields(review_fields)
+        page = decode_cursor(request.args['cursor'], int)[0] if 'cursor' in request.args else 1
+    except ValueError as e:
+        return bad_request(str(e))
+    if page < 1:
+        return bad_request('Malformed cursor')
+    limit = get_limit()
+    sort = request.args.get('sort', 'rel')
+    if sort not in ('rel', 'old', 'new'):
+        return bad_request('sort must be one of rel, old, new')
+    if request.args.get('q'):
+        query, excluded, tags = parse_query(request.args['q'])
+        reviews, total = Review.search(func=query_index, query=query, excluded=excluded, tags=tags,
+                                       offset=page, size=limit, sort=sort)
+    else:
+        reviews, total = Review.search(func=query_advanced, **advanced_args(request.args), offset=page, size=limit,
+                                       sort=sort)
+    reviews = reviews.options(*eager_options(Review, needed_relations(review_fields, names))).all()
+    next_cursor = encode_cursor(page + 1) if total > page * limit else None
+    return json_response({'items': serialize(reviews, review_fields, names), 'total': total,
+                          'next': next_cursor})
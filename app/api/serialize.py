@@ -0,0 +1,131 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.models import Review, Whisky, Tag, tags
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+"""Compact JSON serialization with `fields=` sparse selection.
+
+Each field maps to a getter and the relationships it needs, so only the requested fields are computed
+and only their relationships are eager loaded.
+"""
+
+
+def _timestamp(value):
+    return value.isoformat() + 'Z' if value is not None else None
+
+
+review_fields = {
+    'id': (lambda r, t: r.id, ()),
+    'score': (lambda r, t: r.score, ()),
+    'nose': (lambda r, t: r.nose, ()),
+    'palate': (lambda r, t: r.palate, ()),
+    'finish': (lambda r, t: r.finish, ()),
+    'timestamp': (lambda r, t: _timestamp(r.timestamp), ()),
+    'whisky_id': (lambda r, t: r.whisky_id, ()),
+    'author': (lambda r, t: r.author.username if r.author else None, ('author',)),
+    'whisky': (lambda r, t: r.whisky.name if r.whisky else None, ('whisky',)),
+    'distillery': (lambda r, t: r.whisky.distillery.name if r.whisky else None, ('whisky', 'distillery')),
+    'tags': (lambda r, t: t.get(r.id, []), ('tags',)),
+}
+
+whisky_fields = {
+    'id': (lambda w, t: w.id, ()),
+    'name': (lambda w, t: w.name, ()),
+    'about': (lambda w, t: w.about, ()),
+    'distillery_id': (lambda w, t: w.distillery_id, ()),
+    'distillery': (lambda w, t: w.distillery.name if w.distillery else None, ('distillery',)),
+}
+
+distillery_fields = {
+    'id': (lambda d, t: d.id, ()),
+    'name': (lambda d, t: d.name, ()),
+    'location': (lambda d, t: d.location, ()),
+    'owner': (lambda d, t: d.owner, ()),
+    'founded': (lambda d, t: d.founded, ()),
+}
+
+
+def select_fields(available, requested):
+    """Parses a `fields=a,b` argument, raising ValueError for unknown names."""
+    if not requested:
+        return list(available)
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError('Unknown fields: ' + ', '.join(unknown))
+    return names
+
+
+def needed_relations(available, names):
+    return {rel for name in names for rel in available[name][1]}
+
+
+def eager_options(model, relations):
+    """Loader options for the many-to-one relationships needed by the selected fields."""
+    options = []
+    if model is Review:
+        if 'author' in relations:
+            options.append(db.joinedload(Review.author))
+        if 'distillery' in relations:
+            options.append(db.joinedload(Review.whisky).joinedload(Whisky.distillery))
+        elif 'whisky' in relations:
+            options.append(db.joinedload(Review.whisky))
+    elif model is Whisky and 'distillery' in relations:
+        options.append(db.joinedload(Whisky.distillery))
+    return options
+
+
+def review_tags(review_ids):
+    """Tag names for many reviews in one query, since the dynamic `Review.tags` cannot be eager loaded."""
+    names = {}
+    if review_ids:
+        rows = db.session.query(tags.c.review_id, Tag.name).join(Tag, Tag.id == tags.c.tag_id).filter(
+            tags.c.review_id.in_(review_ids)).order_by(Tag.name)
+        for review_id, name in rows:
+            names.setdefault(review_id, []).append(name)
+    return names
+
+
+def serialize(objs, available, names):
+    extra = review_tags([obj.id for obj in objs]) if 'tags' in needed_relations(available, names) else {}
+    getters = [(name, available[name][0]) for name in names]
+    return [{name: getter(obj, extra) for name, getter in getters} for obj in objs]
+
+
+def encode_cursor(*values):
+    values = [_timestamp(v) if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, *types):
+    """Returns the values packed by `encode_cursor`, raising ValueError for malformed cursors and for values
+    other than one of each of `types`."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, json.JSONDecodeError, base64.binascii.Error):
+        raise ValueError('Malformed cursor')
+    # JSON true and false would pass for the ints 1 and 0
+    if not isinstance(values, list) or len(values) != len(types) or not all(
+            isinstance(value, type_) and not isinstance(value, bool) for value, type_ in zip(values, types)):
+        raise ValueError('Malformed cursor')
+    return values
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(dumps(payload), status=status, mimetype='application/json')
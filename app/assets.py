@@ -0,0 +1,196 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.request
+from base64 import b64encode
+
+from flask import current_app, request, url_for, send_from_directory
+from markupsafe import Markup
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+"""Static asset pipeline.
+
+`flask assets build` vendors the third-party assets listed in `vendor_assets` into `static/vendor`, copies every
+static file to `static/build` under a content-hashed name, precompresses text assets with gzip (and brotli
+when installed) and writes `static/manifest.json`. Once a manifest exists, `url_for('static', ...)` resolves to
+the hashed names, which are served with far-future immutable cache headers and the best precompressed variant
+accepted by the client. Without a build everything falls back to the plain files and the CDNs.
+"""
+
+# name in static/vendor -> (CDN url, subresource integrity of the CDN file)
+vendor_assets = {
+    'bootstrap.min.css': ('https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css',
+                          'sha384-ggOyR0iXCbMQv3Xipma34MD+dH/1fQ784/j6cY/iJTQUOhcWr7x9JvoRxT2MZw1T'),
+    'fonts.css': ('https://fonts.googleapis.com/css?family=Allerta|Crimson+Text', None),
+    'jquery.min.js': ('https://ajax.googleapis.com/ajax/libs/jquery/3.4.0/jquery.min.js', None),
+    'popper.min.js': ('https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.14.7/umd/popper.min.js',
+                      'sha384-UO2eT0CpHqdSJQ6hJty5KVphtPhzWj9WO1clHTMGa3JDZwrnQq4sF86dIHNDz0W1'),
+    'bootstrap.min.js': ('https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js',
+                         'sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM'),
+    'moment-with-locales.min.js': ('https://cdnjs.cloudflare.com/ajax/libs/moment.js/2.18.1/'
+                                   'moment-with-locales.min.js', None),
+}
+
+compressible = {'.css', '.js', '.svg', '.json', '.txt', '.ttf', '.eot'}
+css_url = re.compile(r'url\(\s*[\'"]?([^\'")]+)[\'"]?\s*\)')
+# Google Fonts picks the font format by user agent; ask for woff2 like a current browser would
+font_user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+def download(url):
+    req = urllib.request.Request(url, headers={'User-Agent': font_user_agent})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return response.read()
+
+
+def check_integrity(data, integrity):
+    algorithm, expected = integrity.split('-', 1)
+    actual = b64encode(hashlib.new(algorithm, data).digest()).decode('ascii')
+    if actual != expected:
+        raise RuntimeError(f'Integrity check failed, expected {integrity}')
+
+
+def vendor(static_folder):
+    """Downloads `vendor_assets` (and the font files referenced by the fonts stylesheet) into static/vendor."""
+    vendor_folder = os.path.join(static_folder, 'vendor')
+    os.makedirs(os.path.join(vendor_folder, 'fonts'), exist_ok=True)
+    for name, (url, integrity) in vendor_assets.items():
+        data = download(url)
+        if integrity:
+            check_integrity(data, integrity)
+        if name == 'fonts.css':
+            css = data.decode('utf-8')
+            for font_url in set(css_url.findall(css)):
+                font_name = 'fonts/' + hashlib.sha1(font_url.encode('utf-8')).hexdigest()[:16] + \
+                    posixpath.splitext(font_url.split('?')[0])[1]
+                with open(os.path.join(vendor_folder, font_name), 'wb') as f:
+                    f.write(download(font_url))
+                css = css.replace(font_url, font_name)
+            data = css.encode('utf-8')
+        with open(os.path.join(vendor_folder, name), 'wb') as f:
+            f.write(data)
+
+
+def _source_files(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        rel_root = os.path.relpath(root, static_folder).replace(os.sep, '/')
+        if rel_root == 'build' or rel_root.startswith('build/'):
+            continue
+        for name in files:
+            path = name if rel_root == '.' else f'{rel_root}/{name}'
+            if path != 'manifest.json':
+                yield path
+
+
+def _rewrite_css(path, css, manifest):
+    # Point relative url() references at the hashed names, which keep the same relative layout under build/
+    def replace(match):
+        ref = match.group(1)
+        if ref.startswith(('data:', 'http:', 'https:', '//', '/')):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(path), ref.split('?')[0].split('#')[0]))
+        if target not in manifest:
+            return match.group(0)
+        hashed = posixpath.relpath(manifest[target], posixpath.join('build', posixpath.dirname(path)))
+        return f'url("{hashed}")'
+    return css_url.sub(replace, css)
+
+
+def build(static_folder):
+    """Writes hashed and precompressed copies of all static files and returns the manifest."""
+    sources = sorted(_source_files(static_folder), key=lambda p: p.endswith('.css'))
+    manifest, encodings = {}, {}
+    for path in sources:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = _rewrite_css(path, data.decode('utf-8'), manifest).encode('utf-8')
+        stem, ext = posixpath.splitext(path)
+        hashed = f'build/{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        target = os.path.join(static_folder, *hashed.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+        manifest[path] = hashed
+        if ext in compressible:
+            encodings[hashed] = []
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+                encodings[hashed].append('br')
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            encodings[hashed].append('gzip')
+    result = {'files': manifest, 'encodings': encodings}
+    with open(os.path.join(static_folder, 'manifest.json'), 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    return result
+
+
+class Assets:
+    """Resolves `url_for('static', ...)` to fingerprinted files and serves them precompressed."""
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        try:
+            with open(os.path.join(app.static_folder, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'files': {}, 'encodings': {}}
+        app.extensions['assets'] = manifest
+        app.url_defaults(self.hashed_filename)
+        app.view_functions['static'] = self.send_static_file
+        app.add_template_global(self.vendor_url)
+        app.add_template_global(self.vendor_tag)
+
+    @staticmethod
+    def hashed_filename(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = current_app.extensions['assets']['files'].get(values['filename'],
+                                                                               values['filename'])
+
+    @staticmethod
+    def send_static_file(filename):
+        manifest = current_app.extensions['assets']
+        if filename not in manifest['encodings'] and not filename.startswith('build/'):
+            return current_app.send_static_file(filename)
+        for encoding in manifest['encodings'].get(filename, ()):
+            if request.accept_encodings[encoding]:
+                suffix = '.br' if encoding == 'br' else '.gz'
+                response = send_from_directory(current_app.static_folder, filename + suffix,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(current_app.static_folder, filename)
+        # Hashed names change with their content, so they never need revalidating
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    @staticmethod
+    def vendor_url(name):
+        """URL of a vendored asset, or None when `flask assets build` has not vendored it."""
+        if 'vendor/' + name in current_app.extensions['assets']['files']:
+            return url_for('static', filename='vendor/' + name)
+
+    def vendor_tag(self, name):
+        """A <link> or <script> tag for a vendored asset, falling back to its CDN with integrity checks."""
+        url, integrity = self.vendor_url(name), None
+        if url is None:
+            url, integrity = vendor_assets[name]
+        attrs = f' integrity="{integrity}" crossorigin="anonymous"' if integrity else ''
+        if name.endswith('.css'):
+            return Markup(f'<link rel="stylesheet" href="{url}"{attrs}>')
+        return Markup(f'<script src="{url}"{attrs}></script>')
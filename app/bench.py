@@ -0,0 +1,445 @@
+"""Benchmarks behind the `flask bench` commands. Results are plain dicts so they can be printed or dumped as JSON."""
+
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from flask import current_app, g
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def password_throughput(method, duration=1.0, salt_length=16):
+    """Measures `check_password_hash` for `method` on one core, i.e. the CPU cost of a single login."""
+    pwhash = generate_password_hash('correct horse battery staple', method=method, salt_length=salt_length)
+    checks = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < duration or checks < 3:
+        check_password_hash(pwhash, 'correct horse battery staple')
+        checks += 1
+        elapsed = time.perf_counter() - start
+    per_second = checks / elapsed
+    return {
+        'method': method,
+        'ms_per_login': round(elapsed / checks * 1000, 2),
+        'logins_per_second_per_core': round(per_second, 1),
+        'cores': os.cpu_count(),
+        'logins_per_second_all_cores': round(per_second * (os.cpu_count() or 1), 1),
+    }
+
+
+"""Synthetic data"""
+
+_syllables = ['glen', 'ben', 'aber', 'strath', 'dal', 'inver', 'auch', 'lag', 'tor', 'mor', 'ard', 'bally', 'craig',
+              'kil', 'loch', 'dun', 'mac', 'ros', 'lin', 'var', 'nock', 'more', 'rie', 'ach', 'ella', 'ish', 'ton']
+_styles = ['Year Old', 'Cask Strength', 'Sherry Cask', 'Port Finish', 'Single Cask', 'Distillers Edition',
+           'Peated', 'Bourbon Barrel', 'Small Batch', 'Reserve']
+_notes = ['apple', 'pear', 'orange peel', 'lemon', 'raisin', 'fig', 'heather', 'honey', 'toffee', 'cinnamon', 'clove',
+          'oak', 'vanilla', 'espresso', 'dark chocolate', 'malt', 'almond', 'walnut', 'leather', 'cut grass', 'sea salt',
+          'bonfire', 'peat smoke', 'iodine', 'ginger', 'pepper', 'butterscotch', 'cherry', 'tobacco', 'brine']
+# Roughly how common each region is among distilleries
+_location_weights = [40, 25, 5, 5, 5, 2, 6, 6, 4, 2]
+
+
+def _skewed(n, rng, alpha=1.2):
+    """Cumulative weights for choosing among `n` items with a long tail, so a few get most of the traffic."""
+    weights = [1 / (i + 1) ** alpha for i in range(n)]
+    rng.shuffle(weights)
+    total, cumulative = 0.0, []
+    for w in weights:
+        total += w
+        cumulative.append(total)
+    return cumulative
+
+
+class _Inserter:
+    """Collects rows for `table` and inserts them `batch_size` at a time, so no table is held in memory whole.
+
+    The rows of `parent`, whose rows these reference, are inserted first.
+    """
+    def __init__(self, table, batch_size, parent=None):
+        self.table = table
+        self.batch_size = batch_size
+        self.parent = parent
+        self.rows = []
+        self.count = 0
+
+    def add(self, **row):
+        self.rows.append(row)
+        self.count += 1
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        from app import db
+        if self.parent is not None:
+            self.parent.flush()
+        if self.rows:
+            db.session.execute(self.table.insert(), self.rows)
+            self.rows = []
+
+
+def generate(distilleries=1000, whiskies=5000, users=2000, reviews=50000, listed=10, seed=0, batch_size=5000):
+    """Bulk loads a seeded, reproducible dataset next to whatever is already in the database.
+
+    Rows go in as executemany INSERTs of `batch_size` rows as they are made, so ORM events (search indexing, cache
+    versions) are skipped; the catalog and review stamps are moved once at the end instead. Popular whiskies and
+    prolific users get most of the reviews and list entries, and tags follow a skewed distribution over
+    `all_tags`. A user reviews a whisky at most once, so when `reviews` comes close to users * whiskies fewer
+    reviews are made. Every user's password is "password".
+    """
+    from app import db
+    from app.avatars import email_hash
+    from app.main.info import all_tags, locations
+    from app.models import Distillery, Whisky, User, Review, Tag, Stamp, tags, whiskies_listed
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    first = {model: (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+             for model in (Distillery, Whisky, User, Review)}
+
+    existing = {name for name, in db.session.query(Tag.name)}
+    db.session.add_all([Tag(name=name) for name, _ in all_tags if name not in existing])
+    db.session.flush()
+    tag_ids = [id for id, in db.session.query(Tag.id).filter(Tag.name.in_([name for name, _ in all_tags]))]
+    tag_weights = _skewed(len(tag_ids), rng, alpha=0.8)
+
+    d0, w0, u0, r0 = first[Distillery], first[Whisky], first[User], first[Review]
+    region_names = [name for name, _ in locations]
+    rows = _Inserter(Distillery.__table__, batch_size)
+    for i in range(distilleries):
+        name = ''.join(rng.sample(_syllables, 2)).capitalize()
+        rows.add(id=d0 + i, name=f'{name} {d0 + i}', location=rng.choices(region_names, _location_weights)[0],
+                 owner=f'{rng.choice(_syllables).capitalize()} Spirits', founded=rng.randint(1750, 2020), version=1)
+    rows.flush()
+
+    rows = _Inserter(Whisky.__table__, batch_size)
+    for i in range(whiskies):
+        style = rng.choice(_styles)
+        name = f'{rng.choice([10, 12, 15, 18, 21, 25])} {style}' if style == 'Year Old' else f'{style} {i}'
+        rows.add(id=w0 + i, name=name, about=', '.join(rng.sample(_notes, 3)).capitalize(),
+                 distillery_id=d0 + rng.randrange(distilleries), version=1)
+    rows.flush()
+
+    # One hash for everyone, hashing each password would dominate the run
+    password_hash = generate_password_hash('password', method='pbkdf2:sha256:1000')
+    rows = _Inserter(User.__table__, batch_size)
+    for i in range(users):
+        email = f'user{u0 + i}@example.com'
+        rows.add(id=u0 + i, username=f'user{u0 + i}', email=email, avatar_hash=email_hash(email),
+                 password_hash=password_hash, about_me=rng.choice(_notes))
+    rows.flush()
+
+    whisky_weights = _skewed(whiskies, rng)
+    user_weights = _skewed(users, rng, alpha=0.8)
+    now = datetime.utcnow()
+    review_rows = _Inserter(Review.__table__, batch_size)
+    tag_rows = _Inserter(tags, batch_size, parent=review_rows)
+    # (user, whisky) pairs as single ints; popular pairs get drawn again and again as the pairs run out, so the
+    # number of draws is bounded too
+    seen = set()
+    for _ in range(20 * reviews):
+        if review_rows.count >= reviews:
+            break
+        user = rng.choices(range(users), cum_weights=user_weights)[0]
+        whisky = rng.choices(range(whiskies), cum_weights=whisky_weights)[0]
+        if user * whiskies + whisky in seen:
+            continue
+        seen.add(user * whiskies + whisky)
+        id = r0 + review_rows.count
+        review_rows.add(id=id, nose=', '.join(rng.sample(_notes, 3)), palate=', '.join(rng.sample(_notes, 3)),
+                        finish=', '.join(rng.sample(_notes, 2)), score=max(0, min(100, round(rng.gauss(84, 6)))),
+                        user_id=u0 + user, whisky_id=w0 + whisky,
+                        timestamp=now - timedelta(minutes=rng.randrange(3 * 365 * 24 * 60)), version=1)
+        for tag_id in set(rng.choices(tag_ids, cum_weights=tag_weights, k=rng.randint(0, 4))):
+            tag_rows.add(tag_id=tag_id, review_id=id)
+    del seen
+    tag_rows.flush()
+
+    listed_rows = _Inserter(whiskies_listed, batch_size)
+    for i in range(users):
+        for whisky in {rng.choices(range(whiskies), cum_weights=whisky_weights)[0]
+                       for _ in range(rng.randint(0, 2 * listed))}:
+            listed_rows.add(whisky_id=w0 + whisky, user_id=u0 + i)
+    listed_rows.flush()
+
+    Stamp.touch(db.session, 'catalog')
+    Stamp.touch(db.session, 'review')
+    db.session.commit()
+    return {
+        'distilleries': distilleries,
+        'whiskies': whiskies,
+        'users': users,
+        'reviews': review_rows.count,
+        'review_tags': tag_rows.count,
+        'whiskies_listed': listed_rows.count,
+        'seconds': round(time.perf_counter() - start, 1),
+    }
+
+
+"""Routes"""
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _route_requests(rng, whisky_ids, usernames):
+    """Request factories for each benchmarked route, taking the request number and returning (method, url, data)."""
+    return {
+        'explore': lambda i: ('GET', '/explore', None),
+        'whisky': lambda i: ('GET', f'/whisky/{rng.choice(whisky_ids)}', None),
+        'whisky_list': lambda i: ('GET', '/whisky_list', None),
+        'user': lambda i: ('GET', f'/user/{rng.choice(usernames)}', None),
+        'search': lambda i: ('GET', f'/search?q={rng.choice(_notes).replace(" ", "+")}', None),
+        'submit_review': lambda i: ('POST', f'/whisky/{rng.choice(whisky_ids)}/submit', {
+            'nose': 'benchmark', 'palate': 'benchmark', 'finish': 'benchmark', 'score': rng.randint(60, 100),
+            'add_tags': ['Peat', 'Smoke']}),
+    }
+
+
+@contextmanager
+def _bench_client(app, user_id=None):
+    """A test client, logged in as `user_id`, with CSRF checks and rate limits switched off while it is used."""
+    ratelimit = app.extensions['ratelimit']
+    saved = app.config.get('WTF_CSRF_ENABLED', True), ratelimit['rules'], ratelimit['groups']
+    app.config['WTF_CSRF_ENABLED'], ratelimit['rules'], ratelimit['groups'] = False, {}, {}
+    try:
+        client = app.test_client()
+        if user_id is not None:
+            with client.session_transaction() as session:
+                session['user_id'] = str(user_id)
+                session['_fresh'] = True
+        yield client
+    finally:
+        app.config['WTF_CSRF_ENABLED'], ratelimit['rules'], ratelimit['groups'] = saved
+
+
+def _measure(client, make_request, requests, warmup):
+    """Latency, Elasticsearch time, query count and status of `requests` requests, after `warmup` unmeasured ones."""
+    from app.querystats import record_queries
+
+    latencies, es_times, queries, statuses = [], [], [], Counter()
+    for i in range(warmup + requests):
+        method, url, data = make_request(i)
+        # The CLI and tests hold an app context, which every test client request shares, `g` included
+        g.pop('es_time', None)
+        with record_queries() as record:
+            start = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            elapsed = time.perf_counter() - start
+        response.close()
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            es_times.append(g.pop('es_time', 0.0) * 1000)
+            queries.append(record.count)
+            statuses[response.status_code] += 1
+    app_times = [total - es for total, es in zip(latencies, es_times)]
+    return {
+        'requests': requests,
+        'p50_ms': round(_percentile(latencies, 50), 2),
+        'p95_ms': round(_percentile(latencies, 95), 2),
+        'max_ms': round(max(latencies), 2),
+        'es_p50_ms': round(_percentile(es_times, 50), 2),
+        'app_p50_ms': round(_percentile(app_times, 50), 2),
+        'app_p95_ms': round(_percentile(app_times, 95), 2),
+        'queries_p50': _percentile(queries, 50),
+        'queries_max': max(queries),
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def _dataset():
+    from app import db
+    from app.models import Distillery, Whisky, User, Review, whiskies_listed
+    return {table.name: db.session.query(db.func.count()).select_from(table).scalar() for table in (
+        Distillery.__table__, Whisky.__table__, User.__table__, Review.__table__, whiskies_listed)}
+
+
+def _report(results, **extra):
+    from app import db
+    return dict({
+        'time': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'database': db.engine.url.drivername,
+        'elasticsearch': bool(current_app.elasticsearch),
+    }, **extra, routes=results)
+
+
+def _sample(rng, query, k=1000):
+    """Up to `k` values of a one column query, drawn with `rng` rather than by the database, whose random
+    function is named differently on each backend."""
+    values = [value for value, in query]
+    return rng.sample(values, min(k, len(values)))
+
+
+def route_latency(app, requests=50, routes=None, warmup=3, seed=0):
+    """Drives routes through the test client as a logged in user and reports latency and query counts per route.
+
+    CSRF checks and rate limits are switched off for the run. Caches are left alone, so the numbers are those
+    of a warm worker; `warmup` unmeasured requests per route make sure of it.
+    """
+    from app import db
+    from app.models import Whisky, User
+
+    rng = random.Random(seed)
+    whisky_ids = _sample(rng, db.session.query(Whisky.id).order_by(Whisky.id))
+    usernames = _sample(rng, db.session.query(User.username).order_by(User.id))
+    if not whisky_ids or not usernames:
+        raise RuntimeError('No data to benchmark, run `flask bench generate` first.')
+    bench_user = db.session.query(User.id).filter_by(username=usernames[0]).scalar()
+    factories = _route_requests(rng, whisky_ids, usernames)
+    dataset = _dataset()
+    with _bench_client(app, bench_user) as client:
+        results = {route: _measure(client, factories[route], requests, warmup) for route in routes or factories}
+    return _report(results, dataset=dataset)
+
+
+"""Search"""
+
+
+def _search_requests(rng):
+    tag_names = ['Peat', 'Smoke', 'Sherry', 'Honey', 'Vanilla', 'Citrus']
+
+    def word():
+        return rng.choice(_notes).split()[-1]
+    return {
+        'simple': lambda i: ('GET', f'/search?q={word()}', None),
+        'tagged': lambda i: ('GET', f'/search?q={word()}+@{rng.choice(tag_names).lower()}', None),
+        'excluded': lambda i: ('GET', f'/search?q={word()}+-{word()}', None),
+        'newest': lambda i: ('GET', f'/search?q={word()}&sort=new', None),
+        'advanced': lambda i: ('GET', f'/search?review={word()}&tags={rng.choice(tag_names)}'
+                                      f'&score_lower={rng.choice([70, 80, 90])}', None),
+        'deep_page': lambda i: ('GET', f'/search?q={word()}&page={rng.randint(5, 20)}', None),
+    }
+
+
+def search_latency(app, requests=50, latency=0.0, jitter=0.0, failure_rate=0.0, warmup=3, seed=0, documents=None):
+    """Benchmarks the search routes against a local fake Elasticsearch loaded with the reviews in the database.
+
+    The fake answers in about `latency` seconds, so `app_p50_ms` is the time spent on our side of the search:
+    building the query, loading the hits from the database and rendering. `failure_rate` makes that share of
+    Elasticsearch requests fail, to see how the routes behave when it does.
+    """
+    from app.fakees import FakeElasticsearch
+    from app.search import insert_mapping, create_client, partition, partitions, review_documents
+
+    rng = random.Random(seed)
+    factories = _search_requests(rng)
+    saved = app.elasticsearch
+    with FakeElasticsearch(seed=seed) as fake:
+        app.elasticsearch = create_client(fake.url, max_retries=0)
+        try:
+            insert_mapping('review')
+            loaded, batch = 0, []
+            for id, body in review_documents():
+                batch += [{'index': {'_index': partition('review', body['timestamp']), '_id': id}}, body]
+                loaded += 1
+                if len(batch) >= 2000 or loaded == documents:
+                    app.elasticsearch.bulk(body=batch)
+                    batch = []
+                if loaded == documents:
+                    break
+            if batch:
+                app.elasticsearch.bulk(body=batch)
+            partitions('review', refresh=True)
+            fake.latency, fake.jitter, fake.failure_rate = latency, jitter, failure_rate
+            fake.requests = 0
+            with _bench_client(app) as client:
+                results = {name: _measure(client, make_request, requests, warmup)
+                           for name, make_request in factories.items()}
+        finally:
+            app.elasticsearch = saved
+        fake_stats = {'documents': loaded, 'latency_ms': latency * 1000, 'jitter_ms': jitter * 1000,
+                      'failure_rate': failure_rate, 'requests': fake.requests, 'failures': fake.failures}
+    return _report(results, dataset=_dataset(), fake_elasticsearch=fake_stats)
+
+
+"""Startup"""
+
+DEFAULT_SERVER = 'gunicorn -c gunicorn.conf.py --workers 1 --bind 127.0.0.1:{port} whisky:app'
+
+
+def imported_packages(root, code='import whisky', env=None):
+    """{top-level package: microseconds spent importing its modules} for running `code` in a fresh interpreter."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, env=env,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    packages = Counter()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(own)
+    return packages
+
+
+def import_times(root):
+    """Time to import the app in a fresh interpreter, and the packages that take longest."""
+    packages = imported_packages(root)
+    return {
+        'import_ms': round(sum(packages.values()) / 1000, 1),
+        'slowest_packages_ms': {name: round(us / 1000, 1) for name, us in packages.most_common(10)},
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def first_response(root, command, path='/auth/login', timeout=60.0):
+    """Seconds from starting the server `command` until it answers `path`, any status counting as an answer."""
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(shlex.split(command.format(port=port)), cwd=root, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f'{command!r} exited with status {process.returncode}')
+            try:
+                urlopen(f'http://127.0.0.1:{port}{path}', timeout=timeout).close()
+            except HTTPError:
+                pass
+            except (URLError, ConnectionError):
+                time.sleep(0.02)
+                continue
+            return time.perf_counter() - start
+        raise RuntimeError(f'{command!r} did not answer within {timeout} s')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def startup_time(runs=3, command=DEFAULT_SERVER, path='/auth/login'):
+    """Import time of the app and the time from starting a server to its first response, best and median of `runs`.
+
+    `command` is run from the project directory with `{port}` replaced by a free port.
+    """
+    root = os.path.dirname(current_app.root_path)
+    imports = [import_times(root) for _ in range(runs)]
+    responses = [first_response(root, command, path) * 1000 for _ in range(runs)]
+    best = min(imports, key=lambda result: result['import_ms'])
+    return {
+        'time': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'python': platform.python_version(),
+        'runs': runs,
+        'import_ms': best['import_ms'],
+        'import_p50_ms': _percentile([result['import_ms'] for result in imports], 50),
+        'slowest_packages_ms': best['slowest_packages_ms'],
+        'command': command,
+        'first_response_ms': round(min(responses), 1),
+        'first_response_p50_ms': round(_percentile(responses, 50), 1),
+    }
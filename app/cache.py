@@ -0,0 +1,192 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from werkzeug.utils import import_string
+
+
+class BaseBackend:
+    """Interface for cache backends. Backends store arbitrary values under string keys."""
+    def __init__(self, **options):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class NullBackend(BaseBackend):
+    """Caches nothing, useful to switch a cache off through the config."""
+
+
+class LRUBackend(BaseBackend):
+    """Process-local cache holding at most `maxsize` entries, evicting the least recently used first."""
+    def __init__(self, maxsize=1000, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return None
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout if timeout is not None else self.timeout
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+backends = {'null': NullBackend, 'lru': LRUBackend}
+
+
+def make_backend(name, **options):
+    """Builds a backend from a short name in `backends` or an import path such as `mypackage.RedisBackend`."""
+    cls = backends[name] if name in backends else import_string(name)
+    return cls(**options)
+
+
+def snapshot(obj):
+    """Column values of a loaded row, safe to keep across sessions."""
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+
+def detached(model, values):
+    """A detached `model` instance built from a `snapshot`, it stays out of every session's identity map."""
+    obj = model(**values)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def attach(session, model, values):
+    """Returns a persistent `model` instance built from a `snapshot` without querying the database.
+
+    Once attached, many-to-one lazy loads that point at it resolve from the session's identity map for as
+    long as something references it.
+    """
+    obj = session.identity_map.get(identity_key(model, values['id']))
+    if obj is None:
+        obj = detached(model, values)
+        session.add(obj)
+    return obj
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class FragmentCache:
+    """Caches rendered template fragments keyed by model id and version stamp.
+
+    A fragment key embeds the `version` column of the rows it was rendered from, so an update never has to
+    delete anything: the next render misses and stale entries age out of the bounded backend.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = make_backend(app.config['FRAGMENT_CACHE_BACKEND'], maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+        app.extensions['fragment_cache'] = (backend, CacheStats())
+
+    @property
+    def backend(self):
+        return current_app.extensions['fragment_cache'][0]
+
+    @property
+    def stats(self):
+        return current_app.extensions['fragment_cache'][1]
+
+    def render(self, key, render_func):
+        """Returns the cached fragment for `key`, calling `render_func` to build it on a miss."""
+        backend, stats = current_app.extensions['fragment_cache']
+        fragment = backend.get(key)
+        if fragment is None:
+            stats.misses += 1
+            fragment = Markup(render_func())
+            backend.set(key, fragment)
+        else:
+            stats.hits += 1
+        return fragment
+
+
+class SearchCache:
+    """Caches complete pages of search results for `SEARCH_CACHE_TIMEOUT` seconds.
+
+    Entries are keyed by a hash of the Elasticsearch query and the page, so the same search reached from
+    different URLs shares one entry. Nothing is invalidated, new reviews show up in a cached search once its
+    entry expires.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = make_backend(app.config['SEARCH_CACHE_BACKEND'], maxsize=app.config['SEARCH_CACHE_SIZE'],
+                               timeout=app.config['SEARCH_CACHE_TIMEOUT'])
+        app.extensions['search_cache'] = (backend, CacheStats())
+
+    @property
+    def stats(self):
+        return current_app.extensions['search_cache'][1]
+
+    @staticmethod
+    def key(*parts):
+        return 'search:' + hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        backend, stats = current_app.extensions['search_cache']
+        value = backend.get(key)
+        if value is None:
+            stats.misses += 1
+        else:
+            stats.hits += 1
+        return value
+
+    def set(self, key, value):
+        current_app.extensions['search_cache'][0].set(key, value)
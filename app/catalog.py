@@ -0,0 +1,174 @@
+import time
+
+from flask import current_app, abort, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.cache import snapshot, attach
+
+
+class CatalogState:
+    def __init__(self, version):
+        self.version = version
+        self.checked = time.monotonic()
+        self.distilleries = {}          # id -> snapshot, or None if there is no such row
+        self.whiskies = {}              # id -> snapshot, or None
+        self.distillery_names = {}      # name -> id, or None
+        self.whisky_names = {}          # (distillery id, name) -> id, or None
+        self.distillery_whiskies = {}   # distillery id -> [whisky id]
+        self.distillery_order = None    # all distillery ids ordered by name
+
+
+class Catalog:
+    """Process-local read-through cache of distilleries and whiskies.
+
+    Lookups are filled from the database on first use, including negative results for uniqueness checks.
+    Every worker compares its copy against the `catalog` stamp at most once per `CATALOG_CHECK_INTERVAL`
+    seconds and drops it when the stamp moved; commits in this worker drop it immediately. Pages validated by
+    the stamp, and uniqueness checks, bring it up to date with `sync` instead.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['catalog'] = CatalogState(version=None)
+        from app import db
+        if not event.contains(db.session, 'after_commit', reset_after_commit):
+            event.listen(db.session, 'after_commit', reset_after_commit)
+            event.listen(db.session, 'after_rollback', discard_touched_stamps)
+
+    def _state(self):
+        state = current_app.extensions['catalog']
+        if state.version is None or time.monotonic() - state.checked >= current_app.config['CATALOG_CHECK_INTERVAL']:
+            state = self.sync()
+        return state
+
+    @staticmethod
+    def sync(version=None):
+        """Drops the cached catalog unless it is at stamp `version`, by default the stamp in the database now.
+
+        Conditional views pass the version their ETag was built from, so the page they render matches it.
+        """
+        from app import db
+        from app.models import Stamp
+        if version is None:
+            version = db.session.query(Stamp.version).filter_by(name='catalog').scalar() or 0
+        state = current_app.extensions['catalog']
+        if version != state.version:
+            state = current_app.extensions['catalog'] = CatalogState(version)
+        state.checked = time.monotonic()
+        return state
+
+    def reset(self):
+        current_app.extensions['catalog'] = CatalogState(version=None)
+
+    def _distillery_values(self, state, id):
+        from app.models import Distillery
+        if id not in state.distilleries:
+            dist = Distillery.query.get(id)
+            state.distilleries[id] = snapshot(dist) if dist is not None else None
+        return state.distilleries[id]
+
+    def _whisky_values(self, state, id):
+        from app.models import Whisky
+        if id not in state.whiskies:
+            wsk = Whisky.query.get(id)
+            state.whiskies[id] = snapshot(wsk) if wsk is not None else None
+        return state.whiskies[id]
+
+    def distillery(self, id):
+        from app import db
+        from app.models import Distillery
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+        values = self._distillery_values(self._state(), id)
+        return attach(db.session, Distillery, values) if values is not None else None
+
+    def whisky(self, id):
+        """The whisky with `id`, with its distillery attached so `whisky.distillery` needs no query."""
+        from app import db
+        from app.models import Whisky
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+        values = self._whisky_values(self._state(), id)
+        if values is None:
+            return None
+        wsk = attach(db.session, Whisky, values)
+        if values['distillery_id'] is not None and 'distillery' not in inspect(wsk).dict:
+            # The identity map only holds weak references, so the distillery is kept on the whisky itself
+            set_committed_value(wsk, 'distillery', self.distillery(values['distillery_id']))
+        return wsk
+
+    def distillery_or_404(self, id):
+        return self.distillery(id) or abort(404)
+
+    def whisky_or_404(self, id):
+        return self.whisky(id) or abort(404)
+
+    def distillery_name(self, id):
+        if id is None or not has_app_context() or 'catalog' not in current_app.extensions:
+            return None
+        values = self._distillery_values(self._state(), id)
+        return values['name'] if values is not None else None
+
+    def distillery_id(self, name):
+        """Id of the distillery called `name` (using the database's name comparison), or None."""
+        from app.models import Distillery
+        state = self._state()
+        if name not in state.distillery_names:
+            dist = Distillery.query.filter_by(name=name).first()
+            state.distillery_names[name] = dist.id if dist is not None else None
+        return state.distillery_names[name]
+
+    def whisky_id(self, distillery_id, name):
+        from app.models import Whisky
+        state = self._state()
+        key = (distillery_id, name)
+        if key not in state.whisky_names:
+            wsk = Whisky.query.filter_by(distillery_id=distillery_id, name=name).first()
+            state.whisky_names[key] = wsk.id if wsk is not None else None
+        return state.whisky_names[key]
+
+    def whiskies_of(self, distillery_id):
+        """The whiskies of a distillery, in the order `Distillery.whiskys` returns them."""
+        from app import db
+        from app.models import Whisky
+        state = self._state()
+        if distillery_id not in state.distillery_whiskies:
+            whiskies = Whisky.query.filter_by(distillery_id=distillery_id).order_by(Whisky.id).all()
+            for wsk in whiskies:
+                state.whiskies[wsk.id] = snapshot(wsk)
+            state.distillery_whiskies[distillery_id] = [wsk.id for wsk in whiskies]
+        return [attach(db.session, Whisky, state.whiskies[id]) for id in state.distillery_whiskies[distillery_id]]
+
+    def distilleries(self):
+        """All distilleries ordered by name. The first call also loads every whisky, since the list shows them."""
+        from app import db
+        from app.models import Distillery, Whisky
+        state = self._state()
+        if state.distillery_order is None:
+            dists = Distillery.query.order_by(Distillery.name.asc()).all()
+            whiskies = {dist.id: [] for dist in dists}
+            for wsk in Whisky.query.order_by(Whisky.id):
+                state.whiskies[wsk.id] = snapshot(wsk)
+                whiskies.setdefault(wsk.distillery_id, []).append(wsk.id)
+            for dist in dists:
+                state.distilleries[dist.id] = snapshot(dist)
+            state.distillery_whiskies.update(whiskies)
+            state.distillery_order = [dist.id for dist in dists]
+        return [attach(db.session, Distillery, state.distilleries[id]) for id in state.distillery_order]
+
+
+def reset_after_commit(session):
+    if 'catalog' in session.info.pop('touched_stamps', ()) and has_app_context() and \
+            'catalog' in current_app.extensions:
+        current_app.extensions['catalog'] = CatalogState(version=None)
+
+
+def discard_touched_stamps(session):
+    session.info.pop('touched_stamps', None)
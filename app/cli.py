@@ -1,4 +1,6 @@
+import json
 import os
+import time
 
 import click
 
@@ -60,3 +62,225 @@ def register(app):
         """
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def recommend():
+        """Recommendation commands"""
+        pass
+
+    @recommend.command()
+    @click.option('--neighbours', default=None, type=int, help='Similar whiskies kept per whisky.')
+    @click.option('--top', default=None, type=int, help='Recommendations stored per user.')
+    def build(neighbours, top):
+        """Rebuild the "you might like" table from whiskies listed and review scores.
+
+        USAGE in command line:
+            $ flask recommend build
+            $ flask recommend build --neighbours 100 --top 20
+        """
+        from app.recommend import build_recommendations
+        written = build_recommendations(neighbours=neighbours or app.config['RECOMMEND_NEIGHBOURS'],
+                                        top_n=top or app.config['RECOMMENDATIONS_PER_USER'])
+        click.echo(f'{written} recommendations written.')
+
+    @app.cli.group()
+    def assets():
+        """Static asset commands"""
+        pass
+
+    @assets.command('build')
+    @click.option('--no-vendor', is_flag=True, help='Skip downloading third-party assets.')
+    def build_assets(no_vendor):
+        """Vendor, fingerprint and precompress the static files into app/static/build.
+
+        USAGE in command line:
+            $ flask assets build
+            $ flask assets build --no-vendor
+        """
+        from app.assets import vendor, build
+        if not no_vendor:
+            vendor(app.static_folder)
+        manifest = build(app.static_folder)
+        click.echo(f"{len(manifest['files'])} files fingerprinted.")
+
+    @app.cli.group()
+    def search():
+        """Search commands"""
+        pass
+
+    @search.command('warm')
+    @click.option('--top', default=50, help='Number of searches to run.')
+    @click.option('--days', default=7, help='Count searches of this many days.')
+    def search_warm(top, days):
+        """Run the most frequent searches of the search log, so the first users after a deploy hit warm caches.
+
+        USAGE in command line:
+            $ flask search warm
+            $ flask search warm --top 200 --days 1
+
+        This fills the search cache of this process, which only helps other processes with a shared
+        SEARCH_CACHE_BACKEND, and Elasticsearch's own caches. Set SEARCH_WARM_TOP to warm the cache of every
+        gunicorn worker as it starts.
+        """
+        from app.searchlog import warm
+        start = time.perf_counter()
+        count = warm(top, days)
+        click.echo(f'{count} searches run in {time.perf_counter() - start:.2f} s.')
+
+    @search.command('rebuild')
+    def search_rebuild():
+        """Delete the review index and index every review again, into one partition per year.
+
+        USAGE in command line:
+            $ flask search rebuild
+
+        Also turns a review index made before partitioning into partitions. Searches find nothing until it is done.
+        """
+        from app.search import rebuild, IndexingError
+        start = time.perf_counter()
+        try:
+            counts, failed = rebuild('review'), {}
+        except IndexingError as e:
+            counts, failed = e.counts, e.failed
+        for name, count in sorted(counts.items()):
+            click.echo(f'{name}: {count} reviews')
+        click.echo(f'{sum(counts.values())} reviews indexed in {time.perf_counter() - start:.2f} s.')
+        if failed:
+            for id, reason in sorted(failed.items()):
+                click.echo(f'review {id}: {reason}', err=True)
+            raise RuntimeError(f'{len(failed)} reviews failed to index.')
+
+    @search.command('optimize')
+    @click.option('--before', type=int, help='Optimize the partitions of years before this one. Defaults to this year.')
+    def search_optimize(before):
+        """Force-merge past years of the review index into one segment each and make them read-only.
+
+        USAGE in command line:
+            $ flask search optimize
+            $ flask search optimize --before 2020
+
+        Run it once a year goes by. A review of an optimized year that is edited opens its partition for writes
+        again, until the next run.
+        """
+        from app.search import optimize
+        names = optimize('review', before)
+        click.echo(f"Optimized {', '.join(names)}." if names else 'No partition to optimize.')
+
+    @app.cli.group()
+    def bench():
+        """Benchmark commands"""
+        pass
+
+    @bench.command('passwords')
+    @click.option('--method', 'methods', multiple=True,
+                  help='Werkzeug hash method to measure, may be repeated. Defaults to a range of pbkdf2 costs.')
+    @click.option('--duration', default=1.0, help='Seconds spent measuring each method.')
+    def bench_passwords(methods, duration):
+        """Report the login cost of password hash settings, to choose PASSWORD_HASH_METHOD.
+
+        USAGE in command line:
+            $ flask bench passwords
+            $ flask bench passwords --method pbkdf2:sha256:150000 --method pbkdf2:sha256:600000
+        """
+        from app.bench import password_throughput
+        methods = methods or [f'pbkdf2:sha256:{n}' for n in (50000, 150000, 260000, 600000)]
+        click.echo(f"{'method':<28}{'ms/login':>10}{'logins/s/core':>15}{'logins/s (all cores)':>22}")
+        for method in methods:
+            result = password_throughput(method, duration, app.config['PASSWORD_SALT_LENGTH'])
+            marker = ' *' if method == app.config['PASSWORD_HASH_METHOD'] else ''
+            click.echo(f"{method:<28}{result['ms_per_login']:>10}{result['logins_per_second_per_core']:>15}"
+                       f"{result['logins_per_second_all_cores']:>22}{marker}")
+
+    @bench.command('generate')
+    @click.option('--distilleries', default=1000)
+    @click.option('--whiskies', default=5000)
+    @click.option('--users', default=2000)
+    @click.option('--reviews', default=50000)
+    @click.option('--listed', default=10, help='Average whiskies listed per user.')
+    @click.option('--seed', default=0, help='Same seed, same data.')
+    def bench_generate(distilleries, whiskies, users, reviews, listed, seed):
+        """Bulk load synthetic distilleries, whiskies, users, reviews and lists for benchmarking.
+
+        USAGE in command line:
+            $ flask bench generate
+            $ flask bench generate --distilleries 100000 --whiskies 100000 --reviews 1000000
+
+        Don't run it against a database with real users in it.
+        """
+        from app.bench import generate
+        click.echo(json.dumps(generate(distilleries, whiskies, users, reviews, listed, seed), indent=2))
+
+    @bench.command('routes')
+    @click.option('--requests', default=50, help='Measured requests per route.')
+    @click.option('--route', 'routes', multiple=True,
+                  help='explore, whisky, whisky_list, user, search or submit_review, may be repeated. Defaults to all.')
+    @click.option('--output', type=click.File('w'), default='-', help='File to write the JSON report to.')
+    def bench_routes(requests, routes, output):
+        """Report p50/p95 latency and query counts of the main routes as JSON, to compare across commits.
+
+        USAGE in command line:
+            $ flask bench routes
+            $ flask bench routes --route whisky --route explore --requests 200 --output before.json
+        """
+        from app.bench import route_latency
+        json.dump(route_latency(app, requests, routes), output, indent=2)
+        output.write('\n')
+
+    @bench.command('search')
+    @click.option('--requests', default=50, help='Measured requests per kind of search.')
+    @click.option('--latency', default=5.0, help='Milliseconds the fake Elasticsearch takes to answer.')
+    @click.option('--jitter', default=0.0, help='Up to this many extra milliseconds, at random.')
+    @click.option('--failure-rate', default=0.0, help='Share of Elasticsearch requests that fail with a 503.')
+    @click.option('--documents', default=None, type=int, help='Index only this many reviews.')
+    @click.option('--output', type=click.File('w'), default='-', help='File to write the JSON report to.')
+    def bench_search(requests, latency, jitter, failure_rate, documents, output):
+        """Benchmark the search routes against a local fake Elasticsearch loaded with the database's reviews.
+
+        USAGE in command line:
+            $ flask bench search
+            $ flask bench search --latency 20 --jitter 30 --failure-rate 0.05 --output search.json
+
+        app_p50_ms in the report is the time spent outside Elasticsearch: query building, loading the
+        reviews and rendering. No real cluster is touched.
+        """
+        from app.bench import search_latency
+        json.dump(search_latency(app, requests, latency / 1000, jitter / 1000, failure_rate, documents=documents),
+                  output, indent=2)
+        output.write('\n')
+
+    @bench.command('startup')
+    @click.option('--runs', default=3, help='Times the app is imported and the server started.')
+    @click.option('--command', default=None,
+                  help='Server command, with {port} for the port to bind. Defaults to gunicorn with gunicorn.conf.py.')
+    @click.option('--path', default='/auth/login', help='Page requested until the server answers.')
+    @click.option('--output', type=click.File('w'), default='-', help='File to write the JSON report to.')
+    def bench_startup(runs, command, path, output):
+        """Report the app's import time and the time from starting a server to its first response as JSON.
+
+        USAGE in command line:
+            $ flask bench startup
+            $ GUNICORN_PRELOAD=false flask bench startup --output no-preload.json
+            $ flask bench startup --command "flask run --port {port}"
+
+        slowest_packages_ms adds up the import time of each top-level package, from `python -X importtime`.
+        """
+        from app.bench import startup_time, DEFAULT_SERVER
+        json.dump(startup_time(runs, command or DEFAULT_SERVER, path), output, indent=2)
+        output.write('\n')
+
+    @app.cli.command()
+    @click.option('--concurrency', default=1, help='Jobs run at the same time.')
+    @click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+    def worker(concurrency, burst):
+        """Run queued background jobs: search indexing, email and scheduled rebuilds.
+
+        USAGE in command line:
+            $ flask worker
+            $ flask worker --concurrency 4
+            $ flask worker --burst
+
+        The web processes only queue jobs when they run with JOB_WORKER set, otherwise they run them themselves.
+        """
+        from app.jobs import work
+        app.config['JOB_WORKER'] = True
+        work(app, concurrency, burst)
@@ -0,0 +1,52 @@
+from functools import wraps
+from hashlib import sha1
+
+from flask import request, session, g, current_app, make_response
+from flask_login import current_user
+
+
+def conditional(validator):
+    """Answers `If-None-Match` / `If-Modified-Since` with 304 before the decorated view runs.
+
+    `validator(**view_args)` returns `(parts, last_modified)` from cheap queries, where `parts` is anything
+    with a stable repr. The ETag also covers the current user and locale, since pages render differently
+    for each. Returning None from the validator skips the check, e.g. to let the view 404.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            # Pending flash messages are consumed by rendering, so the page must not be short-circuited
+            if request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+            validators = validator(**kwargs)
+            if validators is None:
+                return f(*args, **kwargs)
+            parts, last_modified = validators
+            user_id = current_user.get_id() if current_user.is_authenticated else None
+            etag = sha1(repr((parts, user_id, g.locale, request.args)).encode('utf-8')).hexdigest()
+            if last_modified is not None:
+                last_modified = last_modified.replace(microsecond=0)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            elif request.if_modified_since and last_modified is not None:
+                not_modified = last_modified <= request.if_modified_since.replace(tzinfo=None)
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            if user_id is not None:
+                response.cache_control.private = True
+            response.vary.add('Cookie')
+            return response
+        return wrapped
+    return decorator
@@ -1,18 +1,19 @@
-from threading import Thread
-
 from flask import current_app
 from flask_mail import Message
 
-from app import mail
-
+from app import mail_pool
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
 
-
-def send_email(subject, sender, recipients, text_body, html_body):
+def build_message(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(),msg)).start()
+    return msg
+
+
+def send_email(subject, sender, recipients, text_body, html_body):
+    """Sends through the job queue when a worker runs (commit the session afterwards), else the mail pool."""
+    if current_app.config['JOB_WORKER']:
+        from app.jobs import enqueue
+        return enqueue('send_email', subject, sender, recipients, text_body, html_body)
+    return mail_pool.submit(build_message(subject, sender, recipients, text_body, html_body))
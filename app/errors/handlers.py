@@ -1,15 +1,34 @@
-from flask import render_template
+from flask import render_template, request, make_response
 
 from app import db
 from app.errors import bp
+from app.api.errors import error_response
+
+
+def wants_json_response():
+    return request.path.startswith('/api/')
 
 
 @bp.app_errorhandler(404)
 def not_found_error(error):
+    if wants_json_response():
+        return error_response(404)
     return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    if wants_json_response():
+        response = error_response(429)
+    else:
+        response = make_response(render_template('errors/429.html'), 429)
+    response.headers['Retry-After'] = str(getattr(error, 'retry_after', 1))
+    return response
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
+    if wants_json_response():
+        return error_response(500)
     return render_template('errors/500.html'), 500
@@ -0,0 +1,25 @@
+import time
+
+from elasticsearch import Transport
+from flask import g, has_request_context
+
+from app.metrics import observe_elasticsearch
+
+
+class TimedTransport(Transport):
+    """Adds the time spent waiting on Elasticsearch to `g.es_time`, for the request logs, and to the metrics."""
+    def perform_request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().perform_request(method, url, *args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if has_request_context():
+                g.es_time = g.get('es_time', 0.0) + elapsed
+            # The API called, like `_search` or `_doc`, without index names or ids
+            operation = next((part for part in url.split('/') if part.startswith('_')), 'index')
+            observe_elasticsearch(f'{method} {operation}', elapsed, error)
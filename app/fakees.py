@@ -0,0 +1,712 @@
+"""A stand-in for the parts of Elasticsearch 7 the app uses, served over HTTP on localhost.
+
+It speaks enough of the REST API for the real client: index creation and mappings, index templates,
+aliases, `_settings` (only `index.blocks.write` has an effect) and `_forcemerge`, single document index, get
+and delete, `_bulk`, `_refresh`, `_count` and `_search` with `bool`, `match`, `multi_match`, `term`, `terms`,
+`range` and `match_all` queries, sorting, paging, `terms` aggregations and the `term` suggester. Index names
+in a request may be comma separated, aliases or wildcards.
+Scoring is a plain tf-idf, so relevance order is deterministic but not Lucene's. `latency`, `jitter` and
+`failure_rate` add a delay to, or fail with `failure_status`, every request except the root info endpoint.
+"""
+
+import fnmatch
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+
+
+_token = re.compile(r'\w+')
+
+
+class FakeError(Exception):
+    def __init__(self, status, type, reason):
+        super().__init__(reason)
+        self.status = status
+        self.type = type
+        self.reason = reason
+
+    def body(self):
+        return {'error': {'type': self.type, 'reason': self.reason, 'root_cause': [
+            {'type': self.type, 'reason': self.reason}]}, 'status': self.status}
+
+
+def tokens(value):
+    if isinstance(value, list):
+        return [t for v in value for t in tokens(v)]
+    return _token.findall(str(value).lower()) if value is not None else []
+
+
+def _edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def _fuzzy_limit(token, fuzziness):
+    if fuzziness in (None, 0, '0'):
+        return 0
+    if str(fuzziness).upper() == 'AUTO':
+        return 0 if len(token) < 3 else 1 if len(token) < 6 else 2
+    return int(fuzziness)
+
+
+def _flatten(settings, prefix=''):
+    """{'index': {'blocks': {'write': True}}} as {'index.blocks.write': True}, the way they are stored."""
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+class Index:
+    def __init__(self, name, mappings=None, aliases=(), settings=None):
+        self.name = name
+        self.mappings = mappings or {'properties': {}}
+        self.aliases = set(aliases)
+        self.settings = _flatten(settings or {})
+        self.forcemerges = 0
+        self.docs = {}
+        self.versions = {}
+        # Tokens of every text field of every document, and the documents containing each (field, token).
+        # Other fields are posted under their whole value, matched exactly like keywords, prefixed with '='.
+        self.analyzed = {}
+        self.postings = defaultdict(set)
+
+    def field_type(self, field):
+        return self.mappings['properties'].get(field, {}).get('type', 'text')
+
+    def fields(self, patterns):
+        names = set(self.mappings['properties'])
+        for source in self.docs.values():
+            names.update(source)
+        matched = []
+        for pattern in patterns:
+            pattern, _, boost = pattern.partition('^')
+            regex = re.compile('^' + re.escape(pattern).replace(r'\*', '.*') + '$')
+            matched += [(name, float(boost or 1)) for name in sorted(names) if regex.match(name)]
+        return matched
+
+    def check_write(self):
+        if str(self.settings.get('index.blocks.write', False)).lower() == 'true':
+            raise FakeError(403, 'cluster_block_exception',
+                            f'index [{self.name}] blocked by: [FORBIDDEN/8/index write (api)];')
+
+    def put(self, id, source):
+        result = 'updated' if id in self.docs else 'created'
+        self.remove(id)
+        self.docs[id] = source
+        self.versions[id] = self.versions.get(id, 0) + 1
+        self.analyzed[id] = {field: Counter(tokens(value)) for field, value in source.items()
+                             if isinstance(value, (str, list)) and self.field_type(field) == 'text'}
+        for key in self._keys(id):
+            self.postings[key].add(id)
+        return result
+
+    def remove(self, id):
+        if id not in self.docs:
+            return False
+        for key in self._keys(id):
+            self.postings[key].discard(id)
+        del self.docs[id]
+        del self.analyzed[id]
+        return True
+
+    def _keys(self, id):
+        for field, value in self.docs[id].items():
+            if field in self.analyzed[id]:
+                yield from ((field, token) for token in self.analyzed[id][field])
+            elif value is not None:
+                yield from ((field, '=' + str(v)) for v in (value if isinstance(value, list) else [value]))
+
+
+class Engine:
+    """The indices and the query evaluation, without any HTTP."""
+    def __init__(self):
+        self.indices = {}
+        self.templates = {}
+        self.lock = threading.RLock()
+        self._next_id = 0
+
+    def create(self, name, mappings=None, aliases=(), settings=None):
+        """Creates index `name` with what the templates matching its name add to the given mappings and aliases."""
+        if name in self.indices:
+            raise FakeError(400, 'resource_already_exists_exception', f'index [{name}] already exists')
+        if self.aliased(name):
+            raise FakeError(400, 'invalid_index_name_exception', f'Invalid index name [{name}], an alias with the '
+                                                                 f'same name already exists')
+        properties, aliases, merged = {}, set(aliases), {}
+        for template in sorted(self.templates.values(), key=lambda t: t.get('order', 0)):
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in template.get('index_patterns', [])):
+                properties.update((template.get('mappings') or {}).get('properties', {}))
+                aliases.update(template.get('aliases') or {})
+                merged.update(_flatten(template.get('settings') or {}))
+        properties.update((mappings or {}).get('properties', {}))
+        merged.update(_flatten(settings or {}))
+        index = self.indices[name] = Index(name, {'properties': properties}, aliases, merged)
+        return index
+
+    def aliased(self, alias):
+        return [index for index in self.indices.values() if alias in index.aliases]
+
+    def index(self, name, create=True):
+        """The index `name`, or the only index of alias `name`, created when it doesn't exist and `create` is set."""
+        if name in self.indices:
+            return self.indices[name]
+        aliased = self.aliased(name)
+        if len(aliased) == 1:
+            return aliased[0]
+        if aliased:
+            raise FakeError(400, 'illegal_argument_exception', f'no write index is defined for alias [{name}]')
+        if not create:
+            raise FakeError(404, 'index_not_found_exception', f'no such index [{name}]')
+        return self.create(name)
+
+    def targets(self, names):
+        """The indices named by a comma separated list of index names, aliases and wildcards."""
+        if names in (None, '', '_all', '*'):
+            return list(self.indices.values())
+        found = {}
+        for name in names.split(','):
+            if '*' in name:
+                matched = [i for n, i in sorted(self.indices.items())
+                           if fnmatch.fnmatchcase(n, name) or any(fnmatch.fnmatchcase(a, name) for a in i.aliases)]
+            else:
+                matched = [self.indices[name]] if name in self.indices else self.aliased(name)
+                if not matched:
+                    raise FakeError(404, 'index_not_found_exception', f'no such index [{name}]')
+            found.update((index.name, index) for index in matched)
+        return list(found.values())
+
+    def auto_id(self):
+        self._next_id += 1
+        return f'fake{self._next_id}'
+
+    """Queries"""
+
+    def _match_score(self, index, field, query, boost=1.0, fuzziness=None, operator='or'):
+        """Score of `field` against the analyzed `query`, or None when it does not match."""
+        query_tokens = tokens(query)
+        whole = str(query)
+
+        def score(id, source):
+            value = source.get(field)
+            if value is None:
+                return None
+            doc_tokens = index.analyzed[id].get(field)
+            if doc_tokens is None:
+                values = value if isinstance(value, list) else [value]
+                # Fields that aren't text, like keywords, match their whole value exactly
+                return boost if any(str(v) == whole for v in values) else None
+            total, matched = 0.0, 0
+            for token in query_tokens:
+                limit = _fuzzy_limit(token, fuzziness)
+                tf = doc_tokens[token]
+                if limit:
+                    tf = sum(n for t, n in doc_tokens.items() if _edit_distance(t, token, limit) <= limit)
+                if tf:
+                    matched += 1
+                    df = len(index.postings.get((field, token), ()))
+                    total += (1 + math.log(tf)) * math.log(1 + (len(index.docs) + 1) / (df + 1))
+            if not matched or (operator.lower() == 'and' and matched < len(query_tokens)):
+                return None
+            return total * boost
+        return score
+
+    def compile(self, index, query):
+        """Turns a query clause into `f(id, source)` returning a score, or None when the document doesn't match."""
+        if not query:
+            return lambda id, source: 1.0
+        (kind, params), = query.items()
+        if kind == 'match_all':
+            return lambda id, source: float(params.get('boost', 1))
+        if kind == 'match':
+            (field, spec), = params.items()
+            spec = spec if isinstance(spec, dict) else {'query': spec}
+            return self._match_score(index, field, spec['query'], float(spec.get('boost', 1)), spec.get('fuzziness'),
+                                     spec.get('operator', 'or'))
+        if kind == 'multi_match':
+            matches = [self._match_score(index, field, params['query'], boost, params.get('fuzziness'),
+                                         params.get('operator', 'or'))
+                       for field, boost in index.fields(params.get('fields', ['*']))]
+            combine = sum if params.get('type') == 'most_fields' else max
+            boost = float(params.get('boost', 1))
+
+            def multi_match(id, source):
+                scores = [s for s in (m(id, source) for m in matches) if s is not None]
+                return combine(scores) * boost if scores else None
+            return multi_match
+        if kind in ('term', 'terms'):
+            (field, spec), = params.items()
+            if kind == 'term':
+                spec = spec if isinstance(spec, dict) else {'value': spec}
+                wanted, boost = [spec['value']], float(spec.get('boost', 1))
+            else:
+                wanted, boost = spec, 1.0
+
+            def term(id, source):
+                value = source.get(field)
+                values = value if isinstance(value, list) else [value]
+                if field in index.analyzed[id]:
+                    values = index.analyzed[id][field]
+                return boost if any(w in values for w in wanted) else None
+            return term
+        if kind == 'range':
+            (field, bounds), = params.items()
+            checks = {'gte': lambda v, b: v >= b, 'gt': lambda v, b: v > b,
+                      'lte': lambda v, b: v <= b, 'lt': lambda v, b: v < b}
+
+            def range_(id, source):
+                value = source.get(field)
+                if value is None:
+                    return None
+                try:
+                    ok = all(checks[op](value, bound) for op, bound in bounds.items() if op in checks)
+                except TypeError:
+                    return None
+                return float(bounds.get('boost', 1)) if ok else None
+            return range_
+        if kind == 'bool':
+            def clauses(name):
+                value = params.get(name) or []
+                return [self.compile(index, q) for q in (value if isinstance(value, list) else [value])]
+            must, should, filter_, must_not = clauses('must'), clauses('should'), clauses('filter'), \
+                clauses('must_not')
+            minimum = params.get('minimum_should_match')
+            minimum = int(minimum) if minimum is not None else (0 if must or filter_ else 1)
+            boost = float(params.get('boost', 1))
+
+            def bool_(id, source):
+                total = 0.0
+                for clause in must:
+                    score = clause(id, source)
+                    if score is None:
+                        return None
+                    total += score
+                if any(clause(id, source) is None for clause in filter_):
+                    return None
+                if any(clause(id, source) is not None for clause in must_not):
+                    return None
+                matched = [s for s in (clause(id, source) for clause in should) if s is not None]
+                if should and len(matched) < minimum:
+                    return None
+                return (total + sum(matched)) * boost
+            return bool_
+        raise FakeError(400, 'parsing_exception', f'unknown query [{kind}]')
+
+    def candidates(self, index, query):
+        """Ids of the documents that can match `query`, a superset found from the postings, or None for all."""
+        if not query:
+            return None
+        (kind, params), = query.items()
+        postings = index.postings
+        if kind in ('match', 'multi_match'):
+            if kind == 'match':
+                (field, spec), = params.items()
+                spec = spec if isinstance(spec, dict) else {'query': spec}
+                fields = [field]
+            else:
+                spec, fields = params, [f for f, _ in index.fields(params.get('fields', ['*']))]
+            if spec.get('fuzziness') not in (None, 0, '0'):
+                return None
+            ids = set()
+            for field in fields:
+                for token in tokens(spec['query']):
+                    ids |= postings.get((field, token), set())
+                ids |= postings.get((field, '=' + str(spec['query'])), set())
+            return ids
+        if kind in ('term', 'terms'):
+            (field, spec), = params.items()
+            values = spec if kind == 'terms' else [spec['value'] if isinstance(spec, dict) else spec]
+            ids = set()
+            for value in values:
+                ids |= postings.get((field, str(value)), set()) | postings.get((field, '=' + str(value)), set())
+            return ids
+        if kind == 'bool':
+            def clauses(name):
+                value = params.get(name) or []
+                return value if isinstance(value, list) else [value]
+            required = [self.candidates(index, q) for q in clauses('must') + clauses('filter')]
+            required = [ids for ids in required if ids is not None]
+            if required:
+                return set.intersection(*required)
+            minimum = params.get('minimum_should_match')
+            should = [self.candidates(index, q) for q in clauses('should')]
+            if should and (minimum is None or int(minimum) > 0) and None not in should:
+                return set.union(*should)
+        return None
+
+    def search(self, names, body):
+        body = body or {}
+        hits = []
+        with self.lock:
+            for index in self.targets(names):
+                matcher = self.compile(index, body.get('query'))
+                ids = self.candidates(index, body.get('query'))
+                for id in index.docs if ids is None else [id for id in index.docs if id in ids]:
+                    source = index.docs[id]
+                    score = matcher(id, source)
+                    if score is not None:
+                        hits.append({'_index': index.name, '_type': '_doc', '_id': id, '_score': score,
+                                     '_source': dict(source)})
+        sort = body.get('sort', '_score')
+        sort = sort if isinstance(sort, list) else [sort]
+        keys = []
+        for spec in sort:
+            field, order = (spec, 'desc' if spec == '_score' else 'asc') if isinstance(spec, str) else \
+                next(iter(spec.items()))
+            order = order.get('order', 'asc') if isinstance(order, dict) else order
+            keys.append((field, order))
+        # Stable sorts from the last key to the first, documents without the field go last
+        for field, order in reversed(keys):
+            getter = (lambda hit: hit['_score']) if field == '_score' else (lambda hit, f=field: hit['_source'].get(f))
+            present = [h for h in hits if getter(h) is not None]
+            missing = [h for h in hits if getter(h) is None]
+            hits = sorted(present, key=getter, reverse=order == 'desc') + missing
+        if keys != [('_score', 'desc')]:
+            for hit in hits:
+                hit['sort'] = [hit['_score'] if f == '_score' else hit['_source'].get(f) for f, _ in keys]
+                if all(f != '_score' for f, _ in keys):
+                    hit['_score'] = None
+        start = int(body.get('from', 0))
+        page = hits[start:start + int(body.get('size', 10))]
+        scores = [h['_score'] for h in hits if h['_score'] is not None]
+        result = {
+            'took': 1, 'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'max_score': max(scores) if scores else None,
+                     'hits': page},
+        }
+        aggs = body.get('aggs') or body.get('aggregations')
+        if aggs:
+            result['aggregations'] = {name: self.aggregate(spec, hits) for name, spec in aggs.items()}
+        if body.get('suggest'):
+            with self.lock:
+                result['suggest'] = self.suggest(self.targets(names), body['suggest'])
+        return result
+
+    @staticmethod
+    def aggregate(spec, hits):
+        (kind, params), = spec.items()
+        if kind != 'terms':
+            raise FakeError(400, 'parsing_exception', f'unknown aggregation [{kind}]')
+        counts = Counter()
+        for hit in hits:
+            value = hit['_source'].get(params['field'])
+            counts.update(set(value if isinstance(value, list) else [value]) - {None})
+        # Most documents first, then by key like Elasticsearch
+        buckets = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+        size = int(params.get('size', 10))
+        return {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': sum(n for _, n in buckets[size:]),
+                'buckets': [{'key': key, 'doc_count': n} for key, n in buckets[:size]]}
+
+    @staticmethod
+    def suggest(indices, specs):
+        """The term suggester: for each word, indexed words at most `max_edits` edits away, closest first."""
+        result = {}
+        for name, spec in specs.items():
+            if name == 'text':
+                continue
+            params = spec['term']
+            field, mode = params['field'], params.get('suggest_mode', 'missing')
+            max_edits, size = int(params.get('max_edits', 2)), int(params.get('size', 5))
+            prefix = int(params.get('prefix_length', 1))
+            freq = Counter()
+            for index in indices:
+                freq.update({token: len(ids) for (f, token), ids in index.postings.items() if f == field and ids})
+            entries = []
+            text = spec.get('text', specs.get('text', ''))
+            for match in _token.finditer(text.lower()):
+                word = match.group()
+                options = []
+                if not (mode == 'missing' and freq.get(word)) and len(word) > prefix:
+                    for token, n in freq.items():
+                        if token == word or token[:prefix] != word[:prefix]:
+                            continue
+                        distance = _edit_distance(token, word, max_edits)
+                        if distance <= max_edits and (mode != 'popular' or n > freq.get(word, 0)):
+                            options.append({'text': token, 'score': 1 - distance / max(len(word), len(token)),
+                                            'freq': n})
+                options.sort(key=lambda o: (-o['score'], -o['freq'], o['text']))
+                entries.append({'text': word, 'offset': match.start(), 'length': len(word), 'options': options[:size]})
+            result[name] = entries
+        return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        server = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        parts = [unquote(p) for p in urlsplit(self.path).path.split('/') if p]
+        try:
+            if parts:
+                server.delay()
+            status, body = server.handle(method, parts, raw)
+        except FakeError as e:
+            status, body = e.status, e.body()
+        except (ValueError, KeyError, TypeError) as e:
+            status, body = 400, FakeError(400, 'parsing_exception', repr(e)).body()
+        data = json.dumps(body).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if method != 'HEAD':
+                self.wfile.write(data)
+        except ConnectionError:
+            # The client timed out while the injected latency was applied
+            self.close_connection = True
+
+
+class FakeElasticsearch:
+    """Serves an `Engine` on 127.0.0.1, on a free port unless `port` is given. Use as a context manager, or
+    `start()` and `stop()`, and point a client at `url`.
+    """
+    def __init__(self, port=0, latency=0.0, jitter=0.0, failure_rate=0.0, failure_status=503, seed=None):
+        self.engine = Engine()
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', self._port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-elasticsearch', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def delay(self):
+        """Applies the injected latency and failures to one request."""
+        self.requests += 1
+        wait = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if wait:
+            time.sleep(wait)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            self.failures += 1
+            raise FakeError(self.failure_status, 'injected_failure', 'failure injected by the fake server')
+
+    def handle(self, method, parts, raw):
+        engine = self.engine
+        body = json.loads(raw) if raw and not (parts and parts[-1] == '_bulk') else None
+        with engine.lock:
+            if not parts:
+                return 200, {'name': 'fake', 'cluster_name': 'fake', 'version': {'number': '7.0.0'},
+                             'tagline': 'You Know, for Search'}
+            if parts[-1] == '_search':
+                return 200, engine.search(parts[0] if len(parts) > 1 else None, body)
+            if parts[-1] == '_count':
+                result = engine.search(parts[0] if len(parts) > 1 else None, dict(body or {}, size=0))
+                return 200, {'count': result['hits']['total']['value']}
+            if parts[-1] == '_bulk':
+                return 200, self._bulk(parts[0] if len(parts) > 1 else None, raw)
+            if parts[-1] == '_refresh':
+                return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+            if parts[-1] == '_mapping':
+                return 200, {i.name: {'mappings': i.mappings} for i in engine.targets(
+                    parts[0] if len(parts) > 1 else None)}
+            if parts[0] == '_template':
+                return self._template_api(method, parts[1], body)
+            if '_alias' in parts:
+                return self._alias_api(method, parts)
+            if parts[-1] == '_aliases':
+                return self._aliases(body)
+            if parts[-1] == '_settings':
+                return self._settings_api(method, parts[0] if len(parts) > 1 else None, body)
+            if parts[-1] == '_forcemerge':
+                indices = engine.targets(parts[0] if len(parts) > 1 else None)
+                for index in indices:
+                    index.forcemerges += 1
+                return 200, {'_shards': {'total': len(indices), 'successful': len(indices), 'failed': 0}}
+            if len(parts) == 1:
+                return self._index_api(method, parts[0], body)
+            if parts[1] == '_doc':
+                return self._doc_api(method, parts[0], parts[2] if len(parts) > 2 else None, body)
+        raise FakeError(400, 'invalid_request', f'unsupported request {method} /{"/".join(parts)}')
+
+    def _index_api(self, method, name, body):
+        engine = self.engine
+        if method == 'PUT':
+            body = body or {}
+            engine.create(name, body.get('mappings'), body.get('aliases') or {}, body.get('settings'))
+            return 200, {'acknowledged': True, 'shards_acknowledged': True, 'index': name}
+        if method == 'DELETE':
+            for n in name.split(','):
+                if n not in engine.indices and engine.aliased(n):
+                    # Like Elasticsearch, an alias doesn't delete the indices behind it
+                    raise FakeError(400, 'illegal_argument_exception',
+                                    f'The provided expression [{n}] matches an alias, specify the corresponding '
+                                    f'concrete indices instead.')
+            for index in engine.targets(name):
+                del engine.indices[index.name]
+            return 200, {'acknowledged': True}
+        if method in ('HEAD', 'GET'):
+            return 200, {index.name: {'aliases': {alias: {} for alias in sorted(index.aliases)},
+                                      'mappings': index.mappings, 'settings': dict(index.settings)}
+                         for index in engine.targets(name)}
+        raise FakeError(405, 'method_not_allowed', method)
+
+    def _template_api(self, method, name, body):
+        templates = self.engine.templates
+        if method == 'PUT':
+            templates[name] = body
+            return 200, {'acknowledged': True}
+        if name not in templates:
+            raise FakeError(404, 'resource_not_found_exception', f'index_template [{name}] missing')
+        if method == 'DELETE':
+            del templates[name]
+            return 200, {'acknowledged': True}
+        return 200, {name: templates[name]}
+
+    def _alias_api(self, method, parts):
+        """`/_alias/<name>` and `/<index>/_alias/<name>`: the indices with alias `name`, or all their aliases."""
+        at = parts.index('_alias')
+        indices = self.engine.targets(parts[0] if at else None)
+        name = parts[at + 1] if len(parts) > at + 1 else None
+        if method == 'PUT':
+            for index in indices:
+                index.aliases.add(name)
+            return 200, {'acknowledged': True}
+        if method == 'DELETE':
+            for index in indices:
+                index.aliases.discard(name)
+            return 200, {'acknowledged': True}
+        found = {index.name: {'aliases': {a: {} for a in sorted(index.aliases)
+                                          if name is None or fnmatch.fnmatchcase(a, name)}} for index in indices}
+        found = {n: aliases for n, aliases in found.items() if aliases['aliases'] or name is None}
+        if name is not None and not found:
+            return 404, {'error': f'alias [{name}] missing', 'status': 404}
+        return 200, found
+
+    def _aliases(self, body):
+        for action in body['actions']:
+            (kind, params), = action.items()
+            for index in self.engine.targets(params.get('index') or ','.join(params['indices'])):
+                if kind == 'add':
+                    index.aliases.add(params['alias'])
+                elif kind == 'remove':
+                    index.aliases.discard(params['alias'])
+                else:
+                    raise FakeError(400, 'illegal_argument_exception', f'unsupported action [{kind}]')
+        return 200, {'acknowledged': True}
+
+    def _settings_api(self, method, name, body):
+        indices = self.engine.targets(name)
+        if method == 'PUT':
+            settings = _flatten(body or {})
+            for index in indices:
+                index.settings.update({key if key.startswith('index.') else f'index.{key}': value
+                                       for key, value in settings.items()})
+            return 200, {'acknowledged': True}
+        return 200, {index.name: {'settings': dict(index.settings)} for index in indices}
+
+    def _doc_api(self, method, name, id, body):
+        if method in ('PUT', 'POST'):
+            index = self.engine.index(name)
+            index.check_write()
+            id = id or self.engine.auto_id()
+            result = index.put(id, body)
+            return (201 if result == 'created' else 200), self._doc_result(index, id, result)
+        index = self.engine.index(name, create=False)
+        if method == 'DELETE':
+            index.check_write()
+            if not index.remove(id):
+                return 404, self._doc_result(index, id, 'not_found')
+            return 200, self._doc_result(index, id, 'deleted')
+        if id not in index.docs:
+            return 404, {'_index': name, '_type': '_doc', '_id': id, 'found': False}
+        return 200, {'_index': name, '_type': '_doc', '_id': id, '_version': index.versions[id], 'found': True,
+                     '_source': index.docs[id]}
+
+    @staticmethod
+    def _doc_result(index, id, result):
+        return {'_index': index.name, '_type': '_doc', '_id': id, '_version': index.versions.get(id, 0),
+                'result': result, '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def _bulk(self, default_index, raw):
+        lines = [json.loads(line) for line in raw.decode('utf-8').splitlines() if line.strip()]
+        items, errors = [], False
+        while lines:
+            (action, meta), = lines.pop(0).items()
+            name, id = meta.get('_index', default_index), meta.get('_id')
+            try:
+                if action == 'delete':
+                    status, result = self._doc_api('DELETE', name, str(id), None)
+                elif action == 'update':
+                    index = self.engine.index(name, create=False)
+                    doc = lines.pop(0)
+                    if id not in index.docs:
+                        raise FakeError(404, 'document_missing_exception', f'[_doc][{id}]: document missing')
+                    index.check_write()
+                    status, result = 200, self._doc_result(index, id, index.put(id, dict(index.docs[id],
+                                                                                       **doc['doc'])))
+                else:
+                    source = lines.pop(0)
+                    if action == 'create' and id in self.engine.index(name).docs:
+                        raise FakeError(409, 'version_conflict_engine_exception', f'[{id}]: document already exists')
+                    status, result = self._doc_api('PUT', name, str(id) if id is not None else None, source)
+            except FakeError as e:
+                result = {'_index': name, '_id': str(id) if id is not None else None, 'error': e.body()['error']}
+                status, errors = e.status, True
+            items.append({action: dict(result, status=status)})
+        return {'took': 1, 'errors': errors, 'items': items}
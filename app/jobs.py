@@ -0,0 +1,267 @@
+"""Background jobs stored in the `job` table and run by `flask worker`.
+
+Tasks are plain functions registered with `@task`. Request code calls `enqueue`, which adds the job to the
+current session so it is committed, or rolled back, together with the writes that caused it. Without
+`JOB_WORKER` set there is no worker process, and tasks run in-process instead: right away, or after the commit
+for jobs queued during a flush.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from app import db
+from app.models import Job
+
+
+tasks = {}
+
+
+def task(name):
+    def decorator(f):
+        tasks[name] = f
+        return f
+    return decorator
+
+
+def _queued(name, args, kwargs, dedup_key, delay, max_attempts):
+    return dict(name=name, args=json.dumps([args, kwargs]), dedup_key=dedup_key, status='queued', attempts=0,
+                max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+                run_at=datetime.utcnow() + timedelta(seconds=delay), created=datetime.utcnow())
+
+
+def enqueue(name, *args, dedup_key=None, delay=0, max_attempts=None, **kwargs):
+    """Queues task `name` in the current session. Arguments must be JSON serializable.
+
+    A queued job with the same `dedup_key` is replaced rather than duplicated, task and arguments.
+    """
+    if name not in tasks:
+        raise KeyError(f'Unknown task {name}')
+    if not current_app.config['JOB_WORKER']:
+        return tasks[name](*args, **kwargs)
+    values = _queued(name, args, kwargs, dedup_key, delay, max_attempts)
+    if dedup_key is not None:
+        job = Job.query.filter_by(dedup_key=dedup_key, status='queued').first()
+        if job is not None:
+            job.name, job.args, job.run_at = name, values['args'], values['run_at']
+            return
+    db.session.add(Job(**values))
+
+
+def enqueue_from_flush(session, name, *args, dedup_key=None, **kwargs):
+    """Like `enqueue`, for `after_flush` listeners, which may run SQL but not add objects to the session."""
+    if not current_app.config['JOB_WORKER']:
+        session.info.setdefault('jobs_after_commit', []).append((name, args, kwargs))
+        return
+    values = _queued(name, args, kwargs, dedup_key, 0, None)
+    table = Job.__table__
+    if dedup_key is not None:
+        result = session.execute(table.update().where(table.c.dedup_key == dedup_key).where(
+            table.c.status == 'queued').values(name=name, args=values['args'], run_at=values['run_at']))
+        if result.rowcount:
+            return
+    session.execute(table.insert().values(**values))
+
+
+def _run_after_commit(session):
+    for name, args, kwargs in session.info.pop('jobs_after_commit', ()):
+        if has_app_context():
+            try:
+                tasks[name](*args, **kwargs)
+            except Exception:
+                current_app.logger.exception('Job %s failed', name)
+
+
+def _discard(session):
+    session.info.pop('jobs_after_commit', None)
+
+
+event.listen(db.session, 'after_commit', _run_after_commit)
+event.listen(db.session, 'after_rollback', _discard)
+
+
+"""Worker"""
+
+
+def claim(worker):
+    """Marks the next due job as running and returns it, or returns None when there is nothing to do.
+
+    Several workers may race for the same row; the conditional UPDATE lets exactly one of them win. Older queued
+    jobs with the same dedup key are superseded by the claimed one.
+    """
+    table = Job.__table__
+    now = datetime.utcnow()
+    while True:
+        row = db.session.query(Job.id, Job.dedup_key).filter(Job.status == 'queued', Job.run_at <= now).order_by(
+            Job.run_at, Job.id).first()
+        if row is None:
+            db.session.commit()
+            return None
+        id, dedup_key = row
+        if dedup_key is not None:
+            id = db.session.query(db.func.max(Job.id)).filter(Job.dedup_key == dedup_key, Job.status == 'queued',
+                                                              Job.run_at <= now).scalar() or id
+        claimed = db.session.execute(table.update().where(table.c.id == id).where(table.c.status == 'queued').values(
+            status='running', started=now, heartbeat=now, worker=worker, attempts=table.c.attempts + 1)).rowcount
+        if claimed and dedup_key is not None:
+            db.session.execute(table.update().where(table.c.dedup_key == dedup_key).where(
+                table.c.status == 'queued').where(table.c.id < id).values(
+                status='done', finished=now, error=f'Superseded by job {id}'))
+        db.session.commit()
+        if claimed:
+            return Job.query.get(id)
+
+
+def _heartbeat(app, id, stop):
+    """Marks running job `id` alive every `JOB_HEARTBEAT_INTERVAL` seconds until `stop` is set."""
+    table = Job.__table__
+    with app.app_context():
+        try:
+            while not stop.wait(app.config['JOB_HEARTBEAT_INTERVAL']):
+                db.session.execute(table.update().where(table.c.id == id).where(table.c.status == 'running').values(
+                    heartbeat=datetime.utcnow()))
+                db.session.commit()
+        finally:
+            db.session.remove()
+
+
+def run(job):
+    """Runs a claimed job, then records its success, or schedules a retry with exponential backoff."""
+    args, kwargs = json.loads(job.args)
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(current_app._get_current_object(), job.id, stop),
+                            name=f'job-heartbeat-{job.id}', daemon=True)
+    beat.start()
+    try:
+        try:
+            tasks[job.name](*args, **kwargs)
+        finally:
+            stop.set()
+            beat.join()
+    except Exception:
+        db.session.rollback()
+        job = Job.query.get(job.id)
+        job.error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished = datetime.utcnow()
+            current_app.logger.error('Job %d (%s) failed after %d attempts', job.id, job.name, job.attempts)
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=current_app.config['JOB_RETRY_BACKOFF'] * 2 ** (job.attempts - 1))
+    else:
+        job.status = 'done'
+        job.finished = datetime.utcnow()
+        job.error = None
+    db.session.commit()
+
+
+def requeue_stale():
+    """Puts back jobs left running by a worker that died, once their heartbeat is `JOB_TIMEOUT` seconds old.
+
+    Jobs that run longer are left alone, as long as their worker keeps beating.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['JOB_TIMEOUT'])
+    count = Job.query.filter(Job.status == 'running', db.func.coalesce(Job.heartbeat, Job.started) < cutoff).update(
+        {'status': 'queued', 'error': 'Requeued after timeout'}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def purge_done():
+    """Deletes the jobs done more than `JOB_KEEP_DAYS` days ago. Failed jobs are kept for inspection."""
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['JOB_KEEP_DAYS'])
+    count = Job.query.filter(Job.status == 'done', Job.finished < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def work(app, concurrency=1, burst=False, stop=None):
+    """Runs jobs in `concurrency` threads until `stop` is set, or until the queue is empty with `burst`."""
+    stop = stop or threading.Event()
+    name = f'{socket.gethostname()}:{os.getpid()}'
+
+    def loop(i):
+        with app.app_context():
+            try:
+                maintained = time.monotonic()
+                while not stop.is_set():
+                    # The first thread also does the housekeeping, between jobs
+                    if i == 0 and time.monotonic() - maintained > app.config['JOB_MAINTENANCE_INTERVAL']:
+                        requeue_stale()
+                        purge_done()
+                        maintained = time.monotonic()
+                    job = claim(f'{name}:{i}')
+                    if job is not None:
+                        run(job)
+                    elif burst:
+                        return
+                    else:
+                        stop.wait(app.config['JOB_POLL_INTERVAL'])
+            finally:
+                db.session.remove()
+
+    with app.app_context():
+        requeue_stale()
+        purge_done()
+    threads = [threading.Thread(target=loop, args=(i,), name=f'job-worker-{i}') for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def counts():
+    """Number of jobs in each status."""
+    return dict(db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status))
+
+
+"""Tasks"""
+
+
+@task('index_document')
+def _index_document(index, id, body):
+    from app.search import index_document
+    index_document(index, id, body)
+
+
+@task('remove_document')
+def _remove_document(index, id, timestamp=None):
+    from app.search import remove_document
+    remove_document(index, id, timestamp)
+
+
+@task('send_email')
+def _send_email(subject, sender, recipients, text_body, html_body):
+    from app.email import build_message
+    current_app.extensions['mail'].send(build_message(subject, sender, recipients, text_body, html_body))
+
+
+@task('create_tags')
+def _create_tags():
+    from app.main.info import all_tags
+    from app.models import Tag
+    existing = {name for name, in db.session.query(Tag.name)}
+    db.session.add_all([Tag(name=t[0]) for t in all_tags if t[0] not in existing])
+    db.session.commit()
+
+
+@task('build_recommendations')
+def _build_recommendations():
+    from app.recommend import build_recommendations
+    build_recommendations(neighbours=current_app.config['RECOMMEND_NEIGHBOURS'],
+                          top_n=current_app.config['RECOMMENDATIONS_PER_USER'])
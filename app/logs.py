@@ -0,0 +1,195 @@
+"""Logging that stays off the request thread.
+
+`app.logger` only has a `QueueHandler`; formatting, file writes, rotation and error emails happen in a
+`QueueListener` thread. Records are JSON lines carrying the request id (taken from `X-Request-ID` or
+generated), route, latency so far, and the DB and Elasticsearch time spent by the request.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import time
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+
+from flask import g, request, current_app, has_request_context
+from flask.logging import default_handler
+
+
+# Attributes every LogRecord has, so anything else was passed through `extra=`
+_record_attrs = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'template'}
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds request details to records emitted on a request thread, before they are queued."""
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = request_id()
+            record.route = request.endpoint
+            record.method = request.method
+            record.path = request.path
+            if 'request_start' in g:
+                record.latency_ms = round((time.perf_counter() - g.request_start) * 1000, 1)
+            if 'query_record' in g:
+                record.db_ms = round(g.query_record.duration * 1000, 1)
+                record.db_queries = g.query_record.count
+            record.es_ms = round(g.get('es_time', 0.0) * 1000, 1)
+        return True
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Drops records instead of blocking, or growing without bound, when the listener falls behind."""
+    def __init__(self, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Like QueueHandler.prepare, but keeps the traceback separate from the message for the JSON output, and
+        # the unformatted message in `template` for the error email throttling
+        record = logging.makeLogRecord(vars(record))
+        record.template = str(record.msg)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': f'{record.pathname}:{record.lineno}',
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _record_attrs)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    """Emails each distinct error at most once per `interval` seconds, and at most `limit` emails per interval.
+
+    Errors are told apart by where they were logged and their unformatted message. The next email for an
+    error mentions how many repeats were suppressed in between.
+    """
+    def __init__(self, *args, interval=300, limit=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.limit = limit
+        self.last_sent = {}
+        self.suppressed = {}
+        self.window = (float('-inf'), 0)
+
+    def emit(self, record):
+        # Called with the handler lock held
+        key = (record.pathname, record.lineno, getattr(record, 'template', str(record.msg)))
+        now = time.monotonic()
+        window_start, sent = self.window
+        if now - window_start >= self.interval:
+            window_start, sent = now, 0
+        if now - self.last_sent.get(key, float('-inf')) < self.interval or sent >= self.limit:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        self.window = (window_start, sent + 1)
+        self.last_sent[key] = now
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record = logging.makeLogRecord(vars(record))
+            record.msg = f'{record.msg}\n\n({suppressed} similar errors were not emailed)'
+        super().emit(record)
+
+
+def request_id():
+    """Id of the current request, from the `X-Request-ID` header set by a proxy or generated here."""
+    if 'whiskyblog.request_id' not in request.environ:
+        request.environ['whiskyblog.request_id'] = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    return request.environ['whiskyblog.request_id']
+
+
+def _log_request(response):
+    response.headers['X-Request-ID'] = request_id()
+    if current_app.config['LOG_REQUESTS']:
+        current_app.logger.info('%s %s %s', request.method, request.path, response.status_code,
+                                extra={'status': response.status_code})
+    return response
+
+
+def stop_listener(app):
+    """Writes out the queued records and stops the listener thread, if it is running."""
+    listener = app.extensions.get('log_listener')
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+
+def start_listener(app):
+    """Starts the listener thread again, e.g. in a forked worker, which doesn't inherit it."""
+    listener = app.extensions.get('log_listener')
+    if listener is not None:
+        listener._thread = None
+        listener.start()
+
+
+def configure_logging(app):
+    """Adds the request log and, outside debug and testing, the queued log handlers."""
+    app.after_request(_log_request)
+    if app.debug or app.testing:
+        return
+
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Whisky Blog failure',
+            credentials=auth, secure=secure, timeout=10,
+            interval=app.config['LOG_MAIL_INTERVAL'], limit=app.config['LOG_MAIL_LIMIT'])
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+    if app.config['LOG_TO_STDOUT']:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(JSONFormatter())
+        stream_handler.setLevel(logging.INFO)
+        handlers.append(stream_handler)
+    else:
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        file_handler = RotatingFileHandler('logs/WhiskyBlog.logs', maxBytes=app.config['LOG_MAX_BYTES'],
+                                           backupCount=app.config['LOG_BACKUP_COUNT'])
+        file_handler.setFormatter(JSONFormatter())
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+    queue_handler = BoundedQueueHandler(app.config['LOG_QUEUE_SIZE'])
+    queue_handler.addFilter(RequestContextFilter())
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener, app)
+    app.extensions['log_listener'] = listener
+
+    # Flask's default handler writes to stderr on the request thread
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(logging.INFO)
+    app.logger.info('Whisky Blog startup')
@@ -0,0 +1,193 @@
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
+import weakref
+
+from flask import current_app
+
+
+class MailStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.connections = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def add_sent(self, latency):
+        with self.lock:
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    @property
+    def latency_avg(self):
+        return self.latency_total / self.sent if self.sent else 0.0
+
+
+# Pools still alive, flushed by one exit hook without keeping their apps alive
+_pools = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_all():
+    for pool in list(_pools):
+        pool.stop(pool.app.config['MAIL_QUEUE_TIMEOUT'])
+
+
+class _Pool:
+    """Queue, worker threads and SMTP connections of one app in one process."""
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.stats = MailStats()
+        self.threads = []
+        self.lock = threading.Lock()
+        _pools.add(self)
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.app.config['MAIL_WORKERS']):
+                thread = threading.Thread(target=self.run, name=f'mail-worker-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        config = self.app.config
+        connection = None
+        with self.app.app_context():
+            mail = self.app.extensions['mail']
+            while True:
+                try:
+                    item = self.queue.get(timeout=config['MAIL_IDLE_TIMEOUT'])
+                except queue.Empty:
+                    # Don't hold a connection open while there is nothing to send
+                    connection = self._close(connection)
+                    continue
+                batch = [item]
+                while item is not None and len(batch) < config['MAIL_BATCH_SIZE']:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+                for item in batch:
+                    if item is None:
+                        continue
+                    try:
+                        connection = self._send(mail, connection, *item)
+                    except Exception:
+                        # e.g. a message without recipients; the worker must survive it
+                        self.stats.add('failed')
+                        self.app.logger.exception('Could not send email %r', item[0].subject)
+                for _ in batch:
+                    self.queue.task_done()
+                if None in batch:
+                    self._close(connection)
+                    return
+
+    def _send(self, mail, connection, msg, queued):
+        """Sends `msg` over the shared connection, reconnecting and retrying with backoff on SMTP errors."""
+        retries = self.app.config['MAIL_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+                    self.stats.add('connections')
+                connection.send(msg)
+            except (smtplib.SMTPException, OSError):
+                connection = self._close(connection)
+                if attempt == retries:
+                    self.stats.add('failed')
+                    self.app.logger.exception('Giving up on email %r to %s', msg.subject, msg.send_to)
+                    return connection
+                self.stats.add('retried')
+                time.sleep(self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+            else:
+                self.stats.add_sent(time.monotonic() - queued)
+                return connection
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def stop(self, timeout=None):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        try:
+            for _ in threads:
+                self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        for thread in threads:
+            thread.join(timeout)
+
+
+class MailPool:
+    """Sends email from a fixed number of worker threads fed by a bounded queue.
+
+    Each worker keeps one SMTP connection open and sends whatever is queued over it in batches of up to
+    `MAIL_BATCH_SIZE`, closing it after `MAIL_IDLE_TIMEOUT` seconds without mail. When the queue is full,
+    `submit` blocks for up to `MAIL_QUEUE_TIMEOUT` seconds, then gives up. With `MAIL_WORKERS = 0` mail is
+    sent synchronously.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # What is still queued is flushed when the process exits, see `_stop_all`
+        app.extensions['mail_pool'] = _Pool(app)
+
+    @staticmethod
+    def _pool():
+        app = current_app._get_current_object()
+        pool = app.extensions['mail_pool']
+        if pool.pid != os.getpid():
+            # Threads don't survive a fork, so forked workers start their own pool
+            pool = app.extensions['mail_pool'] = _Pool(app)
+        return pool
+
+    def submit(self, msg):
+        """Queues `msg` for sending. Returns False if the queue stayed full for `MAIL_QUEUE_TIMEOUT`."""
+        pool = self._pool()
+        if not current_app.config['MAIL_WORKERS']:
+            pool._close(pool._send(current_app.extensions['mail'], None, msg, time.monotonic()))
+            return True
+        pool.start()
+        try:
+            pool.queue.put((msg, time.monotonic()), timeout=current_app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            pool.stats.add('rejected')
+            current_app.logger.error('Mail queue full, dropping email %r to %s', msg.subject, msg.send_to)
+            return False
+        return True
+
+    def join(self):
+        """Waits until everything queued so far has been sent or given up on."""
+        self._pool().queue.join()
+
+    @property
+    def depth(self):
+        return self._pool().queue.qsize()
+
+    @property
+    def stats(self):
+        return self._pool().stats
@@ -5,7 +5,8 @@ from wtforms import StringField, SubmitField, TextAreaField, SelectField,\
     SelectMultipleField, IntegerField
 from wtforms.validators import DataRequired, ValidationError, Length, NumberRange, optional
 
-from app.models import User, Distillery, Whisky
+from app import catalog
+from app.models import User
 from app.main.info import all_tags, locations
 
 
@@ -44,8 +45,9 @@ class AddDistilleryForm(FlaskForm):
     submit = SubmitField(_l('Add a distillery'))
 
     def validate_name(self, name):
-        distillery = Distillery.query.filter_by(name=name.data.title()).first()
-        if distillery is not None:
+        # A miss cached before another worker added the distillery must not let a duplicate through
+        catalog.sync()
+        if catalog.distillery_id(name.data.title()) is not None:
             raise ValidationError(_('Distillery has already been added'))
 
 
@@ -59,8 +61,8 @@ class AddWhiskyForm(FlaskForm):
         super(AddWhiskyForm, self).__init__(**kwargs)
 
     def validate_name(self, name):
-        whisky = Whisky.query.filter_by(distillery_id=self.distillery.id).filter_by(name=name.data).first()
-        if whisky is not None:
+        catalog.sync()
+        if catalog.whisky_id(self.distillery.id, name.data) is not None:
             raise ValidationError(_('Whisky has already been added'))
 
 
@@ -77,8 +79,8 @@ class EditDistilleryForm(FlaskForm):
 
     def validate_name(self, name):
         if name.data != self.original_name:
-            distillery = Distillery.query.filter_by(name=name.data).first()
-            if distillery is not None:
+            catalog.sync()
+            if catalog.distillery_id(name.data) is not None:
                 raise ValidationError(_('There is already a distillery with that name'))
 
 
@@ -94,8 +96,8 @@ class EditWhiskyForm(FlaskForm):
 
     def validate_name(self, name):
         if name.data != self.original_name:
-            whisky = Whisky.query.filter_by(distillery_id=self.distillery.id).filter_by(name=name.data).first()
-            if whisky is not None:
+            catalog.sync()
+            if catalog.whisky_id(self.distillery.id, name.data) is not None:
                 raise ValidationError(_('There is already a whisky with that name'))
 
 
@@ -116,6 +118,10 @@ class AdvancedSearchForm(FlaskForm):
         NumberRange(min=0, max=100, message=_l('Please give a score from 0 to 100')), optional()])
     score_gt = IntegerField(_l('Score Upper Bound'), validators=[
         NumberRange(min=0, max=100, message=_l('Please give a score from 0 to 100')), optional()])
+    year_from = IntegerField(_l('Reviewed From (Year)'), validators=[
+        NumberRange(min=1900, max=9999, message=_l('Please give a year')), optional()])
+    year_to = IntegerField(_l('Reviewed Until (Year)'), validators=[
+        NumberRange(min=1900, max=9999, message=_l('Please give a year')), optional()])
     add_tags = SelectMultipleField(_l('Tags'), choices=all_tags)
     whisky = StringField(_l('Distillery / Whisky name'), validators=[optional()])
     user = StringField(_l('Author Username'), validators=[optional()])
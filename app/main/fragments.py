@@ -0,0 +1,33 @@
+"""Cached renderers for the `_post.html` review rows and `_distillery.html` cards, available in all templates."""
+
+from flask import render_template, g
+from flask_login import current_user
+
+from app import fragment_cache, catalog
+from app.avatars import avatar_urls
+from app.main import bp
+
+
+@bp.app_template_global()
+def review_avatars(reviews, size=70):
+    """Avatar URLs of the authors of a list of reviews, keyed by user id, for `render_review`."""
+    return avatar_urls({review.author for review in reviews if review.author}, size)
+
+
+@bp.app_template_global()
+def render_review(review, show_whisky=False, avatars=None):
+    is_owner = current_user.is_authenticated and review.user_id == current_user.id
+    if avatars is None:
+        avatars = review_avatars([review])
+    avatar = avatars.get(review.user_id)
+    # The avatar is part of the key, so a changed email isn't hidden behind a cached row
+    key = f'review:{review.id}:{review.version}:{int(show_whisky)}:{int(is_owner)}:{g.locale}:{avatar}'
+    return fragment_cache.render(key, lambda: render_template('_post.html', review=review, show_whisky=show_whisky,
+                                                              avatar=avatar))
+
+
+@bp.app_template_global()
+def render_distillery(distillery, in_list=False):
+    key = f'distillery:{distillery.id}:{distillery.version}:{int(in_list)}:{g.locale}'
+    return fragment_cache.render(key, lambda: render_template(
+        '_distillery.html', distillery=distillery, whiskies=catalog.whiskies_of(distillery.id), all_distillery=in_list))
@@ -1,14 +1,22 @@
-from flask import render_template, flash, redirect, url_for, request, abort, g, current_app, session, jsonify
+import os
+import re
+import time
+
+from flask import render_template, flash, redirect, url_for, request, abort, g, current_app, session, jsonify, \
+    send_file
 from flask_login import current_user, login_required
 from flask_babel import get_locale, _
 
-from app import db
-from app.models import User, Review, Whisky, Distillery, Tag
+from app import db, catalog, search_log
+from app.models import User, Review, Whisky, Distillery, Tag, Stamp, whiskies_listed
+from app.avatars import identicon_path, AVATAR_SIZES
+from app.conditional import conditional
 from app.main import bp
 from app.main.forms import EditProfileForm, ReviewForm, AddWhiskyForm, AddDistilleryForm, EditWhiskyForm, \
     EditDistilleryForm, SearchForm, AdvancedSearchForm
 from app.main.info import all_tags
-from app.search import query_advanced, query_index
+from app.usercache import session_user
+from app.search import search_page, normalize_query, normalize_advanced, advanced_args, search_request
 
 
 @bp.before_app_request
@@ -24,6 +32,28 @@ def inject_conf_var():
                                              request.accept_languages.best_match(current_app.config['LANGUAGES'])))
 
 
+"""Validators for conditional GET, built from the `review` and `catalog` stamps"""
+
+
+def stamps_validator(*names):
+    def validator(**kwargs):
+        stamps = Stamp.get_many(*names)
+        if 'catalog' in stamps:
+            catalog.sync(stamps['catalog'][0])
+        updated = [u for _, u in stamps.values() if u is not None]
+        return stamps, max(updated) if len(updated) == len(names) else None
+    return validator
+
+
+def whisky_validator(id):
+    stamps, last_modified = stamps_validator('review', 'catalog')()
+    if current_user.is_authenticated:
+        # "Liked!" state has no timestamp, so only the ETag can carry it
+        return (stamps, db.session.query(whiskies_listed).filter(
+            whiskies_listed.c.user_id == current_user.id, whiskies_listed.c.whisky_id == id).count()), None
+    return stamps, last_modified
+
+
 @bp.route('/')
 @bp.route('/home')
 def home():
@@ -31,9 +61,11 @@ def home():
 
 
 @bp.route('/explore')
+@conditional(stamps_validator('review', 'catalog'))
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Review.query.order_by(Review.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    posts = Review.query.options(db.joinedload(Review.author), db.joinedload(Review.whisky).joinedload(
+        Whisky.distillery)).order_by(Review.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
     next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
     prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
     return render_template('explore.html', title='Explore', reviews=posts.items, next_url=next_url, prev_url=prev_url)
@@ -53,7 +85,24 @@ def set_language(language=None):
 def user(username):
     usr = User.query.filter_by(username=username).first_or_404()
     all_whisky = usr.get_whiskies_listed()
-    return render_template('user.html', user=usr, all_whisky=all_whisky)
+    recommended = usr.get_recommendations(current_app.config['RECOMMENDATIONS_PER_USER']) \
+        if usr == current_user else []
+    return render_template('user.html', user=usr, all_whisky=all_whisky, recommended=recommended)
+
+
+# Locally drawn identicons, used instead of Gravatar when `AVATAR_CACHE_DIR` is set
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    directory = current_app.config['AVATAR_CACHE_DIR']
+    if not directory or not re.fullmatch('[0-9a-f]{32}', digest) or size not in AVATAR_SIZES:
+        abort(404)
+    # Only draw identicons of registered users, so the directory can't be filled with arbitrary digests
+    if User.query.filter_by(avatar_hash=digest).first() is None:
+        abort(404)
+    response = send_file(identicon_path(os.path.abspath(directory), digest, size), mimetype='image/png')
+    # The image only depends on the URL
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -61,11 +110,12 @@ def user(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
-        current_user.username = form.username.data
-        current_user.about_me = form.about_me.data
+        usr = session_user()
+        usr.username = form.username.data
+        usr.about_me = form.about_me.data
         db.session.commit()
         flash('Your profile has been updated!')
-        return redirect(url_for('main.user', username=current_user.username))
+        return redirect(url_for('main.user', username=usr.username))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -76,10 +126,12 @@ def edit_profile():
 
 
 @bp.route('/whisky/<id>')
+@conditional(whisky_validator)
 def whisky(id):
-    wsk = Whisky.query.filter_by(id=id).first_or_404()
+    wsk = catalog.whisky_or_404(id)
     page = request.args.get('page', 1, type=int)
-    reviews = Review.query.filter_by(whisky_id=wsk.id).order_by(Review.timestamp.desc()).paginate(
+    reviews = Review.query.options(db.joinedload(Review.author)).filter_by(whisky_id=wsk.id).order_by(
+        Review.timestamp.desc()).paginate(
         page, current_app.config['POSTS_PER_PAGE'], False)
     next_url = url_for('main.whisky', id=id, page=reviews.next_num) if reviews.has_next else None
     prev_url = url_for('main.whisky', id=id, page=reviews.prev_num) if reviews.has_prev else None
@@ -107,7 +159,7 @@ def edit_whisky(id):
 @bp.route('/whisky/<id>/submit', methods=['GET', 'POST'])
 @login_required
 def submit_review(id):
-    wsk = Whisky.query.filter_by(id=id).first_or_404()
+    wsk = catalog.whisky_or_404(id)
     form = ReviewForm()
     t = [[x[0] for x in all_tags[i*4:(i*4)+4]] for i in range(len(all_tags) // 4 + 1)]
     if form.validate_on_submit():
@@ -115,11 +167,7 @@ def submit_review(id):
         for tag in list(form.add_tags.data):
             tags.append(Tag.query.filter_by(name=tag).first())
         review = Review(nose=form.nose.data, palate=form.palate.data, finish=form.finish.data,
-                        score=form.score.data, author=current_user, whisky=wsk, tags=tags)
-        review.distillery_ = wsk.distillery.name
-        review.whisky_ = wsk.name
-        review.user_ = current_user.username
-        review.tags_ = list(form.add_tags.data)
+                        score=form.score.data, author=session_user(), whisky=wsk, tags=tags)
         db.session.add(review)
         db.session.commit()
         flash('Your review has been submitted')
@@ -131,7 +179,7 @@ def submit_review(id):
 @login_required
 def edit_review(rev_id):
     rev = Review.query.filter_by(id=rev_id).first_or_404()
-    wsk = Whisky.query.filter_by(id=rev.whisky_id).first()
+    wsk = catalog.whisky(rev.whisky_id)
     if rev.author.id is not current_user.id:
         abort(403)
     form = ReviewForm()
@@ -141,10 +189,6 @@ def edit_review(rev_id):
         rev.palate = form.palate.data
         rev.finish = form.finish.data
         rev.score = form.score.data
-        rev.distillery_ = wsk.distillery.name
-        rev.whisky_ = wsk.name
-        rev.user_ = current_user.username
-        rev.tags_ = list(form.add_tags.data)
         for tag in list(form.add_tags.data):
             rev.add_tag(Tag.query.filter_by(name=tag).first())
         db.session.commit()
@@ -172,32 +216,53 @@ def delete_post(post_id):
 
 
 @bp.route('/whisky_list')
+@conditional(stamps_validator('catalog'))
 def whisky_list():
-    all_distillery = list(Distillery.query.order_by(Distillery.name.asc()).all())
+    all_distillery = catalog.distilleries()
     return render_template('whisky_list.html', title='All distilleries', all_distillery=all_distillery)
 
 
+def review_count_message(num):
+    if num == 1:
+        return _('There is 1 review.')
+    elif num == 0:
+        return _('There are no reviews.')
+    return _('There are %(num)s reviews.', num=str(num))
+
+
 @bp.route('/whisky/<id>/popup')
 @login_required
 def whisky_popup(id):
-    wsk = Whisky.query.filter_by(id=id).first_or_404()
-    if wsk.number_reviews() == 1:
-        msg = _('There is 1 review.')
-    elif wsk.number_reviews() == 0:
-        msg = _('There are no reviews.')
-    else:
-        msg = _('There are %(num)s reviews.', num=str(wsk.number_reviews()))
-    return jsonify(message=msg)
+    wsk = catalog.whisky_or_404(id)
+    return jsonify(message=review_count_message(wsk.number_reviews()))
+
+
+# Popup messages for every whisky on a page, e.g. `/whisky_popups?ids=1,2,3`, counted in one grouped query
+@bp.route('/whisky_popups')
+@login_required
+def whisky_popups():
+    try:
+        ids = {int(i) for i in request.args.get('ids', '').split(',') if i}
+    except ValueError:
+        abort(400)
+    if len(ids) > current_app.config['POPUP_BATCH_LIMIT']:
+        abort(400)
+    counts = dict.fromkeys(ids, 0)
+    if ids:
+        counts.update(db.session.query(Review.whisky_id, db.func.count(Review.id)).filter(
+            Review.whisky_id.in_(ids)).group_by(Review.whisky_id))
+    return jsonify(messages={str(i): review_count_message(n) for i, n in counts.items()})
 
 
 @bp.route('/whisky/<id>/tried')
 @login_required
 def whisky_tried(id):
-    wsk = Whisky.query.filter_by(id=id).first_or_404()
-    if not current_user.has_whisky(wsk):
-        current_user.add_whisky(wsk)
+    wsk = catalog.whisky_or_404(id)
+    usr = session_user()
+    if not usr.has_whisky(wsk):
+        usr.add_whisky(wsk)
     else:
-        current_user.remove_whisky(wsk)
+        usr.remove_whisky(wsk)
     db.session.commit()
     return redirect(url_for('main.whisky', id=wsk.id))
 
@@ -206,14 +271,15 @@ def whisky_tried(id):
 
 
 @bp.route('/distillery/<id>')
+@conditional(stamps_validator('catalog'))
 def distillery(id):
-    dist = Distillery.query.filter_by(id=id).first_or_404()
+    dist = catalog.distillery_or_404(id)
     return render_template('distillery.html', title=dist.name, distillery=dist)
 
 
 @bp.route('/distillery/<id>/add_whisky', methods=['GET', 'POST'])
 def add_whisky(id):
-    dist = Distillery.query.filter_by(id=id).first_or_404()
+    dist = catalog.distillery_or_404(id)
     form = AddWhiskyForm(distillery=dist)
     if form.validate_on_submit():
         if form.about.data:
@@ -267,40 +333,23 @@ def edit_distillery(id):
 @bp.route('/search')
 def search():
     query_args = {}  # Query search arguments
+    page = request.args.get('page', 1, type=int)
+    sort = request.args.get('sort', 'rel')
 
     if g.search_form.validate():  # Simple search
-        page = request.args.get('page', 1, type=int)
-        sort = request.args.get('sort', 'rel')
         query_args['q'] = g.search_form.q.data
-
-        query = query_args['q'].split()
-        tags_queried, excluded_queries, normal_queries = [], [], []
-        for word in query:
-            if word[0] == '@':
-                tags_queried.append(word[1:].title())
-            elif word[0] == '-':
-                excluded_queries.append(word[1:])
-            else:
-                normal_queries.append(word)
-        excluded_queries, normal_queries = ' '.join(excluded_queries), ' '.join(normal_queries)
-        posts, num_revs = Review.search(
-            func=query_index, query=normal_queries, excluded=excluded_queries, tags=tags_queried,
-            offset=page, size=current_app.config['POSTS_PER_PAGE'], sort=sort)
-
+        kind, normalized = 'simple', normalize_query(query_args['q'])
     else:  # Advanced Search
-        page = request.args.get('page', 1, type=int)
-        sort = request.args.get('sort', 'rel')
-        query_args.update({
-            'review': request.args.get('review'),
-            'tags': request.args.getlist('tags'),
-            'whisky': request.args.get('whisky'),
-            'score_lower': request.args.get('score_lower', type=int),
-            'score_greater': request.args.get('score_greater', type=int),
-            'user': request.args.get('user')
-        })
-
-        posts, num_revs = Review.search(
-            func=query_advanced, **query_args, offset=page, size=current_app.config['POSTS_PER_PAGE'], sort=sort)
+        query_args.update(advanced_args(request.args))
+        kind, normalized = 'advanced', normalize_advanced(query_args)
+    query, text = search_request(kind, normalized)
+
+    # Hits, tag counts and spelling corrections are fetched at the same time
+    start = time.perf_counter()
+    results = search_page(Review.__tablename__, query, page, current_app.config['POSTS_PER_PAGE'], sort, text)
+    # Logged as searched, so `flask search warm` replays the query whose results are cached
+    search_log.record(kind, normalized, (time.perf_counter() - start) * 1000, results)
+    posts, num_revs = Review.from_ids(results.ids).all(), results.total
 
     # Sorting links
     rel_url = url_for('main.search', **query_args, sort='rel') if sort != 'rel' else None
@@ -312,8 +361,23 @@ def search():
                        page=page + 1, sort=sort) if num_revs > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', **query_args, page=page - 1, sort=sort) if page > 1 else None
 
+    # Facet links narrow the search down to a tag, the correction link searches again with the words fixed
+    facets = []
+    for tag, count in results.facets:
+        if 'q' in query_args:
+            facet_args = dict(query_args, q=f"{query_args['q']} @{tag.replace(' ', '_')}")
+        else:
+            facet_args = dict(query_args, tags=query_args['tags'] + [tag])
+        facets.append((tag, count, url_for('main.search', **facet_args, sort=sort)))
+    corrected = None
+    if results.corrections:
+        field = 'q' if 'q' in query_args else 'review'
+        corrected = ' '.join(results.corrections.get(word.lower(), word) for word in query_args[field].split())
+        corrected = (corrected, url_for('main.search', **dict(query_args, **{field: corrected}), sort=sort))
+
     return render_template('search/search.html', title='Search', reviews=posts, next_url=next_url, prev_url=prev_url,
-                           rel_url=rel_url, old_url=old_url, new_url=new_url)
+                           rel_url=rel_url, old_url=old_url, new_url=new_url, total=num_revs, facets=facets,
+                           corrected=corrected, missing=results.missing)
 
 
 @bp.route('/adv_search', methods=['GET', 'POST'])
@@ -323,5 +387,6 @@ def adv_search():
     if form.validate_on_submit():
         return redirect(url_for('main.search', review=form.review.data, tags=form.add_tags.data,
                                 whisky=form.whisky.data,
-                                score_lower=form.score_lt.data, score_greater=form.score_gt.data, user=form.user.data))
+                                score_lower=form.score_lt.data, score_greater=form.score_gt.data, user=form.user.data,
+                                year_from=form.year_from.data, year_to=form.year_to.data))
     return render_template('search/adv_search.html', title='Advanced Search', form=form, all_tags=t)
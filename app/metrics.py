@@ -0,0 +1,244 @@
+"""Prometheus metrics at `/metrics`, in the text exposition format, without a client library.
+
+Each process keeps its own counters and histograms. With `METRICS_DIR` set, as under gunicorn, every process
+writes a snapshot of them to `<METRICS_DIR>/<pid>.json` at most every `METRICS_FLUSH_INTERVAL` seconds and when
+it exits, and `/metrics` adds up the snapshots of all processes. Counters of processes that are gone still
+count, their gauges don't. The directory should be emptied when the server starts.
+"""
+
+import atexit
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import request, g, current_app, Response, abort, has_app_context
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+definitions = {
+    'whisky_http_request_duration_seconds': ('histogram', 'Time to answer a request, by endpoint.'),
+    'whisky_http_requests_total': ('counter', 'Requests answered, by endpoint, method and status.'),
+    'whisky_db_queries_total': ('counter', 'SQL statements issued by requests, by endpoint.'),
+    'whisky_db_query_seconds_total': ('counter', 'Time requests spent in SQL statements, by endpoint.'),
+    'whisky_elasticsearch_request_duration_seconds': ('histogram', 'Time Elasticsearch requests took, by operation.'),
+    'whisky_elasticsearch_errors_total': ('counter', 'Elasticsearch requests that failed, by error.'),
+    'whisky_mail_queue_depth': ('gauge', 'Emails waiting in the mail pool queue.'),
+    'whisky_mail_sent_total': ('counter', 'Emails sent by the mail pool.'),
+    'whisky_mail_failed_total': ('counter', 'Emails the mail pool gave up on.'),
+    'whisky_cache_hits_total': ('counter', 'Cache hits, by cache.'),
+    'whisky_cache_misses_total': ('counter', 'Cache misses, by cache.'),
+    'whisky_ratelimit_rejected_total': ('counter', 'Requests turned away with 429, by reason.'),
+    'whisky_jobs': ('gauge', 'Background jobs, by status.'),
+}
+
+
+class Registry:
+    """Metric values of one process, keyed by (name, labels) with labels a sorted tuple of (key, value)."""
+    def __init__(self):
+        self.pid = os.getpid()
+        self.values = {}
+        self.lock = threading.Lock()
+        self.flushed = 0.0
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            # Per-bucket counts with one more for +Inf, then the sum
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, list(labels), list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self.values.items()]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots):
+    """Adds up [(pid, samples)] into {(name, labels): value}, leaving out gauges of dead processes."""
+    totals = {}
+    for pid, samples in snapshots:
+        alive = None
+        for name, labels, value in samples:
+            if definitions[name][0] == 'gauge':
+                alive = _alive(pid) if alive is None else alive
+                if not alive:
+                    continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if isinstance(value, list):
+                previous = totals.get(key) or [0] * len(value)
+                totals[key] = [a + b for a, b in zip(previous, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}' if pairs else ''
+
+
+def render(totals):
+    lines = []
+    for name in sorted({name for name, _ in totals}):
+        kind, help = definitions[name]
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        for (_, labels), value in sorted((k, v) for k, v in totals.items() if k[0] == name):
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+            else:
+                lines.append(f'{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def observe_elasticsearch(operation, seconds, error=None):
+    """Called by the Elasticsearch transport for every request."""
+    if not has_app_context() or 'metrics' not in current_app.extensions:
+        return
+    registry = Metrics.registry()
+    registry.observe('whisky_elasticsearch_request_duration_seconds', seconds, (('operation', operation),))
+    if error is not None:
+        registry.inc('whisky_elasticsearch_errors_total', (('error', error),))
+
+
+class Metrics:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['metrics'] = Registry()
+        if not app.config['METRICS_ENABLED']:
+            return
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start)
+        app.after_request(self._finish)
+        app.add_url_rule('/metrics', 'metrics', self._view)
+        if app.config['METRICS_DIR']:
+            atexit.register(self._flush_at_exit, app)
+
+    @staticmethod
+    def registry():
+        app = current_app._get_current_object()
+        registry = app.extensions['metrics']
+        if registry.pid != os.getpid():
+            # Values before a fork belong to the parent's snapshot
+            registry = app.extensions['metrics'] = Registry()
+        return registry
+
+    @staticmethod
+    def _start():
+        request.environ['whiskyblog.metrics_start'] = time.perf_counter()
+
+    def _finish(self, response):
+        start = request.environ.get('whiskyblog.metrics_start')
+        if start is None:
+            return response
+        registry = self.registry()
+        endpoint = request.endpoint or 'unmatched'
+        registry.observe('whisky_http_request_duration_seconds', time.perf_counter() - start,
+                         (('endpoint', endpoint),))
+        registry.inc('whisky_http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                                   ('status', str(response.status_code))))
+        record = g.get('query_record')
+        if record is not None and record.count:
+            registry.inc('whisky_db_queries_total', (('endpoint', endpoint),), record.count)
+            registry.inc('whisky_db_query_seconds_total', (('endpoint', endpoint),), record.duration)
+        directory = current_app.config['METRICS_DIR']
+        if directory and time.monotonic() - registry.flushed > current_app.config['METRICS_FLUSH_INTERVAL']:
+            self._flush(registry, directory)
+        return response
+
+    @staticmethod
+    def _collect(registry):
+        """Copies the running totals other extensions keep into the registry."""
+        extensions = current_app.extensions
+        stats = extensions['mail_pool'].stats
+        registry.set('whisky_mail_queue_depth', extensions['mail_pool'].queue.qsize())
+        registry.set('whisky_mail_sent_total', stats.sent)
+        registry.set('whisky_mail_failed_total', stats.failed)
+        from app import fragment_cache, page_cache, user_cache, search_cache
+        for name, cache in (('fragment', fragment_cache), ('page', page_cache), ('user', user_cache),
+                            ('search', search_cache)):
+            registry.set('whisky_cache_hits_total', cache.stats.hits, (('cache', name),))
+            registry.set('whisky_cache_misses_total', cache.stats.misses, (('cache', name),))
+        ratelimit = extensions['ratelimit']
+        registry.set('whisky_ratelimit_rejected_total', ratelimit['limited'], (('reason', 'rate'),))
+        registry.set('whisky_ratelimit_rejected_total', ratelimit['shed'], (('reason', 'concurrency'),))
+
+    def _flush(self, registry, directory):
+        self._collect(registry)
+        registry.flushed = time.monotonic()
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(path, os.path.join(directory, f'{registry.pid}.json'))
+
+    def _flush_at_exit(self, app):
+        with app.app_context():
+            registry = app.extensions['metrics']
+            if registry.pid == os.getpid():
+                self._flush(registry, app.config['METRICS_DIR'])
+
+    def _view(self):
+        token = current_app.config['METRICS_TOKEN']
+        if not token:
+            # Without a token, only development servers answer scrapes
+            if not (current_app.debug or current_app.testing):
+                abort(404)
+        elif request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+        registry = self.registry()
+        directory = current_app.config['METRICS_DIR']
+        if directory:
+            self._flush(registry, directory)
+            snapshots = []
+            for path in glob.glob(os.path.join(directory, '*.json')):
+                try:
+                    with open(path) as f:
+                        snapshots.append((int(os.path.basename(path)[:-len('.json')]), json.load(f)))
+                except (OSError, ValueError):
+                    # Removed, or written by something else
+                    continue
+        else:
+            self._collect(registry)
+            snapshots = [(registry.pid, registry.snapshot())]
+        totals = merge(snapshots)
+        from app.jobs import counts
+        for status, n in counts().items():
+            totals[('whisky_jobs', (('status', status),))] = n
+        return Response(render(totals), mimetype='text/plain; version=0.0.4')
@@ -1,14 +1,13 @@
 from datetime import datetime
-from hashlib import md5
 from time import time
 
-import jwt
 from flask import current_app
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from flask_login import UserMixin
 
-from app import db, login
-from app.search import add_doc_to_index, remove_doc_from_index
+from app import db, login, catalog, user_cache
+from app.search import add_doc_to_index, index_body
+from app.avatars import email_hash, avatar_url
 
 
 tags = db.Table('tags',
@@ -25,33 +24,37 @@ class SearchableMixin:
     @classmethod
     def search(cls, func, **kwargs):
         ids, total = func(cls.__tablename__, **kwargs)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+        return cls.from_ids(ids), total
+
+    """Query object of the rows with `ids`, in the order of `ids`"""
+    @classmethod
+    def from_ids(cls, ids):
+        if not ids:
+            # Nothing matched, or the page is past the last hit
+            return cls.query.filter_by(id=0)
         # append to when in the order that is returned by elasticsearch
         when = []
         for i, v in enumerate(ids):
             when.append((v, i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id))
 
-    """Saves all changes to be committed in _changes in the db session before actually committing."""
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': [obj for obj in session.new if isinstance(obj, cls)],
-            'update': [obj for obj in session.dirty if isinstance(obj, cls)],
-            'delete': [obj for obj in session.deleted if isinstance(obj, cls)]
-        }
-
-    """Updates the elasticsearch index with all changes that were committed."""
+    """Queues elasticsearch updates for the flushed changes, as jobs committed with the same transaction."""
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            add_doc_to_index(cls.__tablename__, obj)
-        for obj in session._changes['update']:
-            add_doc_to_index(cls.__tablename__, obj)
-        for obj in session._changes['delete']:
-            remove_doc_from_index(cls.__tablename__, obj)
-        session._changes = None
+    def after_flush(cls, session, flush_context):
+        from app.jobs import enqueue_from_flush
+        if not current_app.elasticsearch:
+            return
+        index = cls.__tablename__
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, cls):
+                enqueue_from_flush(session, 'index_document', index, obj.id, index_body(obj),
+                                   dedup_key=f'index:{index}:{obj.id}')
+        for obj in session.deleted:
+            if isinstance(obj, cls):
+                # The timestamp tells the partition the document is in
+                enqueue_from_flush(session, 'remove_document', index, obj.id,
+                                   obj.timestamp.isoformat() if obj.timestamp else None,
+                                   dedup_key=f'index:{index}:{obj.id}')
 
     """Refreshes an index with objects from the database"""
     # Not possible to use for Review class currently
@@ -61,10 +64,19 @@ class SearchableMixin:
             add_doc_to_index(cls.__tablename__, obj)
 
 
+def password_hash_method():
+    """`PASSWORD_HASH_METHOD` as werkzeug writes it into hashes, i.e. with the pbkdf2 iterations spelled out."""
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        method = f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    avatar_hash = db.Column(db.String(32), index=True)
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     reviews = db.relationship('Review', backref='author', lazy='dynamic')
@@ -75,16 +87,26 @@ class User(UserMixin, db.Model):
         return f'<{type(self).__name__}(id={self.id}, username={self.username})>'
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=password_hash_method(),
+                                                    salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def password_needs_rehash(self):
+        """Whether the stored hash was made with other settings than `PASSWORD_HASH_METHOD`."""
+        return self.password_hash.split('$', 1)[0] != password_hash_method()
+
+    @db.validates('email')
+    def update_avatar_hash(self, key, email):
+        self.avatar_hash = email_hash(email) if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return avatar_url(self.avatar_hash or email_hash(self.email), size)
 
     def get_reset_password_token(self, expires_in=600):
+        import jwt
         return jwt.encode({'reset_password': self.id, 'exp': time() + expires_in},
                           current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
 
@@ -103,10 +125,20 @@ class User(UserMixin, db.Model):
             self.whiskies_listed.remove(wsk)
 
     def has_whisky(self, wsk):
-        return self.whiskies_listed.filter(Whisky.id == wsk.id).count() > 0
+        # Queries the association table, so it works on the detached copy `load_user` may return
+        return db.session.query(whiskies_listed).filter(
+            whiskies_listed.c.user_id == self.id, whiskies_listed.c.whisky_id == wsk.id).count() > 0
+
+    def get_recommendations(self, limit=10):
+        # Whiskies listed since the last `flask recommend build` are filtered out here
+        listed = db.session.query(whiskies_listed.c.whisky_id).filter(whiskies_listed.c.user_id == self.id)
+        return Whisky.query.join(Recommendation, Recommendation.whisky_id == Whisky.id).filter(
+            Recommendation.user_id == self.id, ~Whisky.id.in_(listed)).order_by(
+            Recommendation.score.desc()).limit(limit).all()
 
     @staticmethod
     def verify_reset_password_token(token):
+        import jwt
         try:
             id = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])['reset_password']
         except:
@@ -116,7 +148,7 @@ class User(UserMixin, db.Model):
 
 @login.user_loader
 def load_user(id_num):
-    return User.query.get(int(id_num))
+    return user_cache.get(int(id_num))
 
 
 class Review(SearchableMixin, db.Model):
@@ -132,6 +164,8 @@ class Review(SearchableMixin, db.Model):
     whisky_id = db.Column(db.Integer, db.ForeignKey('whisky.id'))
     tags = db.relationship('Tag', secondary=tags, lazy='dynamic',
                            backref=db.backref('reviews', lazy='dynamic'))
+    # `version` is bumped on every change to the row or to what its rendered fragment shows (see `bump_versions`)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __repr__(self):
         return f'<{type(self).__name__}(id={self.id})>'
@@ -150,9 +184,25 @@ class Review(SearchableMixin, db.Model):
     def is_tagged(self, tag):
         return self.tags.filter(Tag.id == tag.id).count() > 0
 
+    """Fields of the search index copied from the related rows"""
+    @property
+    def distillery_(self):
+        return self.whisky.distillery.name if self.whisky is not None else None
+
+    @property
+    def whisky_(self):
+        return self.whisky.name if self.whisky is not None else None
+
+    @property
+    def user_(self):
+        return self.author.username if self.author is not None else None
+
+    @property
+    def tags_(self):
+        return [tag.name for tag in self.tags]
+
 
-db.event.listen(db.session, 'before_commit', Review.before_commit)
-db.event.listen(db.session, 'after_commit', Review.after_commit)
+db.event.listen(db.session, 'after_flush', Review.after_flush)
 
 
 class Whisky(db.Model):
@@ -161,9 +211,11 @@ class Whisky(db.Model):
     about = db.Column(db.String(255))
     distillery_id = db.Column(db.Integer, db.ForeignKey('distillery.id'))
     reviews = db.relationship('Review', backref='whisky', lazy='dynamic')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __repr__(self):
-        return f'<{type(self).__name__}(id={self.id}, distillery={self.distillery.name}, name={self.name})>'
+        distillery = catalog.distillery_name(self.distillery_id) or self.distillery.name
+        return f'<{type(self).__name__}(id={self.id}, distillery={distillery}, name={self.name})>'
 
     def number_reviews(self):
         return self.reviews.count() if not None else 0
@@ -179,6 +231,7 @@ class Distillery(db.Model):
     owner = db.Column(db.String(64))
     founded = db.Column(db.Integer)
     whiskys = db.relationship('Whisky', backref='distillery', lazy='dynamic')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __repr__(self):
         return f'<{type(self).__name__}(id={self.id}, name={self.name})>'
@@ -187,6 +240,16 @@ class Distillery(db.Model):
         return self.whiskys.count() if not None else 0
 
 
+class Recommendation(db.Model):
+    # Top-N "you might like" whiskies per user, rebuilt offline by `flask recommend build`
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    whisky_id = db.Column(db.Integer, db.ForeignKey('whisky.id'), primary_key=True)
+    score = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(user_id={self.user_id}, whisky_id={self.whisky_id}, score={self.score})>'
+
+
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
@@ -196,3 +259,132 @@ class Tag(db.Model):
 
     def get_reviews(self):
         return self.reviews.all()
+
+
+class Stamp(db.Model):
+    # Version stamp of a whole group of tables (`review`, `catalog`), touched on every flush that changes it
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(name={self.name}, version={self.version})>'
+
+    @classmethod
+    def touch(cls, session, name):
+        now = datetime.utcnow()
+        result = session.execute(cls.__table__.update().where(cls.name == name).values(
+            version=cls.version + 1, updated=now))
+        if result.rowcount == 0:
+            session.execute(cls.__table__.insert().values(name=name, version=1, updated=now))
+        # Lets after_commit listeners (e.g. the catalog cache) react to the stamps this transaction moved
+        session.info.setdefault('touched_stamps', set()).add(name)
+
+    @classmethod
+    def get_many(cls, *names):
+        """Returns {name: (version, updated)}, with (0, None) for stamps that were never touched."""
+        rows = db.session.query(cls.name, cls.version, cls.updated).filter(cls.name.in_(names))
+        stamps = {name: (0, None) for name in names}
+        stamps.update((name, (version, updated)) for name, version, updated in rows)
+        return stamps
+
+
+class Job(db.Model):
+    """A task for `flask worker`, see app/jobs.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    args = db.Column(db.Text, nullable=False, default='[]')
+    # Queued jobs with the same key are coalesced, the newest one wins
+    dedup_key = db.Column(db.String(128), index=True)
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    started = db.Column(db.DateTime)
+    heartbeat = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    worker = db.Column(db.String(64))
+    error = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(id={self.id}, name={self.name}, status={self.status})>'
+
+
+class SearchQuery(db.Model):
+    """Searches for one normalized query on one day, written in batches by app/searchlog.py."""
+    __table_args__ = (db.UniqueConstraint('day', 'kind', 'query'),)
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)
+    # `simple` with the query as typed in the search box, or `advanced` with the form's arguments URL-encoded
+    kind = db.Column(db.String(8), nullable=False)
+    query = db.Column(db.String(200), nullable=False)
+    searches = db.Column(db.Integer, nullable=False, default=0)
+    # Searches that went to Elasticsearch rather than the result cache, and how long they took
+    timed = db.Column(db.Integer, nullable=False, default=0)
+    total_ms = db.Column(db.Float, nullable=False, default=0.0)
+    max_ms = db.Column(db.Float, nullable=False, default=0.0)
+    zero_results = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(day={self.day}, kind={self.kind}, query={self.query})>'
+
+
+def _bump(obj):
+    obj.version = (obj.version or 0) + 1
+
+
+def _columns_changed(obj, *keys):
+    attrs = db.inspect(obj).attrs
+    return any(attrs[key].history.has_changes() for key in keys)
+
+
+def bump_versions(session, flush_context, instances):
+    """Bumps the `version` stamp of every row whose rendered fragment is affected by this flush.
+
+    Review rows show their author, whisky, distillery and tag names and distillery cards list their whiskies,
+    so changes to those rows are propagated with bulk updates. The `review` and `catalog` stamps are
+    touched whenever any review or any whisky/distillery changes.
+    """
+    whisky_ids, distillery_ids, user_ids, tag_ids = set(), set(), set(), set()
+    touched = set()
+    for obj in session.dirty:
+        if isinstance(obj, (Review, Whisky, Distillery)) and session.is_modified(obj):
+            _bump(obj)
+            touched.add('review' if isinstance(obj, Review) else 'catalog')
+        if isinstance(obj, Whisky) and _columns_changed(obj, 'name', 'distillery_id'):
+            whisky_ids.add(obj.id)
+            if obj.distillery is not None and obj.distillery not in session.new:
+                _bump(obj.distillery)
+        elif isinstance(obj, Distillery) and _columns_changed(obj, 'name'):
+            distillery_ids.add(obj.id)
+        elif isinstance(obj, User) and _columns_changed(obj, 'username', 'email'):
+            user_ids.add(obj.id)
+        elif isinstance(obj, Tag) and _columns_changed(obj, 'name'):
+            tag_ids.add(obj.id)
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Review):
+            touched.add('review')
+        elif isinstance(obj, (Whisky, Distillery)):
+            touched.add('catalog')
+        if isinstance(obj, Whisky) and obj.distillery is not None and obj.distillery not in session.new:
+            _bump(obj.distillery)
+
+    bump = {Review.version: Review.version + 1}
+    if whisky_ids:
+        Review.query.filter(Review.whisky_id.in_(whisky_ids)).update(bump, synchronize_session=False)
+    if distillery_ids:
+        whiskies = db.session.query(Whisky.id).filter(Whisky.distillery_id.in_(distillery_ids))
+        Review.query.filter(Review.whisky_id.in_(whiskies.subquery())).update(bump, synchronize_session=False)
+    if user_ids:
+        Review.query.filter(Review.user_id.in_(user_ids)).update(bump, synchronize_session=False)
+        touched.add('review')
+    if tag_ids:
+        reviews = db.session.query(tags.c.review_id).filter(tags.c.tag_id.in_(tag_ids))
+        Review.query.filter(Review.id.in_(reviews.subquery())).update(bump, synchronize_session=False)
+        touched.add('review')
+    for name in sorted(touched):
+        Stamp.touch(session, name)
+
+
+db.event.listen(db.session, 'before_flush', bump_versions)
@@ -0,0 +1,121 @@
+from flask import request, session, current_app, g, has_app_context
+from flask_babel import get_locale
+from sqlalchemy import event, inspect
+
+from app.cache import make_backend, CacheStats
+
+
+class PageCache:
+    """Full-response cache for anonymous GETs of the endpoints in `PAGE_CACHE_ENDPOINTS`.
+
+    Entries are keyed by path, query string and locale, plus a generation counter for the endpoint and for
+    the row the page shows. Commits bump the generations of the pages that display the changed rows, which
+    makes their entries unreachable in this worker; other workers pick up changes once their entries expire
+    after `PAGE_CACHE_TIMEOUT` seconds.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = make_backend(app.config['PAGE_CACHE_BACKEND'], maxsize=app.config['PAGE_CACHE_SIZE'],
+                               timeout=app.config['PAGE_CACHE_TIMEOUT'])
+        app.extensions['page_cache'] = {'backend': backend, 'stats': CacheStats(), 'generations': {}}
+        # Must run before any other before_request hook, so hits skip the search form and locale setup
+        app.before_request_funcs.setdefault(None, []).insert(0, self._serve)
+        app.after_request(self._store)
+
+        from app import db
+        if not event.contains(db.session, 'after_commit', invalidate_pages):
+            event.listen(db.session, 'after_flush', collect_page_tags)
+            event.listen(db.session, 'after_commit', invalidate_pages)
+            event.listen(db.session, 'after_rollback', discard_page_tags)
+
+    @property
+    def stats(self):
+        return current_app.extensions['page_cache']['stats']
+
+    @staticmethod
+    def _is_anonymous():
+        # Checked from the session rather than `current_user` to avoid loading the user
+        return 'user_id' not in session and '_user_id' not in session and \
+            current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token') not in request.cookies
+
+    def _key(self):
+        cache = current_app.extensions['page_cache']
+        tags = [request.endpoint]
+        if 'id' in request.view_args:
+            tags.append(f"{request.endpoint}:{request.view_args['id']}")
+        generations = ','.join(str(cache['generations'].get(tag, 0)) for tag in tags)
+        query = '&'.join(sorted(request.query_string.decode('utf-8', 'replace').split('&')))
+        return f'{request.path}?{query}|{get_locale()}|{generations}'
+
+    def _serve(self):
+        if request.method != 'GET' or request.endpoint not in current_app.config['PAGE_CACHE_ENDPOINTS'] or \
+                not self._is_anonymous() or session.get('_flashes'):
+            return
+        cache = current_app.extensions['page_cache']
+        key = self._key()
+        cached = cache['backend'].get(key)
+        if cached is None:
+            cache['stats'].misses += 1
+            g.page_cache_key = key
+            return
+        cache['stats'].hits += 1
+        body, headers = cached
+        return current_app.response_class(body, headers=headers).make_conditional(request)
+
+    @staticmethod
+    def _store(response):
+        key = g.pop('page_cache_key', None)
+        if key is None or response.status_code != 200 or response.direct_passthrough or session.modified or \
+                'Set-Cookie' in response.headers:
+            return response
+        headers = [(k, v) for k, v in response.headers if k not in ('Content-Length', 'Date')]
+        current_app.extensions['page_cache']['backend'].set(key, (response.get_data(), headers))
+        return response
+
+
+def page_tags(obj):
+    """Tags of the cached pages that display `obj`."""
+    table = getattr(obj, '__tablename__', None)
+    if table == 'review':
+        return {'main.explore', f'main.whisky:{obj.whisky_id}'}
+    if table == 'whisky':
+        return {'main.explore', 'main.whisky_list', f'main.whisky:{obj.id}', f'main.distillery:{obj.distillery_id}'}
+    if table == 'distillery':
+        return {'main.explore', 'main.whisky_list', 'main.whisky', f'main.distillery:{obj.id}'}
+    if table == 'tag':
+        return {'main.explore', 'main.whisky'}
+    return set()
+
+
+def collect_page_tags(session, flush_context):
+    tags = session.info.setdefault('page_cache_tags', set())
+    for obj in list(session.new) + list(session.deleted):
+        tags |= page_tags(obj)
+    for obj in session.dirty:
+        table = getattr(obj, '__tablename__', None)
+        if table == 'user':
+            # Only the author name and avatar shown on review rows matter, not e.g. the whiskies a user listed
+            attrs = inspect(obj).attrs
+            if any(attrs[key].history.has_changes() for key in ('username', 'email', 'avatar_hash')):
+                tags |= {'main.explore', 'main.whisky'}
+        elif session.is_modified(obj):
+            tags |= page_tags(obj)
+            if table == 'whisky':
+                # A whisky moved to another distillery also drops off the old distillery's page
+                tags |= {f'main.distillery:{id}' for id in inspect(obj).attrs.distillery_id.history.deleted
+                         if id is not None}
+
+
+def invalidate_pages(session):
+    tags = session.info.pop('page_cache_tags', None)
+    if tags and has_app_context() and 'page_cache' in current_app.extensions:
+        generations = current_app.extensions['page_cache']['generations']
+        for tag in tags:
+            generations[tag] = generations.get(tag, 0) + 1
+
+
+def discard_page_tags(session):
+    session.info.pop('page_cache_tags', None)
@@ -0,0 +1,71 @@
+"""Hooks for serving with a preloaded app, called from gunicorn.conf.py.
+
+With `preload_app` the app is created once in the master and every worker is a fork of it, sharing its memory
+copy-on-write. `prepare` fills the caches that are the same in every worker, closes what must not be shared and
+freezes the garbage collector, so the shared pages aren't written to by the collector later. `after_fork` gives
+each worker its own Elasticsearch client, log listener and random seed. Database connections, the mail pool,
+search executor, profiler and metrics are all opened or started on first use in each worker.
+"""
+
+import gc
+import glob
+import os
+import random
+
+from babel import Locale
+
+from app.logs import start_listener, stop_listener
+from app.search import create_client, shutdown_executor
+
+
+def clear_metrics(directory):
+    """Removes the snapshots a previous server left in `METRICS_DIR`."""
+    if not directory:
+        return
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def warm(app):
+    """Compiles every template and loads the locale data of every language."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    for language in app.config['LANGUAGES']:
+        locale = Locale.parse(language)
+        # Properties are read from the locale data on first use
+        locale.datetime_formats, locale.decimal_formats
+
+
+def prepare(app):
+    """Gets the master ready to fork: warm caches, no open connections or threads, a frozen collector.
+
+    With `SEARCH_WARM_TOP` set, the most frequent searches are run into the search cache too, so every worker
+    starts with them.
+    """
+    from app import db
+    with app.app_context():
+        warm(app)
+        if app.config['SEARCH_WARM_TOP']:
+            from app.searchlog import warm as warm_searches
+            warm_searches(app.config['SEARCH_WARM_TOP'])
+        # The searches ran in threads, which must not be alive at the fork
+        shutdown_executor()
+        db.session.remove()
+        db.get_engine(app).dispose()
+    stop_listener(app)
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def after_fork(app):
+    """Gives a newly forked worker its own connections and threads."""
+    # The database pool was emptied by prepare and connects again on first use. Disposing of it here would
+    # close sockets the master may still be using
+    if app.elasticsearch is not None:
+        app.elasticsearch = create_client(app.config['ELASTICSEARCH_URL'])
+    start_listener(app)
+    random.seed()
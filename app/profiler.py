@@ -0,0 +1,213 @@
+"""Opt-in sampling profiler for production requests.
+
+A fraction `PROFILE_SAMPLE_RATE` of requests, plus any request carrying a valid `X-Profile` token, have their
+thread's stack sampled every `PROFILE_INTERVAL` seconds by one background thread. Samples are kept as collapsed
+stacks per endpoint, the format flamegraph.pl and speedscope read. Requests that aren't profiled only pay for a
+config lookup and a header check.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request, current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+
+HEADER = 'X-Profile'
+_labels = {}
+
+
+def _label(code):
+    try:
+        return _labels[code]
+    except KeyError:
+        path = code.co_filename
+        root = os.path.dirname(current_app.root_path)
+        if path.startswith(root + os.sep):
+            path = os.path.relpath(path, root)
+        else:
+            path = os.sep.join(path.split(os.sep)[-2:])
+        label = _labels[code] = f'{path}:{code.co_name}'.replace(';', ':')
+        return label
+
+
+def collapse(frame):
+    """The stack of `frame` as 'outer;...;inner', starting at the WSGI app so server frames are left out."""
+    labels = []
+    while frame is not None:
+        if frame.f_code.co_name == 'wsgi_app':
+            break
+        labels.append(frame.f_code)
+        frame = frame.f_back
+    return ';'.join(_label(code) for code in reversed(labels))
+
+
+class Sampler:
+    """One thread that samples the stacks of all threads currently being profiled."""
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.pid = os.getpid()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, ident):
+        stacks = Counter()
+        with self.lock:
+            self.active[ident] = stacks
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+        return stacks
+
+    def remove(self, ident):
+        with self.lock:
+            return self.active.pop(ident, Counter())
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                with self.lock:
+                    if not self.active:
+                        self.thread = None
+                        return
+                    active = list(self.active)
+                frames = sys._current_frames()
+                samples = [(ident, collapse(frames[ident])) for ident in active if ident in frames]
+                del frames
+                # Counted under the lock, so `remove` waits for this sample and hands over a settled Counter
+                with self.lock:
+                    for ident, stack in samples:
+                        if ident in self.active:
+                            self.active[ident][stack] += 1
+                time.sleep(self.interval)
+
+
+class EndpointProfile:
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.seconds = 0.0
+        self.stacks = Counter()
+
+    def copy(self):
+        profile = EndpointProfile(self.name)
+        profile.requests, profile.seconds, profile.stacks = self.requests, self.seconds, self.stacks.copy()
+        return profile
+
+    @property
+    def samples(self):
+        return sum(self.stacks.values())
+
+    @property
+    def avg_ms(self):
+        return self.seconds / self.requests * 1000 if self.requests else 0.0
+
+    def functions(self):
+        """[(function, self samples, total samples)], total counting each function once per stack."""
+        own, total = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            frames = stack.split(';') if stack else ['[idle]']
+            own[frames[-1]] += n
+            for frame in set(frames):
+                total[frame] += n
+        return [(name, own[name], n) for name, n in total.items()]
+
+    def folded(self, prefix=None):
+        """Collapsed stacks, one 'frame;frame;frame count' line each."""
+        lines = []
+        for stack, n in self.stacks.most_common():
+            stack = ';'.join(part for part in (prefix, stack) if part)
+            lines.append(f'{stack or "[idle]"} {n}')
+        return '\n'.join(lines) + '\n'
+
+
+class ProfileStore:
+    def __init__(self, max_stacks):
+        self.max_stacks = max_stacks
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, seconds, stacks):
+        with self.lock:
+            profile = self.endpoints.setdefault(endpoint, EndpointProfile(endpoint))
+            profile.requests += 1
+            profile.seconds += seconds
+            for stack, n in stacks.items():
+                # Past the limit new stacks are only counted, so memory stays bounded
+                if stack not in profile.stacks and len(profile.stacks) >= self.max_stacks:
+                    stack = '[other stacks]'
+                profile.stacks[stack] += n
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def snapshot(self):
+        """{endpoint: profile} copied under the lock, for reading while requests keep adding samples."""
+        with self.lock:
+            return {name: profile.copy() for name, profile in self.endpoints.items()}
+
+
+class Profiler:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['profiler'] = {
+            'sampler': Sampler(app, app.config['PROFILE_INTERVAL']),
+            'store': ProfileStore(app.config['PROFILE_MAX_STACKS']),
+        }
+        # First, so time spent in other before_request hooks (rate limits, page cache) is included
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start)
+        app.teardown_request(self._stop)
+
+    @staticmethod
+    def _serializer():
+        return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='profile')
+
+    def token(self):
+        """A value for the `X-Profile` header that gets requests profiled for `PROFILE_TOKEN_MAX_AGE` seconds."""
+        return self._serializer().dumps('profile')
+
+    def _wanted(self):
+        rate = current_app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return True
+        token = request.headers.get(HEADER)
+        if token:
+            max_age = current_app.config['PROFILE_TOKEN_MAX_AGE']
+            try:
+                return self._serializer().loads(token, max_age=max_age) == 'profile'
+            except BadSignature:
+                return False
+        return False
+
+    def _start(self):
+        if not self._wanted():
+            return
+        state = current_app.extensions['profiler']
+        if state['sampler'].pid != os.getpid():
+            # The sampler thread doesn't survive a fork
+            state['sampler'] = Sampler(current_app._get_current_object(), current_app.config['PROFILE_INTERVAL'])
+        state['sampler'].add(threading.get_ident())
+        request.environ['whiskyblog.profile_start'] = time.perf_counter()
+
+    @staticmethod
+    def _stop(exc):
+        start = request.environ.pop('whiskyblog.profile_start', None)
+        if start is None:
+            return
+        state = current_app.extensions['profiler']
+        stacks = state['sampler'].remove(threading.get_ident())
+        state['store'].add(request.endpoint or '[unmatched]', time.perf_counter() - start, stacks)
+
+    @property
+    def store(self):
+        return current_app.extensions['profiler']['store']
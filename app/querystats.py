@@ -0,0 +1,111 @@
+import heapq
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+_local = threading.local()
+
+
+class QueryRecord:
+    """Query count, total DB time and slowest statements seen while the record is active."""
+    def __init__(self, keep_slowest=3):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self.slowest = []
+        self.keep_slowest = keep_slowest
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, (duration, statement))
+        else:
+            heapq.heappushpop(self.slowest, (duration, statement))
+
+    def repeated(self, threshold):
+        """Statements issued at least `threshold` times, which usually point to an N+1 lazy load."""
+        return [(s, n) for s, n in self.statements.most_common() if n >= threshold]
+
+    def slowest_statements(self):
+        return sorted(self.slowest, reverse=True)
+
+
+def _active_records():
+    if not hasattr(_local, 'records'):
+        _local.records = []
+    return _local.records
+
+
+@contextmanager
+def record_queries(keep_slowest=3):
+    """Records every statement issued on this thread inside the block, e.g. around a test client request."""
+    record = QueryRecord(keep_slowest)
+    _active_records().append(record)
+    try:
+        yield record
+    finally:
+        _active_records().remove(record)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    for record in _active_records():
+        record.add(statement, duration)
+
+
+class QueryStats:
+    """Per-request query instrumentation.
+
+    Requests slower than `SLOW_REQUEST_THRESHOLD` (ms) are logged with their query count, DB time and slowest
+    statements, and any statement repeated `QUERY_REPEAT_THRESHOLD` times or more is flagged as a likely N+1.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    @staticmethod
+    def _start():
+        g.request_start = time.perf_counter()
+        g.query_record = QueryRecord(current_app.config['SLOW_QUERY_COUNT'])
+        _active_records().append(g.query_record)
+
+    @staticmethod
+    def _finish(response):
+        record = g.get('query_record')
+        if record is None:
+            return response
+        elapsed = (time.perf_counter() - g.request_start) * 1000
+        repeated = record.repeated(current_app.config['QUERY_REPEAT_THRESHOLD'])
+        if elapsed >= current_app.config['SLOW_REQUEST_THRESHOLD']:
+            current_app.logger.warning(
+                'Slow request %s %s: %.1f ms, %d queries in %.1f ms. Slowest: %s', request.method, request.path,
+                elapsed, record.count, record.duration * 1000,
+                '; '.join(f'{d * 1000:.1f} ms {s}' for d, s in record.slowest_statements()))
+        for statement, n in repeated:
+            current_app.logger.warning('Possible N+1 on %s %s: %d x %s', request.method, request.path, n, statement)
+        return response
+
+    @staticmethod
+    def _teardown(exc):
+        record = g.pop('query_record', None)
+        if record is not None and record in _active_records():
+            _active_records().remove(record)
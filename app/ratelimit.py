@@ -0,0 +1,142 @@
+"""Per-client token buckets and per-worker concurrency caps for expensive endpoints.
+
+`RATELIMIT_RULES` maps an endpoint, optionally prefixed by a method (`'POST auth.login'`), to
+`(tokens per second, burst)`. Clients are told apart by user id when logged in, otherwise by IP address,
+which behind a proxy needs `TRUSTED_PROXIES` set.
+`RATELIMIT_CONCURRENCY` maps a group name to `(limit, endpoints)`: at most `limit` requests to those endpoints
+run at once in a worker, and the rest are turned away immediately instead of queueing in front of
+Elasticsearch. Both answer 429 with `Retry-After`.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, session, current_app
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.utils import import_string
+
+
+class RateLimited(TooManyRequests):
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class MemoryBuckets:
+    """Token buckets of one worker process, at most `maxsize` of them."""
+    def __init__(self, maxsize=100000, **options):
+        self.maxsize = maxsize
+        # Least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from the bucket for `key`. Returns 0 on success, else the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now):
+        # Buckets that were left alone long enough to refill are equivalent to missing ones. A minute is
+        # enough for any sensible rule; past that the least recently used go, down to 90% of `maxsize` so a
+        # flood of new clients doesn't prune on every request.
+        target = self.maxsize * 9 // 10
+        while self._buckets:
+            key, (tokens, last) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= target and now - last < 60:
+                break
+            self._buckets.popitem(last=False)
+
+
+class RedisBuckets:
+    """Token buckets shared by all workers, kept in Redis and updated atomically by a Lua script."""
+    script = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+local last = tonumber(redis.call('HGET', KEYS[1], 'l') or ARGV[3])
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 't', tokens, 'l', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url='redis://localhost:6379/0', **options):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(self.script)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[f'ratelimit:{key}'], args=[rate, burst, time.time()]))
+
+
+backends = {'memory': MemoryBuckets, 'redis': RedisBuckets}
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config['RATELIMIT_BACKEND']
+        cls = backends[name] if name in backends else import_string(name)
+        groups = {}
+        for group, (limit, endpoints) in app.config['RATELIMIT_CONCURRENCY'].items():
+            for endpoint in endpoints:
+                groups[endpoint] = (group, limit)
+        app.extensions['ratelimit'] = {
+            'buckets': cls(url=app.config['RATELIMIT_REDIS_URL']),
+            'rules': dict(app.config['RATELIMIT_RULES']),
+            'groups': groups,
+            'active': dict.fromkeys(app.config['RATELIMIT_CONCURRENCY'], 0),
+            'lock': threading.Lock(),
+            'limited': 0,
+            'shed': 0,
+        }
+        if app.config['RATELIMIT_ENABLED']:
+            app.before_request_funcs.setdefault(None, []).insert(0, self._check)
+            app.teardown_request(self._release)
+
+    @staticmethod
+    def _client():
+        user_id = session.get('user_id') or session.get('_user_id')
+        return f'user:{user_id}' if user_id else f'ip:{request.remote_addr}'
+
+    @classmethod
+    def _check(cls):
+        state = current_app.extensions['ratelimit']
+        endpoint = request.endpoint
+        rule = state['rules'].get(f'{request.method} {endpoint}') or state['rules'].get(endpoint)
+        if rule is not None:
+            wait = state['buckets'].take(f'{endpoint}:{cls._client()}', *rule)
+            if wait:
+                state['limited'] += 1
+                raise RateLimited(wait)
+        group = state['groups'].get(endpoint)
+        if group is not None:
+            name, limit = group
+            with state['lock']:
+                if state['active'][name] >= limit:
+                    state['shed'] += 1
+                    raise RateLimited(1)
+                state['active'][name] += 1
+            request.environ['whiskyblog.concurrency_group'] = name
+
+    @staticmethod
+    def _release(exc):
+        name = request.environ.pop('whiskyblog.concurrency_group', None)
+        if name is not None:
+            state = current_app.extensions['ratelimit']
+            with state['lock']:
+                state['active'][name] -= 1
@@ -0,0 +1,106 @@
+"""Offline item-item collaborative filtering over the sparse user x whisky matrix.
+
+The matrix is built from `whiskies_listed` (implicit "tried it" signal) and review scores. It is held as two
+adjacency lists of typed arrays, so memory grows with the number of interactions rather than users x whiskies.
+Only the `neighbours` most similar whiskies are kept per whisky and recommendations are written in batches,
+which keeps the job bounded for ~100k users x 50k whiskies on a single machine.
+"""
+
+import heapq
+from array import array
+from collections import defaultdict
+from itertools import groupby
+from math import sqrt
+
+from app import db
+from app.models import Review, Recommendation, whiskies_listed
+
+
+def interaction_weight(score):
+    # A listed whisky counts as 1.0; a review moves the weight between 0.5 (score 0) and 1.0 (score 100)
+    if score is None:
+        return 1.0
+    return 0.5 + min(max(score, 0), 100) / 200
+
+
+def load_interactions(batch_size=10000):
+    """Returns `user_items` and `item_users`, mapping ids to parallel arrays of (ids, weights).
+
+    Both sources are read as one UNION query in user order, so a single cursor streams them and no
+    intermediate structure grows beyond a single user's history.
+    """
+    listed = db.select([whiskies_listed.c.user_id, whiskies_listed.c.whisky_id,
+                        db.cast(db.null(), db.Integer).label('score')])
+    reviewed = db.select([Review.user_id, Review.whisky_id, Review.score]).where(
+        db.and_(Review.user_id.isnot(None), Review.whisky_id.isnot(None)))
+    interactions = db.union_all(listed, reviewed).alias('interactions')
+    rows = db.session.query(interactions).order_by(interactions.c.user_id).yield_per(batch_size)
+
+    user_items = {}
+    item_users = defaultdict(lambda: (array('i'), array('f')))
+    for user_id, user_rows in groupby(rows, key=lambda row: row[0]):
+        history = {}
+        for _, whisky_id, score in user_rows:
+            history[whisky_id] = max(history.get(whisky_id, 0.0), interaction_weight(score))
+        user_items[user_id] = (array('i', history.keys()), array('f', history.values()))
+        for whisky_id, weight in history.items():
+            users, weights = item_users[whisky_id]
+            users.append(user_id)
+            weights.append(weight)
+    return user_items, item_users
+
+
+def item_neighbours(user_items, item_users, neighbours=50, max_users_per_item=1000):
+    """Cosine similarity between whiskies, keeping only the top `neighbours` for each whisky.
+
+    Very popular whiskies only look at their `max_users_per_item` strongest users to bound the work per item.
+    """
+    norms = {i: sqrt(sum(w * w for w in ws)) for i, (_, ws) in item_users.items()}
+    similar = {}
+    for item, (users, weights) in item_users.items():
+        pairs = zip(users, weights)
+        if len(users) > max_users_per_item:
+            pairs = heapq.nlargest(max_users_per_item, pairs, key=lambda p: p[1])
+        dots = defaultdict(float)
+        for user, weight in pairs:
+            others, other_weights = user_items[user]
+            for other, other_weight in zip(others, other_weights):
+                if other != item:
+                    dots[other] += weight * other_weight
+        best = heapq.nlargest(neighbours, dots.items(), key=lambda d: d[1])
+        similar[item] = (array('i', (other for other, _ in best)),
+                         array('f', (dot / (norms[item] * norms[other]) for other, dot in best)))
+    return similar
+
+
+def recommend_for_user(items, weights, similar, top_n=10):
+    seen = set(items)
+    scores = defaultdict(float)
+    for item, weight in zip(items, weights):
+        for other, sim in zip(*similar.get(item, ((), ()))):
+            if other not in seen:
+                scores[other] += weight * sim
+    return heapq.nlargest(top_n, scores.items(), key=lambda s: s[1])
+
+
+def build_recommendations(neighbours=50, top_n=10, batch_size=1000):
+    """Rebuilds the `recommendation` table and returns the number of rows written."""
+    user_items, item_users = load_interactions()
+    similar = item_neighbours(user_items, item_users, neighbours=neighbours)
+    del item_users
+
+    db.session.query(Recommendation).delete(synchronize_session=False)
+    written = 0
+    rows = []
+    for user_id, (items, weights) in user_items.items():
+        for whisky_id, score in recommend_for_user(items, weights, similar, top_n=top_n):
+            rows.append({'user_id': user_id, 'whisky_id': whisky_id, 'score': score})
+        if len(rows) >= batch_size:
+            db.session.execute(Recommendation.__table__.insert(), rows)
+            written += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(Recommendation.__table__.insert(), rows)
+        written += len(rows)
+    db.session.commit()
+    return written
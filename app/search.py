@@ -1,30 +1,187 @@
-from flask import current_app
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+from flask import current_app, g, has_request_context
+from werkzeug.urls import url_encode, url_decode
+
+
+class LazyClient:
+    """Stands in for the Elasticsearch client, which is only imported and created when first used."""
+    def __init__(self, url, **kwargs):
+        self.url = url
+        self.kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from elasticsearch import Elasticsearch
+                    from app.estransport import TimedTransport
+                    self._client = Elasticsearch([self.url], transport_class=TimedTransport, **self.kwargs)
+        return getattr(self._client, name)
+
+
+def create_client(url, **kwargs):
+    """Elasticsearch client for `url`. It connects on first use, so it is cheap to create again after a fork."""
+    return LazyClient(url, **kwargs)
+
+
+"""Partitions
+
+Reviews are indexed into one index per year, `<index>-<year>`, and read through the alias `<index>`. An index
+template gives every partition the mappings and the alias, so the first review of a new year creates its
+partition. Searches sorted by date read the partitions in order and stop once the page is full, and a date range
+only reads the partitions it covers. Past years can be force-merged and made read-only with
+`flask search optimize`.
+"""
+
+MAPPINGS = {
+    'properties': {
+        'score': {'type': 'integer'},
+        'timestamp': {'type': 'date'},
+        'nose': {'type': 'text'},
+        'palate': {'type': 'text'},
+        'finish': {'type': 'text'},
+        'distillery_': {'type': 'text'},
+        'whisky_': {'type': 'text'},
+        'tags_': {'type': 'keyword'},
+        'user_': {'type': 'keyword'}
+    }
+}
+
+
+def partition(index, timestamp=None):
+    """The partition of `index` holding documents of the ISO `timestamp`, or of now."""
+    return f'{index}-{timestamp[:4] if timestamp else datetime.utcnow().year}'
+
+
+def partition_year(name):
+    return int(name.rsplit('-', 1)[1])
+
+
+def partitions(index, refresh=False):
+    """Partitions of `index`, newest first, or [] when `index` is a plain index or doesn't exist.
+
+    The list is looked up again at most every `SEARCH_PARTITION_CHECK_INTERVAL` seconds, so a partition created
+    by another process is searched after that long at most.
+    """
+    known = current_app.extensions.setdefault('search_partitions', {})
+    checked, names = known.get(index, (None, None))
+    if refresh or checked is None or time.monotonic() - checked > current_app.config['SEARCH_PARTITION_CHECK_INTERVAL']:
+        aliases = current_app.elasticsearch.indices.get_alias(name=index, ignore=404)
+        names = sorted((name for name in aliases if name.startswith(f'{index}-') and name[len(index) + 1:].isdigit()),
+                       key=partition_year, reverse=True)
+        known[index] = (time.monotonic(), names)
+    return names
 
 
 def insert_mapping(index):
+    """Puts the template of the partitions of `index` and creates the partition of this year."""
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.indices.create(index=index, ignore=400, body={
-        'mappings': {
-            'properties': {
-                'score': {'type': 'integer'},
-                'timestamp': {'type': 'date'},
-                'nose': {'type': 'text'},
-                'palate': {'type': 'text'},
-                'finish': {'type': 'text'},
-                'distillery_': {'type': 'text'},
-                'whisky_': {'type': 'text'},
-                'tags_': {'type': 'keyword'},
-                'user_': {'type': 'keyword'}
-            }
-        }
+    current_app.elasticsearch.indices.put_template(name=index, body={
+        'index_patterns': [f'{index}-*'],
+        'mappings': MAPPINGS,
+        'aliases': {index: {}}
     })
+    current_app.elasticsearch.indices.create(index=partition(index), ignore=400)
+    partitions(index, refresh=True)
 
 
 def delete_mapping(index):
+    """Deletes the partitions of `index` and their template, or `index` itself when it isn't partitioned."""
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.indices.delete(index=index)
+    current_app.elasticsearch.indices.delete(index=f'{index}-*')
+    current_app.elasticsearch.indices.delete_template(name=index, ignore=404)
+    current_app.elasticsearch.indices.delete(index=index, ignore=404)
+    partitions(index, refresh=True)
+
+
+class IndexingError(Exception):
+    """Some documents of a rebuild were not indexed. `failed` is {id: reason}, `counts` the documents indexed."""
+    def __init__(self, failed, counts):
+        super().__init__(f'{len(failed)} documents failed to index')
+        self.failed = failed
+        self.counts = counts
+
+
+def _bulk(batch, counts, failed):
+    """Sends the actions of `batch`, counting the documents indexed by partition and the failures by id."""
+    response = current_app.elasticsearch.bulk(body=batch)
+    for item in response['items']:
+        (action, result), = item.items()
+        if 'error' in result:
+            error = result['error']
+            failed[result['_id']] = f"{error['type']}: {error['reason']}" if isinstance(error, dict) else str(error)
+        else:
+            counts[result['_index']] = counts.get(result['_index'], 0) + 1
+
+
+def rebuild(index='review', batch_size=2000):
+    """Deletes `index` and indexes every review again into its partitions. Returns {partition: documents}.
+
+    Raises `IndexingError` once every batch is sent if any review failed to index.
+    """
+    delete_mapping(index)
+    insert_mapping(index)
+    counts, failed, batch = {}, {}, []
+    for id, body in review_documents():
+        batch += [{'index': {'_index': partition(index, body['timestamp']), '_id': id}}, body]
+        if len(batch) >= 2 * batch_size:
+            _bulk(batch, counts, failed)
+            batch = []
+    if batch:
+        _bulk(batch, counts, failed)
+    partitions(index, refresh=True)
+    if failed:
+        raise IndexingError(failed, counts)
+    return counts
+
+
+def optimize(index, before=None):
+    """Force-merges the partitions of `index` older than year `before`, this year by default, into one segment
+    each and blocks writes to them. Returns the names of the partitions optimized.
+
+    Merged segments take less heap and search faster. A review edited later opens its partition for writes
+    again, until the next optimize.
+    """
+    before = before or datetime.utcnow().year
+    names = [name for name in partitions(index, refresh=True) if partition_year(name) < before]
+    for name in names:
+        current_app.elasticsearch.indices.put_settings(index=name, body={'index': {'blocks': {'write': True}}})
+        current_app.elasticsearch.indices.forcemerge(index=name, max_num_segments=1, request_timeout=3600)
+    return names
+
+
+def review_documents(batch_size=5000):
+    """Yields (id, body) for every review, as `index_body` would build them, from a few joined queries per batch."""
+    from app import db
+    from app.models import Review, Whisky, Distillery, User, Tag, tags
+
+    last = 0
+    while True:
+        rows = db.session.query(Review.id, Review.nose, Review.palate, Review.finish, Review.score, Review.timestamp,
+                                Distillery.name, Whisky.name, User.username).join(
+            Whisky, Review.whisky_id == Whisky.id).join(Distillery, Whisky.distillery_id == Distillery.id).join(
+            User, Review.user_id == User.id).filter(Review.id > last).order_by(Review.id).limit(batch_size).all()
+        if not rows:
+            return
+        last = rows[-1][0]
+        review_tags = {}
+        for review_id, name in db.session.query(tags.c.review_id, Tag.name).join(Tag, Tag.id == tags.c.tag_id).filter(
+                tags.c.review_id.between(rows[0][0], last)):
+            review_tags.setdefault(review_id, []).append(name)
+        for id, nose, palate, finish, score, timestamp, distillery, whisky, username in rows:
+            yield id, {'nose': nose, 'palate': palate, 'finish': finish, 'score': score,
+                       'timestamp': timestamp.isoformat() if timestamp else None, 'distillery_': distillery,
+                       'whisky_': whisky, 'tags_': review_tags.get(id, []), 'user_': username}
 
 
 def get_mappings():
@@ -33,62 +190,140 @@ def get_mappings():
     return current_app.elasticsearch.indices.get_mapping(index='_all')
 
 
-def add_doc_to_index(index, doc):
-    if not current_app.elasticsearch:
-        return
+def index_body(doc):
+    """The document indexed for `doc`, made of JSON types so it can be stored in a job."""
     body = {}
     for field in doc.searchable_fields:
-        body[field] = getattr(doc, field)
-    current_app.elasticsearch.index(index=index, id=doc.id, body=body)
+        value = getattr(doc, field, None)
+        body[field] = value.isoformat() if isinstance(value, datetime) else value
+    return body
 
 
-def remove_doc_from_index(index, doc):
+def _write(name, request):
+    """Runs `request` on partition `name`, opening the partition for writes again if it was optimized."""
+    from elasticsearch import AuthorizationException
+    try:
+        return request()
+    except AuthorizationException as e:
+        # Other 403s, from security settings for instance, aren't lifted by opening the partition
+        if e.error != 'cluster_block_exception':
+            raise
+        current_app.elasticsearch.indices.put_settings(index=name, body={'index': {'blocks': {'write': False}}})
+        return request()
+
+
+def index_document(index, id, body):
+    """Indexes `body` into the partition of `index` of its timestamp."""
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=doc.id)
+    name = partition(index, body.get('timestamp'))
+    _write(name, lambda: current_app.elasticsearch.index(index=name, id=id, body=body))
+    known = current_app.extensions.get('search_partitions', {})
+    if index in known and name not in known[index][1]:
+        # A new partition, searched from now on in this process
+        del known[index]
 
 
-# Use a bool filter to combine the matches of `query`, the exclusion of `excluded` and filtered by `tags`.
-def query_index(index, query, excluded, tags, offset, size, sort):
+def remove_document(index, id, timestamp=None):
+    """Removes document `id` from the partition of `index` of `timestamp`, or from all of them without one."""
     if not current_app.elasticsearch:
-        return [], 0
-    sort_order = {'rel': '_score', 'old': {'timestamp': 'asc'}, 'new': {'timestamp': 'desc'}}
-    search = current_app.elasticsearch.search(
-        index=index, body={
-            'query': {
-                'bool': {
-                    'must': [{
-                        'multi_match': {
-                            'query': query,
-                            'fields': ['*'],
-                            'lenient': 'true'
-                        }
-                    }] if query else [],
-                    'must_not': [{
-                        'multi_match': {
-                            'query': excluded,
-                            'fields': ['*'],
-                            'lenient': 'true'
-                        }
-                    }] if excluded else [],
-                    'filter': [{
-                        'term': {
-                            'tags_': t
-                        }
-                    } for t in tags]
+        return
+    for name in [partition(index, timestamp)] if timestamp else partitions(index) or [index]:
+        _write(name, lambda: current_app.elasticsearch.delete(index=name, id=id, ignore=404))
+
+
+def add_doc_to_index(index, doc):
+    index_document(index, doc.id, index_body(doc))
+
+
+def remove_doc_from_index(index, doc):
+    remove_document(index, doc.id, doc.timestamp.isoformat() if doc.timestamp else None)
+
+
+def parse_query(q):
+    """Splits a simple search into (query, excluded, tags): `@tag` filters by tag and `-word` excludes a word."""
+    tags_queried, excluded_queries, normal_queries = [], [], []
+    for word in q.split():
+        if word[0] == '@':
+            # Tags of several words are written with underscores, e.g. `@fresh_fruit`
+            tags_queried.append(word[1:].replace('_', ' ').title())
+        elif word[0] == '-':
+            excluded_queries.append(word[1:])
+        else:
+            normal_queries.append(word)
+    return ' '.join(normal_queries), ' '.join(excluded_queries), tags_queried
+
+
+def normalize_query(q):
+    """A simple search in one form per meaning: excluded words and tags sorted after the words, tags in lower case.
+
+    Words keep their case, since keyword fields like `user_` match it exactly.
+    """
+    normal, excluded, tags = parse_query(q)
+    return ' '.join([normal] + [f'-{word}' for word in sorted(excluded.split())] +
+                    [f"@{tag.lower().replace(' ', '_')}" for tag in sorted(tags)]).strip()
+
+
+def advanced_args(args):
+    """Arguments for `advanced_query` from the arguments of an advanced search URL."""
+    return {
+        'review': args.get('review'),
+        'tags': args.getlist('tags'),
+        'whisky': args.get('whisky'),
+        'score_lower': args.get('score_lower', type=int),
+        'score_greater': args.get('score_greater', type=int),
+        'user': args.get('user'),
+        'year_from': args.get('year_from', type=int),
+        'year_to': args.get('year_to', type=int)
+    }
+
+
+def normalize_advanced(args):
+    """An advanced search as a URL query string of its arguments that are set, sorted."""
+    return url_encode({k: sorted(v) if k == 'tags' else v for k, v in args.items() if v not in (None, '', [])},
+                      sort=True)
+
+
+def search_request(kind, query):
+    """(Elasticsearch query, text to check the spelling of) for a normalized `simple` or `advanced` search."""
+    if kind == 'simple':
+        normal, excluded, tags = parse_query(query)
+        return simple_query(normal, excluded, tags), normal
+    args = advanced_args(url_decode(query))
+    return advanced_query(**args), args['review']
+
+
+SORT_ORDER = {'rel': '_score', 'old': {'timestamp': 'asc'}, 'new': {'timestamp': 'desc'}}
+
+
+# Use a bool filter to combine the matches of `query`, the exclusion of `excluded` and filtered by `tags`.
+def simple_query(query, excluded, tags):
+    return {
+        'bool': {
+            'must': [{
+                'multi_match': {
+                    'query': query,
+                    'fields': ['*'],
+                    'lenient': 'true'
+                }
+            }] if query else [],
+            'must_not': [{
+                'multi_match': {
+                    'query': excluded,
+                    'fields': ['*'],
+                    'lenient': 'true'
+                }
+            }] if excluded else [],
+            'filter': [{
+                'term': {
+                    'tags_': t
                 }
-            },
-            'from': (offset - 1) * size, 'size': size, 'sort': sort_order[sort] if sort else '_score'
+            } for t in tags]
         }
-    )
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    }
 
 
-def query_advanced(index, review, score_lower, score_greater, tags, whisky, user, offset, size, sort='_score'):
-    if not current_app.elasticsearch:
-        return [], 0
-    sort_order = {'rel': '_score', 'old': {'timestamp': 'asc'}, 'new': {'timestamp': 'desc'}}
+def advanced_query(review, score_lower, score_greater, tags, whisky, user, year_from=None, year_to=None):
     body_must = []
     body_should = []
     body_filter = []
@@ -109,6 +344,18 @@ def query_advanced(index, review, score_lower, score_greater, tags, whisky, user
                 }
             }
         })
+    if year_from or year_to:
+        # Whole years, which also tell `routed` the partitions to search
+        years = {}
+        if year_from:
+            years['gte'] = f'{year_from:04d}-01-01'
+        if year_to:
+            years['lt'] = f'{year_to + 1:04d}-01-01'
+        body_filter.append({
+            'range': {
+                'timestamp': years
+            }
+        })
     if user:
         body_filter.append({
             'term': {
@@ -144,19 +391,185 @@ def query_advanced(index, review, score_lower, score_greater, tags, whisky, user
                 } for t in tags]
             }
         })
-    search = current_app.elasticsearch.search(
-        index=index, body={
-            'query': {
-                'bool': {
-                    'must': body_must,
-                    'should': body_should,
-                    'filter': body_filter,
-                    'minimum_should_match': 1 if body_should else 0,
-                    'boost': 2
-                }
-            },
-            'from': (offset - 1) * size, 'size': size, 'sort': sort_order[sort] if sort else '_score'
+    return {
+        'bool': {
+            'must': body_must,
+            'should': body_should,
+            'filter': body_filter,
+            'minimum_should_match': 1 if body_should else 0,
+            'boost': 2
         }
-    )
+    }
+
+
+def _years(query):
+    """(first, last) year allowed by the `timestamp` range filter of an `advanced_query`, None when unbounded."""
+    for clause in query.get('bool', {}).get('filter', []):
+        bounds = clause.get('range', {}).get('timestamp')
+        if bounds:
+            return (int(bounds['gte'][:4]) if 'gte' in bounds else None,
+                    int(bounds['lt'][:4]) - 1 if 'lt' in bounds else None)
+    return None, None
+
+
+def routed(index, query):
+    """Partitions of `index` that can hold reviews matching `query`, newest first, or [index] if not partitioned."""
+    names = partitions(index)
+    if not names:
+        return [index]
+    first, last = _years(query)
+    return [name for name in names if (first is None or partition_year(name) >= first) and
+            (last is None or partition_year(name) <= last)]
+
+
+def hits(index, query, offset, size, sort, **kwargs):
+    """Ids of page `offset` (from 1) of the reviews matching `query`, and how many match in total."""
+    names = routed(index, query)
+    if not names:
+        return [], 0
+    if sort in ('new', 'old') and len(names) > 1:
+        return _hits_by_date(names if sort == 'new' else names[::-1], query, offset, size, sort, **kwargs)
+    search = current_app.elasticsearch.search(
+        index=','.join(names), body={'query': query, 'from': (offset - 1) * size, 'size': size,
+                                     'sort': SORT_ORDER.get(sort, '_score')}, **kwargs)
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
+
+
+def _hits_by_date(names, query, offset, size, sort, **kwargs):
+    """`hits` sorted by date, searching the partitions `names` one after the other in that order.
+
+    Only the partitions up to the one that fills the page are searched, the matches in the others are counted
+    with a single request. The first pages of the newest or oldest reviews mostly take one partition.
+    """
+    skip, ids, total = (offset - 1) * size, [], 0
+    for i, name in enumerate(names):
+        search = current_app.elasticsearch.search(index=name, body={
+            'query': query, 'from': skip, 'size': size - len(ids), 'sort': SORT_ORDER[sort],
+            'track_total_hits': True}, **kwargs)
+        matched = search['hits']['total']['value']
+        ids += [int(hit['_id']) for hit in search['hits']['hits']]
+        total += matched
+        skip = max(0, skip - matched)
+        if len(ids) == size:
+            if names[i + 1:]:
+                total += current_app.elasticsearch.count(index=','.join(names[i + 1:]), body={'query': query},
+                                                         **kwargs)['count']
+            break
+    return ids, total
+
+
+def tag_facets(index, query, size=10, **kwargs):
+    """[(tag, number of matching reviews)] for the most common tags among the reviews matching `query`."""
+    names = routed(index, query)
+    if not names:
+        return []
+    search = current_app.elasticsearch.search(index=','.join(names), body={
+        'query': query, 'size': 0, 'aggs': {'tags': {'terms': {'field': 'tags_', 'size': size}}}}, **kwargs)
+    return [(bucket['key'], bucket['doc_count']) for bucket in search['aggregations']['tags']['buckets']]
+
+
+def suggest(index, text, fields=('nose', 'palate', 'finish'), **kwargs):
+    """{word: correction} for the words of `text` that appear in no review while a close spelling does."""
+    search = current_app.elasticsearch.search(index=index, body={'size': 0, 'suggest': dict(
+        {field: {'term': {'field': field, 'suggest_mode': 'missing'}} for field in fields}, text=text)}, **kwargs)
+    best = {}
+    for field in fields:
+        for entry in search['suggest'][field]:
+            for option in entry['options'][:1]:
+                if (option['score'], option['freq']) > best.get(entry['text'], (0, 0, None))[:2]:
+                    best[entry['text']] = (option['score'], option['freq'], option['text'])
+    return {word: correction for word, (_, _, correction) in best.items()}
+
+
+def query_index(index, query, excluded, tags, offset, size, sort):
+    if not current_app.elasticsearch:
+        return [], 0
+    return hits(index, simple_query(query, excluded, tags), offset, size, sort)
+
+
+def query_advanced(index, review, score_lower, score_greater, tags, whisky, user, offset, size, sort='_score',
+                   year_from=None, year_to=None):
+    if not current_app.elasticsearch:
+        return [], 0
+    return hits(index, advanced_query(review, score_lower, score_greater, tags, whisky, user, year_from, year_to),
+                offset, size, sort)
+
+
+"""Concurrent searches"""
+
+SearchPage = namedtuple('SearchPage', 'ids total facets corrections missing cached')
+_pool = {'pid': None, 'executor': None}
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    with _pool_lock:
+        if _pool['pid'] != os.getpid():
+            # Threads don't survive a fork
+            _pool['executor'] = ThreadPoolExecutor(current_app.config['SEARCH_WORKERS'], thread_name_prefix='search')
+            _pool['pid'] = os.getpid()
+        return _pool['executor']
+
+
+def shutdown_executor():
+    """Stops the search threads of this process, e.g. before forking; the next `fan_out` starts new ones."""
+    with _pool_lock:
+        if _pool['pid'] == os.getpid():
+            _pool['executor'].shutdown()
+        _pool['pid'] = _pool['executor'] = None
+
+
+def fan_out(calls, timeout):
+    """Runs `calls`, {name: (function, *args)}, at the same time, and waits for them for `timeout` seconds at most.
+
+    Returns {name: result} of the calls that finished in time without raising. The time waited is added to
+    `g.es_time` like that of other Elasticsearch requests.
+    """
+    app = current_app._get_current_object()
+
+    def run(function, *args):
+        with app.app_context():
+            return function(*args, request_timeout=timeout)
+
+    start = time.perf_counter()
+    futures = {name: _executor().submit(run, *call) for name, call in calls.items()}
+    done, _ = wait(futures.values(), timeout=timeout)
+    if has_request_context():
+        g.es_time = g.get('es_time', 0.0) + time.perf_counter() - start
+    results = {}
+    for name, future in futures.items():
+        if future not in done:
+            future.cancel()
+            current_app.logger.warning('Search %s did not finish within %.2f s', name, timeout)
+        elif future.exception() is not None:
+            current_app.logger.warning('Search %s failed: %r', name, future.exception())
+        else:
+            results[name] = future.result()
+    return results
+
+
+def search_page(index, query, offset, size, sort, text=None):
+    """A page of search results with its tag facets and spelling corrections for `text`, fetched concurrently.
+
+    Whatever did not come back within `SEARCH_TIMEOUT` is left out and named in `missing`, so the page takes as
+    long as the slowest part rather than the sum of them, and never longer than the timeout. Complete pages are
+    kept in the search cache.
+    """
+    from app import search_cache
+    if not current_app.elasticsearch:
+        return SearchPage([], 0, [], {}, [], False)
+    key = search_cache.key(index, query, offset, size, sort, text)
+    page = search_cache.get(key)
+    if page is not None:
+        return page._replace(cached=True)
+    calls = {'hits': (hits, index, query, offset, size, sort), 'facets': (tag_facets, index, query)}
+    if text:
+        calls['suggest'] = (suggest, index, text)
+    results = fan_out(calls, current_app.config['SEARCH_TIMEOUT'])
+    ids, total = results.get('hits', ([], 0))
+    page = SearchPage(ids, total, results.get('facets', []), results.get('suggest', {}),
+                      [name for name in calls if name not in results], False)
+    if not page.missing:
+        search_cache.set(key, page)
+    return page
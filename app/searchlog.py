@@ -0,0 +1,172 @@
+"""Log of what people search for, in the `search_query` table.
+
+The search page only puts an entry on a bounded queue. One thread per process adds the entries up and writes
+them every `SEARCH_LOG_FLUSH_INTERVAL` seconds, with one UPDATE, or INSERT, per distinct query and day rather
+than per search. Entries are dropped when the queue is full, and rows older than `SEARCH_LOG_DAYS` days are
+deleted as new days start.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+
+class _Writer:
+    """Queue and writer thread of one app in one process."""
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=app.config['SEARCH_LOG_QUEUE_SIZE'])
+        self.dropped = 0
+        self.pruned = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def put(self, entry):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='search-log', daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.app.config['SEARCH_LOG_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Could not write the search log')
+
+    def _drain(self):
+        """{(day, kind, query): [searches, timed, total_ms, max_ms, zero_results]} of the queued entries."""
+        totals = {}
+        while True:
+            try:
+                day, kind, query, ms, total, cached = self.queue.get_nowait()
+            except queue.Empty:
+                return totals
+            row = totals.setdefault((day, kind, query), [0, 0, 0.0, 0.0, 0])
+            row[0] += 1
+            if not cached:
+                row[1] += 1
+                row[2] += ms
+                row[3] = max(row[3], ms)
+            row[4] += total == 0
+
+    def flush(self):
+        from app import db
+        from app.models import SearchQuery
+        table = SearchQuery.__table__
+        with self.flush_lock, self.app.app_context():
+            totals = self._drain()
+            if not totals:
+                return 0
+            for attempt in range(2):
+                try:
+                    # A connection of its own, so flushing from a request leaves its session alone
+                    with db.engine.begin() as connection:
+                        for (day, kind, query), (searches, timed, total_ms, max_ms, zero) in totals.items():
+                            result = connection.execute(table.update().where(table.c.day == day).where(
+                                table.c.kind == kind).where(table.c.query == query).values(
+                                searches=table.c.searches + searches, timed=table.c.timed + timed,
+                                total_ms=table.c.total_ms + total_ms, zero_results=table.c.zero_results + zero,
+                                max_ms=db.case([(table.c.max_ms < max_ms, max_ms)], else_=table.c.max_ms)))
+                            if result.rowcount == 0:
+                                connection.execute(table.insert().values(
+                                    day=day, kind=kind, query=query, searches=searches, timed=timed,
+                                    total_ms=total_ms, max_ms=max_ms, zero_results=zero))
+                        self._prune(connection, table)
+                    break
+                except IntegrityError:
+                    # Another process inserted one of the rows first; this time it gets updated
+                    if attempt:
+                        raise
+        return len(totals)
+
+    def _prune(self, connection, table):
+        today = datetime.utcnow().date()
+        if self.pruned != today:
+            connection.execute(table.delete().where(
+                table.c.day < today - timedelta(days=self.app.config['SEARCH_LOG_DAYS'])))
+            self.pruned = today
+
+
+class SearchLog:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['search_log'] = _Writer(app)
+        atexit.register(self._flush_at_exit, app)
+
+    @staticmethod
+    def _writer():
+        app = current_app._get_current_object()
+        writer = app.extensions['search_log']
+        if writer.pid != os.getpid():
+            # The writer thread doesn't survive a fork
+            writer = app.extensions['search_log'] = _Writer(app)
+        return writer
+
+    def record(self, kind, query, ms, page):
+        """Queues one search for a normalized query that took `ms` milliseconds and returned the SearchPage `page`."""
+        if not current_app.config['SEARCH_LOG_ENABLED'] or not query or len(query) > 200:
+            return
+        self._writer().put((datetime.utcnow().date(), kind, query, ms, page.total, page.cached))
+
+    def flush(self):
+        """Writes the queued searches now, returning the number of rows written."""
+        return self._writer().flush()
+
+    @property
+    def dropped(self):
+        return self._writer().dropped
+
+    @staticmethod
+    def _flush_at_exit(app):
+        writer = app.extensions['search_log']
+        if writer.pid == os.getpid():
+            try:
+                writer.flush()
+            except Exception:
+                app.logger.exception('Could not write the search log')
+
+
+def top_queries(days=7, limit=50, order='searches'):
+    """[(kind, query, searches, avg_ms, max_ms, zero_results)] over the last `days` days, by `order`."""
+    from app import db
+    from app.models import SearchQuery
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    searches = db.func.sum(SearchQuery.searches)
+    avg_ms = db.func.sum(SearchQuery.total_ms) / db.func.nullif(db.func.sum(SearchQuery.timed), 0)
+    max_ms = db.func.max(SearchQuery.max_ms)
+    zero = db.func.sum(SearchQuery.zero_results)
+    orders = {'searches': searches, 'avg': avg_ms, 'max': max_ms, 'zero': zero}
+    return db.session.query(SearchQuery.kind, SearchQuery.query, searches, avg_ms, max_ms, zero).filter(
+        SearchQuery.day >= since).group_by(SearchQuery.kind, SearchQuery.query).order_by(
+        orders.get(order, searches).desc(), SearchQuery.query).limit(limit).all()
+
+
+def warm(top=50, days=7):
+    """Runs the first page of the `top` most frequent searches of the last `days` days into the search cache.
+
+    Returns the number of searches run.
+    """
+    from app.search import search_page, search_request
+    count = 0
+    for kind, query, *_ in top_queries(days, top):
+        es_query, text = search_request(kind, query)
+        search_page('review', es_query, 1, current_app.config['POSTS_PER_PAGE'], 'rel', text)
+        count += 1
+    return count
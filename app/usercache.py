@@ -0,0 +1,80 @@
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+
+from app.cache import make_backend, snapshot, detached, CacheStats
+
+
+class UserCache:
+    """Per-worker cache of `User` rows for `load_user`, so logged-in requests skip the user query.
+
+    Entries expire after `USER_CACHE_TTL` seconds. Commits that change a user's columns or delete a user
+    (profile edits, password resets, the admin `UserView`) evict it from this worker straight away.
+
+    A hit is a detached copy, so a later `User.query` in the same request still loads the current row rather
+    than getting the cached one back from the identity map. Views that change the user load it with
+    `session_user`.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = make_backend(app.config['USER_CACHE_BACKEND'], maxsize=app.config['USER_CACHE_SIZE'],
+                               timeout=app.config['USER_CACHE_TTL'])
+        app.extensions['user_cache'] = (backend, CacheStats())
+
+        from app import db
+        if not event.contains(db.session, 'after_commit', evict_users):
+            event.listen(db.session, 'after_flush', collect_users)
+            event.listen(db.session, 'after_commit', evict_users)
+            event.listen(db.session, 'after_rollback', discard_users)
+
+    @property
+    def stats(self):
+        return current_app.extensions['user_cache'][1]
+
+    def get(self, id):
+        """The user with `id`, detached on a cache hit, or None if there is no such user."""
+        from app.models import User
+        backend, stats = current_app.extensions['user_cache']
+        values = backend.get(id)
+        if values is not None:
+            stats.hits += 1
+            return detached(User, values)
+        stats.misses += 1
+        user = User.query.get(id)
+        if user is not None:
+            backend.set(id, snapshot(user))
+        return user
+
+    def evict(self, id):
+        current_app.extensions['user_cache'][0].delete(id)
+
+
+def session_user():
+    """The logged-in user loaded in the current session, for views that change it or its relationships."""
+    from flask_login import current_user
+    from app.models import User
+    return User.query.get(current_user.id)
+
+
+def collect_users(session, flush_context):
+    ids = session.info.setdefault('evict_users', set())
+    for obj in session.dirty:
+        if getattr(obj, '__tablename__', None) == 'user':
+            attrs = inspect(obj).attrs
+            if any(attrs[attr.key].history.has_changes() for attr in inspect(obj).mapper.column_attrs):
+                ids.add(obj.id)
+    ids.update(obj.id for obj in session.deleted if getattr(obj, '__tablename__', None) == 'user')
+
+
+def evict_users(session):
+    ids = session.info.pop('evict_users', None)
+    if ids and has_app_context() and 'user_cache' in current_app.extensions:
+        backend = current_app.extensions['user_cache'][0]
+        for id in ids:
+            backend.delete(id)
+
+
+def discard_users(session):
+    session.info.pop('evict_users', None)
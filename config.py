@@ -12,13 +12,121 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Werkzeug hash method, e.g. 'pbkdf2:sha256:260000'. Existing hashes are upgraded on login. The
+    # password_hash column fits sha256 digests; `flask bench passwords` measures the cost of each setting
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 16
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # Email is sent by MAIL_WORKERS threads from a queue of at most MAIL_QUEUE_SIZE messages (0 sends inline)
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+    MAIL_QUEUE_TIMEOUT = 5
+    MAIL_BATCH_SIZE = 20
+    MAIL_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 1
+    MAIL_IDLE_TIMEOUT = 30
     ADMINS = ['']
+    # The /admin views, off unless asked for so the CLI and tests start without Flask-Admin. gunicorn.conf.py
+    # turns them on for the web process, set ADMIN_ENABLED=true to get them under `flask run`
+    ADMIN_ENABLED = os.environ.get('ADMIN_ENABLED', 'false').lower() == 'true'
     POSTS_PER_PAGE = 8
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_REQUESTS = os.environ.get('LOG_REQUESTS', 'true').lower() != 'false'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_QUEUE_SIZE = 10000
+    # Set JOB_WORKER when `flask worker` runs; otherwise jobs run in the process that queues them
+    JOB_WORKER = os.environ.get('JOB_WORKER') is not None
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_BACKOFF = 10
+    JOB_POLL_INTERVAL = 1
+    # Running jobs mark themselves alive every JOB_HEARTBEAT_INTERVAL seconds; one silent for JOB_TIMEOUT seconds
+    # lost its worker and is queued again
+    JOB_HEARTBEAT_INTERVAL = 30
+    JOB_TIMEOUT = 120
+    # Workers look for lost jobs and delete those done more than JOB_KEEP_DAYS ago this often, in seconds
+    JOB_MAINTENANCE_INTERVAL = 300
+    JOB_KEEP_DAYS = 7
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() != 'false'
+    # Shared by all worker processes, e.g. a tmpfs; without it /metrics only covers the process answering
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5
+    # Scrapers must send `Authorization: Bearer <token>`; without one /metrics is only served in debug or testing
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Share of requests profiled; others can be with the token shown in the admin Profiler view
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_INTERVAL = 0.005
+    PROFILE_MAX_STACKS = 2000
+    PROFILE_TOKEN_MAX_AGE = 3600
+    # Number of proxies in front of the app whose X-Forwarded-For and X-Forwarded-Proto are trusted, e.g. 1 on
+    # Heroku or behind one nginx. Clients are rate limited by the address they give
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+    # Token buckets as (tokens per second, burst) per endpoint, optionally for one method only
+    RATELIMIT_ENABLED = True
+    RATELIMIT_BACKEND = os.environ.get('RATELIMIT_BACKEND') or 'memory'
+    RATELIMIT_REDIS_URL = os.environ.get('RATELIMIT_REDIS_URL') or 'redis://localhost:6379/0'
+    RATELIMIT_RULES = {
+        'main.search': (1, 10),
+        'main.adv_search': (0.5, 5),
+        'api.search': (1, 10),
+        'main.whisky_popup': (5, 30),
+        'main.whisky_popups': (1, 10),
+        'POST main.submit_review': (0.1, 5),
+        'POST main.edit_review': (0.2, 10),
+        'POST main.add_whisky': (0.1, 5),
+        'POST main.add_distillery': (0.1, 5),
+        'POST auth.login': (0.2, 10),
+        'POST auth.register': (0.05, 3),
+        'POST auth.reset_password_request': (0.05, 3),
+    }
+    # Requests in flight per worker for endpoints sharing a resource, as (limit, endpoints). Keep the search
+    # limit below the Elasticsearch connection pool size (10 by default)
+    RATELIMIT_CONCURRENCY = {
+        'elasticsearch': (8, ['main.search', 'main.adv_search', 'api.search']),
+    }
+    # Each distinct error is emailed at most once per LOG_MAIL_INTERVAL seconds, and at most LOG_MAIL_LIMIT
+    # error emails are sent per interval
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 300)
+    LOG_MAIL_LIMIT = int(os.environ.get('LOG_MAIL_LIMIT') or 10)
     LANGUAGES = ['en', 'ja']
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # Search results pages show whatever parts (hits, tag counts, corrections) came back within this many seconds
+    SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT') or 1)
+    SEARCH_WORKERS = 16
+    # Complete result pages are cached for SEARCH_CACHE_TIMEOUT seconds
+    SEARCH_CACHE_BACKEND = os.environ.get('SEARCH_CACHE_BACKEND') or 'lru'
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TIMEOUT = int(os.environ.get('SEARCH_CACHE_TIMEOUT') or 60)
+    # Searches are counted per normalized query and day, and written in batches every SEARCH_LOG_FLUSH_INTERVAL
+    # seconds. Run this many of the most frequent ones into the search cache before gunicorn forks its workers
+    SEARCH_LOG_ENABLED = os.environ.get('SEARCH_LOG_ENABLED', 'true').lower() != 'false'
+    SEARCH_LOG_FLUSH_INTERVAL = 5
+    SEARCH_LOG_QUEUE_SIZE = 10000
+    SEARCH_LOG_DAYS = 30
+    SEARCH_WARM_TOP = int(os.environ.get('SEARCH_WARM_TOP') or 0)
+    # Reviews are indexed into yearly partitions, whose list each process looks up again at this interval
+    SEARCH_PARTITION_CHECK_INTERVAL = 60
+    RECOMMEND_NEIGHBOURS = 50
+    RECOMMENDATIONS_PER_USER = 10
+    SLOW_REQUEST_THRESHOLD = int(os.environ.get('SLOW_REQUEST_THRESHOLD') or 500)
+    SLOW_QUERY_COUNT = 3
+    QUERY_REPEAT_THRESHOLD = 5
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'lru'
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    API_MAX_LIMIT = 100
+    POPUP_BATCH_LIMIT = 1000
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND') or 'lru'
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE') or 1000)
+    PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT') or 60)
+    PAGE_CACHE_ENDPOINTS = ['main.home', 'main.explore', 'main.whisky_list', 'main.whisky', 'main.distillery']
+    # Seconds between checks of the `catalog` stamp by each worker's catalog cache
+    CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL') or 1)
+    USER_CACHE_BACKEND = os.environ.get('USER_CACHE_BACKEND') or 'lru'
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)
+    # Directory for locally generated identicons; avatars come from gravatar.com when unset
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR')
@@ -0,0 +1,34 @@
+"""Production settings for `gunicorn -c gunicorn.conf.py whisky:app`, see app/prefork.py."""
+
+import os
+
+
+# The web process serves the /admin views unless ADMIN_ENABLED=false, see config.py
+os.environ.setdefault('ADMIN_ENABLED', 'true')
+
+bind = os.environ.get('GUNICORN_BIND') or ':5000'
+# gunicorn's own default of one worker; set WEB_CONCURRENCY, e.g. to 2 * cores + 1, to serve more requests at once
+workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+threads = int(os.environ.get('GUNICORN_THREADS') or 1)
+# Load the app once in the master and fork the workers from it
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() != 'false'
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    from app.prefork import clear_metrics
+    clear_metrics(os.environ.get('METRICS_DIR'))
+
+
+def when_ready(server):
+    # Runs in the master once the app is loaded and before the first worker is forked
+    if server.cfg.preload_app:
+        from app.prefork import prepare
+        prepare(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app.prefork import after_fork
+        after_fork(worker.app.wsgi())
@@ -1,14 +1,59 @@
+import gc
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta
+from logging.handlers import QueueListener
 
-from app import create_app, db
-from app.models import User, Review, Tag, Whisky, Distillery
+from aiosmtpd.controller import Controller
+from elasticsearch import Elasticsearch, TransportError
+
+from flask import url_for
+
+from app import create_app, db, fragment_cache, assets, page_cache, catalog, user_cache, mail, \
+    mail_pool, profiler, search_cache, search_log
+from app.api.serialize import encode_cursor
+from app.assets import build as build_assets
+from app.avatars import email_hash, avatar_urls
+from app.bench import generate, route_latency, search_latency, startup_time, imported_packages
+from app import mailpool
+from app.email import send_email, build_message
+from app.fakees import FakeElasticsearch
+from app.jobs import enqueue, tasks, work, requeue_stale, purge_done
+from app.logs import BoundedQueueHandler, RequestContextFilter, JSONFormatter, ThrottledSMTPHandler, stop_listener
+from app.main.forms import AddDistilleryForm
+from app.main.info import all_tags
+from app.models import User, Review, Tag, Whisky, Distillery, Job
+from app.prefork import prepare, after_fork, clear_metrics
+from app.querystats import record_queries
+from app.ratelimit import MemoryBuckets
+from app.recommend import build_recommendations, load_interactions
+from app.searchlog import top_queries, warm
+from app.search import insert_mapping, query_index, query_advanced, parse_query, simple_query, search_page, \
+    optimize, normalize_query, rebuild, index_document, IndexingError, fan_out
 from config import Config
 
+# Apps the tests start in other processes log to stdout rather than to logs/ in the working directory
+os.environ['LOG_TO_STDOUT'] = '1'
+
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    PAGE_CACHE_BACKEND = 'null'
+    SEARCH_CACHE_BACKEND = 'null'
+    SEARCH_LOG_ENABLED = False
+    ADMIN_ENABLED = False
 
 
 class UserModelCase(unittest.TestCase):
@@ -29,11 +74,55 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        self.app.config.update(WTF_CSRF_ENABLED=False, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertFalse(u.password_needs_rehash())
+
+        # Raising the cost upgrades the stored hash on the next successful login
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertTrue(u.password_needs_rehash())
+        self.app.test_client().post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertTrue(User.query.get(u.id).password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128),
                          ('https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=identicon&s=128'))
 
+    def test_avatar_hash(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u1.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u1.email = 'John@Example.org'
+        self.assertEqual(u1.avatar_hash, email_hash('john@example.org'))
+        self.assertEqual(avatar_urls([u1, u2], 70), {u1.id: u1.avatar(70), u2.id: u2.avatar(70)})
+
+        # With a local avatar directory, identicons are drawn and served by the app itself
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['AVATAR_CACHE_DIR'] = directory
+        with self.app.test_request_context():
+            url = u2.avatar(70)
+        self.assertEqual(url, f'/avatar/{u2.avatar_hash}/70')
+        response = self.app.test_client().get(url)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+        self.assertTrue(os.path.exists(os.path.join(directory, f'{u2.avatar_hash}-70.png')))
+        response.close()
+        client = self.app.test_client()
+        self.assertEqual(client.get('/avatar/nothex/70').status_code, 404)
+        # Only digests of registered users and the sizes the templates use are drawn
+        self.assertEqual(client.get(f'/avatar/{email_hash("nobody@example.com")}/70').status_code, 404)
+        self.assertEqual(client.get(f'/avatar/{u2.avatar_hash}/71').status_code, 404)
+        self.assertEqual(sorted(os.listdir(directory)), [f'{u2.avatar_hash}-70.png'])
+
     def test_models(self):
         user = User(username='john', email='john@example.com')
         dist1 = Distillery(name='TestDistillery')
@@ -86,5 +175,1251 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(user.has_whisky(whisky1))
 
 
+class RecommendationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_build_recommendations(self):
+        dist = Distillery(name='TestDistillery')
+        w1, w2, w3 = (Whisky(name=f'Whisky {i}', distillery=dist) for i in range(3))
+        u1, u2, u3 = (User(username=f'user{i}', email=f'user{i}@example.com') for i in range(3))
+        db.session.add_all([dist, w1, w2, w3, u1, u2, u3])
+        db.session.commit()
+        u1.add_whisky(w1)
+        u1.add_whisky(w2)
+        u2.add_whisky(w1)
+        u2.add_whisky(w2)
+        u2.add_whisky(w3)
+        db.session.add(Review(score=90, author=u3, whisky=w1))
+        db.session.commit()
+
+        self.assertEqual(build_recommendations(), 3)
+        self.assertEqual(u1.get_recommendations(), [w3])
+        self.assertEqual(u2.get_recommendations(), [])
+        self.assertEqual(u3.get_recommendations()[0], w2)
+
+        # Whiskies listed after the build are no longer suggested
+        u1.add_whisky(w3)
+        db.session.commit()
+        self.assertEqual(u1.get_recommendations(), [])
+
+    def test_load_interactions(self):
+        dist = Distillery(name='TestDistillery')
+        w1, w2 = Whisky(name='Whisky 1', distillery=dist), Whisky(name='Whisky 2', distillery=dist)
+        u1, u2 = User(username='user1', email='user1@example.com'), User(username='user2', email='user2@example.com')
+        db.session.add_all([dist, w1, w2, u1, u2])
+        db.session.commit()
+        u1.add_whisky(w1)
+        u2.add_whisky(w1)
+        db.session.add_all([Review(score=100, author=u1, whisky=w1), Review(score=0, author=u2, whisky=w2)])
+        db.session.commit()
+
+        # Lists and reviews come from a single streamed query
+        with record_queries() as record:
+            user_items, item_users = load_interactions(batch_size=1)
+        self.assertEqual(record.count, 1)
+        self.assertEqual({u: (list(i), list(w)) for u, (i, w) in user_items.items()},
+                         {u1.id: ([w1.id], [1.0]), u2.id: ([w1.id, w2.id], [1.0, 0.5])})
+        self.assertEqual(list(item_users[w1.id][0]), [u1.id, u2.id])
+
+
+class QueryBudgetCase(unittest.TestCase):
+    # Maximum number of queries each page may issue for the fixture below
+    budgets = {'main.explore': 8, 'main.whisky': 5, 'main.whisky_list': 1}
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        user = User(username='john', email='john@example.com')
+        dists = [Distillery(name='TestDistillery'), Distillery(name='OtherDistillery')]
+        whiskies = [Whisky(name=f'Whisky {i}', distillery=dists[i % 2]) for i in range(4)]
+        tag = Tag(name='Sweet')
+        db.session.add_all([user, tag] + dists + whiskies)
+        for i in range(6):
+            db.session.add(Review(nose='nose', palate='palate', finish='finish', score=80, author=user,
+                                  whisky=whiskies[i % 2], tags=[tag]))
+        db.session.commit()
+        self.whisky_id = whiskies[0].id
+        # Workers serve nearly every request from a warm catalog
+        catalog.distilleries()
+        catalog.whisky(self.whisky_id)
+        # Start every request from an empty identity map, as a real request would
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertQueryBudget(self, endpoint, **values):
+        with self.app.test_request_context():
+            url = url_for(endpoint, **values)
+        with record_queries() as record:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(record.count, self.budgets[endpoint],
+                             f'{endpoint} issued {record.count} queries: {record.repeated(2)}')
+
+    def test_explore(self):
+        self.assertQueryBudget('main.explore')
+
+    def test_whisky(self):
+        self.assertQueryBudget('main.whisky', id=self.whisky_id)
+
+    def test_whisky_list(self):
+        self.assertQueryBudget('main.whisky_list')
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_review_rows(self):
+        user = User(username='john', email='john@example.com')
+        whisky = Whisky(name='TestWhisky', distillery=Distillery(name='TestDistillery'))
+        review = Review(nose='Smoky', palate='palate', finish='finish', score=80, author=user, whisky=whisky)
+        db.session.add_all([user, whisky, review])
+        db.session.commit()
+
+        self.assertIn(b'Smoky', self.client.get('/explore').data)
+        self.assertEqual(fragment_cache.stats.misses, 1)
+        self.assertIn(b'Smoky', self.client.get('/explore').data)
+        self.assertEqual(fragment_cache.stats.hits, 1)
+
+        # Editing the review or renaming its whisky renders the row again
+        review.nose = 'Peaty'
+        db.session.commit()
+        self.assertIn(b'Peaty', self.client.get('/explore').data)
+        whisky.name = 'RenamedWhisky'
+        db.session.commit()
+        self.assertIn(b'RenamedWhisky', self.client.get('/explore').data)
+        self.assertEqual(fragment_cache.stats.misses, 3)
+
+        # So does a new avatar after the author changes their email
+        user.email = 'john@example.org'
+        db.session.commit()
+        self.assertIn(user.avatar_hash.encode(), self.client.get('/explore').data)
+        self.assertEqual(fragment_cache.stats.misses, 4)
+
+        # And renaming one of its tags
+        tag = Tag(name='Smoky')
+        review.tags.append(tag)
+        db.session.commit()
+        self.assertIn(b'Smoky', self.client.get('/explore').data)
+        tag.name = 'Peated'
+        db.session.commit()
+        self.assertIn(b'Peated', self.client.get('/explore').data)
+        self.assertEqual(fragment_cache.stats.misses, 6)
+
+    def test_distillery_cards(self):
+        dist = Distillery(name='TestDistillery')
+        db.session.add(dist)
+        db.session.commit()
+        self.client.get('/whisky_list')
+        with record_queries() as record:
+            self.client.get('/whisky_list')
+        # Only the catalog stamp is queried, the distillery list comes from the catalog
+        self.assertEqual(record.count, 1)
+
+        db.session.add(Whisky(name='NewWhisky', distillery=dist))
+        db.session.commit()
+        self.assertIn(b'NewWhisky', self.client.get('/whisky_list').data)
+
+
+class WhiskyPopupCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_batch_popups(self):
+        user = User(username='john', email='john@example.com')
+        whiskies = [Whisky(name=f'Whisky {i}') for i in range(3)]
+        db.session.add_all([user] + whiskies)
+        for i in range(3):
+            db.session.add(Review(score=80, author=user, whisky=whiskies[i % 2]))
+        db.session.commit()
+        ids = [w.id for w in whiskies]
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+        db.session.remove()
+
+        with record_queries() as record:
+            response = self.client.get('/whisky_popups?ids=' + ','.join(map(str, ids)))
+        self.assertEqual(response.get_json()['messages'], {
+            str(ids[0]): 'There are 2 reviews.', str(ids[1]): 'There is 1 review.',
+            str(ids[2]): 'There are no reviews.'})
+        # Loading the user and one grouped count
+        self.assertEqual(record.count, 2)
+        self.assertEqual(self.client.get('/whisky_popups?ids=x').status_code, 400)
+
+        # Pages ask for at most the limit of ids per request
+        self.app.config['POPUP_BATCH_LIMIT'] = 2
+        self.assertEqual(self.client.get('/whisky_popups?ids=' + ','.join(map(str, ids))).status_code, 400)
+        self.assertIn(b'var limit = 2;', self.client.get('/whisky_list').data)
+
+
+class UserCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_load_user(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+        db.session.remove()
+
+        self.client.get('/edit_profile')
+        with record_queries() as record:
+            self.assertIn(b'john', self.client.get('/edit_profile').data)
+        self.assertEqual(record.count, 0)
+        self.assertEqual(user_cache.stats.hits, 1)
+
+        # Editing the profile evicts the cached row
+        self.client.post('/edit_profile', data={'username': 'jane', 'about_me': ''})
+        self.assertIn(b'jane', self.client.get('/edit_profile').data)
+        self.assertEqual(user_cache.stats.misses, 2)
+
+    def test_cached_user_is_detached(self):
+        user = User(username='john', email='john@example.com')
+        wsk = Whisky(name='16', distillery=Distillery(name='Lagavulin'))
+        db.session.add_all([user, wsk])
+        db.session.commit()
+        user_id, wsk_id = user.id, wsk.id
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user_id)
+        db.session.remove()
+        self.client.get('/edit_profile')
+
+        # Another worker's edit doesn't evict this worker's entry, the profile page still loads the fresh row
+        db.session.execute(User.__table__.update().values(about_me='Peat lover'))
+        db.session.commit()
+        db.session.remove()
+        self.assertIn(b'Peat lover', self.client.get('/user/john').data)
+        self.assertEqual(user_cache.stats.hits, 1)
+
+        self.client.get(f'/whisky/{wsk_id}/tried')
+        self.assertEqual([w.name for w in User.query.get(user_id).get_whiskies_listed()], ['16'])
+        self.assertIn(b'Liked!', self.client.get(f'/whisky/{wsk_id}').data)
+
+
+class MailPoolCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['MAIL_WORKERS'] = 1
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app.extensions['mail_pool'].stop(timeout=5)
+        self.app_context.pop()
+
+    def send(self, count):
+        for i in range(count):
+            self.assertTrue(send_email(f'Test {i}', sender='admin@example.com', recipients=['john@example.com'],
+                                       text_body='text', html_body='<p>html</p>'))
+        mail_pool.join()
+
+    def test_queue(self):
+        with mail.record_messages() as outbox:
+            self.send(5)
+        self.assertEqual([msg.subject for msg in outbox], [f'Test {i}' for i in range(5)])
+        self.assertEqual(mail_pool.stats.sent, 5)
+        self.assertEqual(mail_pool.depth, 0)
+
+    def test_exit_flushes_every_pool(self):
+        # One exit hook stops the pools of every app, which it only holds weakly
+        self.assertIn(create_app(TestConfig).extensions['mail_pool'], mailpool._pools)
+        with mail.record_messages() as outbox:
+            mail_pool.submit(build_message('Bye', 'admin@example.com', ['john@example.com'], 'text', '<p>html</p>'))
+            mailpool._stop_all()
+        self.assertEqual([msg.subject for msg in outbox], ['Bye'])
+
+    def test_smtp_connection_reuse(self):
+        received = []
+
+        class Handler:
+            async def handle_DATA(self, server, session, envelope):
+                received.append(envelope)
+                return '250 OK'
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        controller = Controller(Handler(), hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_SUPPRESS_SEND=False)
+        mail.init_app(self.app)
+
+        self.send(5)
+        self.assertEqual(len(received), 5)
+        self.assertEqual(received[0].rcpt_tos, ['john@example.com'])
+        self.assertEqual(mail_pool.stats.connections, 1)
+
+
+class LoggingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_json_records(self):
+        handler = BoundedQueueHandler(10)
+        handler.addFilter(RequestContextFilter())
+        with self.app.test_request_context('/explore', headers={'X-Request-ID': 'abc123'}):
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                handler.handle(logging.makeLogRecord({'msg': 'Failed %s', 'args': ('here',), 'levelname': 'ERROR',
+                                                      'exc_info': sys.exc_info()}))
+        entry = json.loads(JSONFormatter().format(handler.queue.get_nowait()))
+        self.assertEqual(entry['message'], 'Failed here')
+        self.assertEqual(entry['request_id'], 'abc123')
+        self.assertEqual(entry['path'], '/explore')
+        self.assertIn('es_ms', entry)
+        self.assertIn('ZeroDivisionError', entry['exception'])
+        self.assertEqual(self.app.test_client().get('/', headers={'X-Request-ID': 'xyz'}).headers['X-Request-ID'],
+                         'xyz')
+
+    def test_error_emails_are_throttled(self):
+        received = []
+
+        class Handler:
+            async def handle_DATA(self, server, session, envelope):
+                received.append(envelope.content.decode('utf-8'))
+                return '250 OK'
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        controller = Controller(Handler(), hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+
+        # Through the queue and listener, the way the app logs
+        handler = ThrottledSMTPHandler(('127.0.0.1', port), 'app@example.com', ['admin@example.com'], 'Failure',
+                                       interval=60, limit=2)
+        queue_handler = BoundedQueueHandler(100)
+        listener = QueueListener(queue_handler.queue, handler)
+        logger = logging.getLogger('tests.throttle')
+        logger.propagate = False
+        logger.addHandler(queue_handler)
+        self.addCleanup(logger.removeHandler, queue_handler)
+
+        def storm(i):
+            logger.error('Storm %d', i)
+        listener.start()
+        for i in range(5):
+            storm(i)
+        logger.error('Other error')
+        logger.error('Third error')
+        listener.stop()
+        # The repeats and the error over the limit are suppressed
+        self.assertEqual(len(received), 2)
+        self.assertIn('Storm 0', received[0])
+        handler.last_sent.clear()
+        handler.window = (float('-inf'), 0)
+        listener.start()
+        storm(5)
+        listener.stop()
+        self.assertIn('Storm 5', received[-1])
+        self.assertIn('4 similar errors', received[-1])
+
+
+class RateLimitConfig(TestConfig):
+    RATELIMIT_RULES = {'main.search': (0.01, 2), 'POST auth.login': (0.01, 1)}
+    RATELIMIT_CONCURRENCY = {'elasticsearch': (1, ['main.search'])}
+
+
+class ProxiedRateLimitConfig(RateLimitConfig):
+    TRUSTED_PROXIES = 1
+
+
+class RateLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(RateLimitConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_token_bucket(self):
+        self.assertEqual(self.client.get('/search?q=peat').status_code, 200)
+        self.assertEqual(self.client.get('/search?q=peat').status_code, 200)
+        response = self.client.get('/search?q=peat')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 1)
+        # Rules restricted to a method leave the other methods alone
+        for _ in range(3):
+            self.assertEqual(self.client.get('/auth/login').status_code, 200)
+        self.client.post('/auth/login')
+        self.assertEqual(self.client.post('/auth/login').status_code, 429)
+
+    def test_concurrency_cap(self):
+        state = self.app.extensions['ratelimit']
+        state['active']['elasticsearch'] = 1
+        response = self.client.get('/search?q=peat')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        state['active']['elasticsearch'] = 0
+        self.assertEqual(self.client.get('/search?q=peat').status_code, 200)
+        # The slot is given back once the request is done
+        self.assertEqual(state['active']['elasticsearch'], 0)
+        self.assertEqual(state['shed'], 1)
+
+    def test_bucket_count_is_bounded(self):
+        buckets = MemoryBuckets(maxsize=100)
+        for i in range(1000):
+            self.assertEqual(buckets.take(f'ip:{i}', 1, 10), 0)
+            self.assertLessEqual(len(buckets._buckets), 100)
+        # The most recent clients keep their buckets
+        self.assertIn('ip:999', buckets._buckets)
+
+    def test_trusted_proxies(self):
+        headers = {'X-Forwarded-For': '203.0.113.7'}
+        self.assertEqual(self.client.get('/search?q=peat', headers=headers).status_code, 200)
+        self.assertEqual(self.client.get('/search?q=peat', headers=headers).status_code, 200)
+        # Behind a proxy every client has its own bucket, rather than sharing the proxy's
+        app = create_app(ProxiedRateLimitConfig)
+        with app.app_context():
+            client = app.test_client()
+            for address in ('203.0.113.7', '203.0.113.7', '203.0.113.8'):
+                self.assertEqual(client.get('/search?q=peat', headers={'X-Forwarded-For': address}).status_code,
+                                 200)
+            self.assertEqual(client.get('/search?q=peat', headers=headers).status_code, 429)
+
+
+class PageCacheConfig(TestConfig):
+    PAGE_CACHE_BACKEND = 'lru'
+
+
+class PageCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(PageCacheConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_anonymous_pages(self):
+        user = User(username='john', email='john@example.com')
+        whisky = Whisky(name='TestWhisky', distillery=Distillery(name='TestDistillery'))
+        other = Whisky(name='OtherWhisky', distillery=Distillery(name='OtherDistillery'))
+        db.session.add_all([user, whisky, other])
+        db.session.commit()
+        whisky_url, other_url = f'/whisky/{whisky.id}', f'/whisky/{other.id}'
+
+        self.client.get(whisky_url)
+        self.client.get(other_url)
+        with record_queries() as record:
+            self.assertIn(b'TestWhisky', self.client.get(whisky_url).data)
+        self.assertEqual(record.count, 0)
+        self.assertEqual(page_cache.stats.hits, 1)
+
+        # A review only invalidates the page of its whisky
+        db.session.add(Review(nose='Smoky', score=80, author=user, whisky=whisky))
+        db.session.commit()
+        self.assertIn(b'Smoky', self.client.get(whisky_url).data)
+        self.client.get(other_url)
+        self.assertEqual(page_cache.stats.hits, 2)
+
+        # Moving a whisky invalidates the pages of both distilleries
+        old_url, new_url = f'/distillery/{whisky.distillery_id}', f'/distillery/{other.distillery_id}'
+        self.client.get(old_url)
+        self.client.get(new_url)
+        whisky.distillery = other.distillery
+        db.session.commit()
+        self.assertNotIn(b'TestWhisky', self.client.get(old_url).data)
+        self.assertIn(b'TestWhisky', self.client.get(new_url).data)
+        self.assertEqual(page_cache.stats.hits, 2)
+
+        # So does an email change, which changes the avatar on review rows
+        self.client.get(whisky_url)
+        user.email = 'jane@example.com'
+        db.session.commit()
+        self.assertIn(email_hash('jane@example.com').encode(), self.client.get(whisky_url).data)
+        self.assertEqual(page_cache.stats.hits, 2)
+
+        # Logged in users are never served from the cache
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+        self.client.get(other_url)
+        self.assertEqual(page_cache.stats.hits, 2)
+
+
+class CatalogCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lookups(self):
+        dist = Distillery(name='TestDistillery')
+        whisky = Whisky(name='TestWhisky', distillery=dist)
+        db.session.add(whisky)
+        db.session.commit()
+        whisky_id, dist_id = whisky.id, dist.id
+        for name in ('TestDistillery', 'NewDistillery'):
+            catalog.distillery_id(name)
+        catalog.whisky(whisky_id)
+        catalog.whisky(12345)
+        db.session.remove()
+
+        # Warm lookups, including misses, are answered without touching the database
+        with record_queries() as record:
+            wsk = catalog.whisky(whisky_id)
+            self.assertEqual(wsk.distillery.name, 'TestDistillery')
+            self.assertEqual(catalog.distillery_id('TestDistillery'), dist_id)
+            self.assertIsNone(catalog.distillery_id('NewDistillery'))
+            self.assertIsNone(catalog.whisky('12345'))
+            self.assertIn('TestDistillery', repr(wsk))
+        self.assertEqual(record.count, 0)
+
+        # Commits in this process drop the catalog straight away
+        db.session.add(Distillery(name='NewDistillery'))
+        db.session.commit()
+        self.assertIsNotNone(catalog.distillery_id('NewDistillery'))
+
+        # Other processes' changes are seen once the stamp is checked again
+        self.app.config['CATALOG_CHECK_INTERVAL'] = 0
+        db.engine.execute(Whisky.__table__.update().values(name='RenamedWhisky'))
+        db.engine.execute("UPDATE stamp SET version = version + 1 WHERE name = 'catalog'")
+        db.session.remove()
+        self.assertEqual(catalog.whisky(whisky_id).name, 'RenamedWhisky')
+
+
+class ConditionalGetCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_etag(self):
+        dist = Distillery(name='TestDistillery')
+        db.session.add(dist)
+        db.session.commit()
+
+        response = self.client.get('/whisky_list')
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        with record_queries() as record:
+            response = self.client.get('/whisky_list', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(record.count, 1)
+        response = self.client.get('/whisky_list', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # Any catalog change produces a new validator
+        db.session.add(Whisky(name='TestWhisky', distillery=dist))
+        db.session.commit()
+        response = self.client.get('/whisky_list', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_body_matches_etag(self):
+        # The page cache keeps whole responses, ETag included, so it is left out here
+        self.app.config.update(CATALOG_CHECK_INTERVAL=3600, PAGE_CACHE_ENDPOINTS=())
+        dist = Distillery(name='TestDistillery')
+        db.session.add(Whisky(name='TestWhisky', distillery=dist))
+        db.session.commit()
+        etag = self.client.get('/whisky_list').headers['ETag']
+
+        # Another process renames the whisky: the new ETag comes with the new name, not the cached one
+        db.engine.execute(Whisky.__table__.update().values(name='RenamedWhisky', version=Whisky.version + 1))
+        db.engine.execute(Distillery.__table__.update().values(version=Distillery.version + 1))
+        db.engine.execute("UPDATE stamp SET version = version + 1 WHERE name = 'catalog'")
+        db.session.remove()
+        response = self.client.get('/whisky_list', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'RenamedWhisky', response.data)
+
+        # Nor does a cached miss let a duplicate distillery through
+        self.assertIsNone(catalog.distillery_id('Bowmore'))
+        db.engine.execute(Distillery.__table__.insert().values(name='Bowmore'))
+        db.engine.execute("UPDATE stamp SET version = version + 1 WHERE name = 'catalog'")
+        with self.app.test_request_context(method='POST', data={'name': 'bowmore', 'region': 'Islay'}):
+            form = AddDistilleryForm(meta={'csrf': False})
+            form.validate()
+            self.assertIn('name', form.errors)
+
+    def test_missing_whisky(self):
+        self.assertEqual(self.client.get('/whisky/1').status_code, 404)
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_reviews(self):
+        user = User(username='john', email='john@example.com')
+        whisky = Whisky(name='TestWhisky', distillery=Distillery(name='TestDistillery'))
+        tag = Tag(name='Sweet')
+        db.session.add_all([user, whisky, tag])
+        for i in range(5):
+            db.session.add(Review(nose=f'Review {i}', score=80, author=user, whisky=whisky, tags=[tag],
+                                  timestamp=datetime(2019, 1, 1 + i)))
+        db.session.commit()
+
+        response = self.client.get('/api/v1/reviews?limit=3&fields=nose,author,distillery,tags')
+        data = response.get_json()
+        self.assertEqual(data['items'][0], {'nose': 'Review 4', 'author': 'john', 'distillery': 'TestDistillery',
+                                            'tags': ['Sweet']})
+        self.assertEqual(len(data['items']), 3)
+        data = self.client.get('/api/v1/reviews?limit=3&fields=nose&cursor=' + data['next']).get_json()
+        self.assertEqual([r['nose'] for r in data['items']], ['Review 1', 'Review 0'])
+        self.assertIsNone(data['next'])
+
+        self.assertEqual(self.client.get('/api/v1/reviews?fields=password').status_code, 400)
+        response = self.client.get('/api/v1/reviews/100')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error'], 'Not Found')
+
+    def test_distilleries(self):
+        db.session.add_all([Distillery(name=f'Distillery {i}', location='Islay') for i in range(3)])
+        db.session.commit()
+        data = self.client.get('/api/v1/distilleries?limit=2&fields=id,name').get_json()
+        self.assertEqual(data['items'], [{'id': 1, 'name': 'Distillery 0'}, {'id': 2, 'name': 'Distillery 1'}])
+        data = self.client.get('/api/v1/distilleries?limit=2&cursor=' + data['next']).get_json()
+        self.assertEqual(data['items'][0]['location'], 'Islay')
+        self.assertIsNone(data['next'])
+
+    def test_malformed_cursors(self):
+        for url, cursor in (('/api/v1/reviews', encode_cursor(1, 2)), ('/api/v1/reviews', encode_cursor('x', 'y')),
+                            ('/api/v1/reviews', encode_cursor('2019-01-01T00:00:00Z')),
+                            ('/api/v1/distilleries', encode_cursor({'id': 1})),
+                            ('/api/v1/distilleries', encode_cursor(True)), ('/api/v1/distilleries', 'bm90IGpzb24='),
+                            ('/api/v1/search', encode_cursor('2')), ('/api/v1/search', encode_cursor(0))):
+            response = self.client.get(f'{url}?cursor={cursor}')
+            self.assertEqual(response.status_code, 400, (url, cursor))
+            self.assertEqual(response.get_json()['message'], 'Malformed cursor')
+
+
+class AssetsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.static_folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_folder, 'vendor', 'fonts'))
+        with open(os.path.join(self.static_folder, 'style.css'), 'w') as f:
+            f.write('body { background: url("./swirl.png"); }' * 20)
+        with open(os.path.join(self.static_folder, 'swirl.png'), 'wb') as f:
+            f.write(b'png')
+        with open(os.path.join(self.static_folder, 'vendor', 'fonts.css'), 'w') as f:
+            f.write("@font-face { src: url(fonts/allerta.woff2); }")
+        with open(os.path.join(self.static_folder, 'vendor', 'fonts', 'allerta.woff2'), 'wb') as f:
+            f.write(b'woff2')
+
+    def tearDown(self):
+        shutil.rmtree(self.static_folder)
+        self.app_context.pop()
+
+    def test_build_and_serve(self):
+        manifest = build_assets(self.static_folder)
+        swirl, style = manifest['files']['swirl.png'], manifest['files']['style.css']
+        self.assertRegex(style, r'^build/style\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(self.static_folder, style)) as f:
+            self.assertIn(swirl[len('build/'):], f.read())
+        with open(os.path.join(self.static_folder, manifest['files']['vendor/fonts.css'])) as f:
+            self.assertIn(manifest['files']['vendor/fonts/allerta.woff2'][len('build/vendor/'):], f.read())
+
+        self.app.static_folder = self.static_folder
+        self.app.extensions['assets'] = manifest
+        with self.app.test_request_context():
+            self.assertEqual(url_for('static', filename='style.css'), '/static/' + style)
+            self.assertIn('/static/build/vendor/fonts.', assets.vendor_tag('fonts.css'))
+            self.assertIn('integrity=', assets.vendor_tag('bootstrap.min.css'))
+        response = self.app.test_client().get('/static/' + style, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn(b'swirl', gzip.decompress(response.data))
+        response.close()
+
+
+class JobCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['JOB_WORKER'] = True
+        self.app.config['JOB_RETRY_BACKOFF'] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        tasks.pop('explode', None)
+        tasks.pop('sleep', None)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_dedup_and_run(self):
+        enqueue('create_tags', dedup_key='create_tags')
+        db.session.commit()
+        enqueue('create_tags', dedup_key='create_tags')
+        db.session.commit()
+        self.assertEqual(Job.query.count(), 1)
+        self.assertEqual(Tag.query.count(), 0)
+
+        work(self.app, burst=True)
+        db.session.remove()
+        self.assertEqual(Job.query.one().status, 'done')
+        self.assertGreater(Tag.query.count(), 0)
+
+    def test_edit_then_delete(self):
+        with FakeElasticsearch() as fake:
+            self.app.elasticsearch = Elasticsearch([fake.url], max_retries=0)
+            insert_mapping('review')
+            review = Review(nose='Peat', palate='', finish='', score=90, timestamp=datetime(2020, 1, 1),
+                            author=User(username='john', email='john@example.com'),
+                            whisky=Whisky(name='Ten', distillery=Distillery(name='Ardbeg')))
+            db.session.add(review)
+            db.session.commit()
+            work(self.app, burst=True)
+            db.session.remove()
+            docs = fake.engine.indices['review-2020'].docs
+            self.assertEqual(list(docs), ['1'])
+
+            # The removal replaces the queued update, task included
+            review = Review.query.get(1)
+            review.nose = 'Peat smoke'
+            db.session.commit()
+            db.session.delete(review)
+            db.session.commit()
+            self.assertEqual(Job.query.filter_by(status='queued').one().name, 'remove_document')
+            work(self.app, burst=True)
+            db.session.remove()
+            self.assertEqual(docs, {})
+            self.assertEqual({job.status for job in Job.query}, {'done'})
+
+    def test_retry_then_fail(self):
+        tasks['explode'] = lambda: 1 / 0
+        enqueue('explode', max_attempts=2)
+        db.session.commit()
+        work(self.app, burst=True)
+        db.session.remove()
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertIn('ZeroDivisionError', job.error)
+
+    def test_heartbeat(self):
+        self.app.config['JOB_HEARTBEAT_INTERVAL'] = 0.01
+        tasks['sleep'] = lambda: time.sleep(0.2)
+        enqueue('sleep')
+        db.session.commit()
+        work(self.app, burst=True)
+        db.session.remove()
+        job = Job.query.one()
+        self.assertEqual(job.status, 'done')
+        self.assertGreater(job.heartbeat, job.started)
+
+        # A long job that still beats is left running, one whose worker went quiet is queued again
+        now = datetime.utcnow()
+        long_ago = now - timedelta(seconds=self.app.config['JOB_TIMEOUT'] * 10)
+        alive = Job(name='sleep', status='running', started=long_ago, heartbeat=now)
+        lost = Job(name='sleep', status='running', started=long_ago, heartbeat=long_ago)
+        db.session.add_all([alive, lost])
+        db.session.commit()
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual((alive.status, lost.status), ('running', 'queued'))
+
+    def test_purge_done(self):
+        old = datetime.utcnow() - timedelta(days=self.app.config['JOB_KEEP_DAYS'] + 1)
+        db.session.add_all([Job(name='create_tags', status='done', finished=old),
+                            Job(name='create_tags', status='failed', finished=old),
+                            Job(name='create_tags', status='done', finished=datetime.utcnow())])
+        db.session.commit()
+        self.assertEqual(purge_done(), 1)
+        self.assertEqual(sorted(job.status for job in Job.query), ['done', 'failed'])
+
+    def test_inline_without_worker(self):
+        self.app.config['JOB_WORKER'] = False
+        enqueue('create_tags')
+        self.assertEqual(Job.query.count(), 0)
+        self.assertGreater(Tag.query.count(), 0)
+
+
+class BenchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_generate_and_bench(self):
+        counts = generate(distilleries=5, whiskies=20, users=10, reviews=50, seed=1)
+        self.assertEqual(counts['reviews'], 50)
+        self.assertEqual(Review.query.count(), 50)
+        self.assertEqual(Tag.query.count(), len(all_tags))
+        # Generating again adds to the data instead of clashing with it
+        generate(distilleries=5, whiskies=20, users=10, reviews=50, seed=1)
+        self.assertEqual(Distillery.query.count(), 10)
+
+        report = route_latency(self.app, requests=2, warmup=1)
+        self.assertEqual(report['dataset']['review'], 100)
+        self.assertEqual(report['routes']['whisky']['statuses'], {'200': 2})
+        self.assertEqual(report['routes']['submit_review']['statuses'], {'302': 2})
+        self.assertEqual(Review.query.count(), 103)
+        self.assertTrue(self.app.config['WTF_CSRF_ENABLED'])
+
+    def test_generate_small(self):
+        # More reviews than user and whisky pairs: every pair is reviewed once, and the draws still stop
+        counts = generate(distilleries=1, whiskies=2, users=3, reviews=100, seed=1, batch_size=2)
+        self.assertEqual(counts['reviews'], 6)
+        self.assertEqual(Review.query.count(), 6)
+        self.assertEqual(Review.query.join(Review.tags).count(), counts['review_tags'])
+        user = User.query.first()
+        self.assertEqual(user.avatar_hash, email_hash(user.email))
+
+    def test_startup(self):
+        report = startup_time(runs=1, command=f'env FLASK_APP=whisky.py {sys.executable} -m flask run --port {{port}}')
+        self.assertGreater(report['import_ms'], 0)
+        self.assertIn('sqlalchemy', report['slowest_packages_ms'])
+        self.assertGreater(report['first_response_ms'], 0)
+
+
+class ImportTimeCase(unittest.TestCase):
+    def test_heavy_modules_loaded_on_first_use(self):
+        root = os.path.dirname(os.path.abspath(__file__))
+        env = {k: v for k, v in os.environ.items() if k != 'ADMIN_ENABLED'}
+        env['ELASTICSEARCH_URL'] = 'http://localhost:9200'
+        packages = imported_packages(root, 'from app import create_app; create_app()', env)
+        self.assertIn('flask_sqlalchemy', packages)
+        for name in ('elasticsearch', 'flask_admin', 'jwt'):
+            self.assertNotIn(name, packages)
+
+        packages = imported_packages(root, 'from app import create_app; create_app()', dict(env, ADMIN_ENABLED='true'))
+        self.assertIn('flask_admin', packages)
+
+
+class PreforkCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['ELASTICSEARCH_URL'] = 'http://localhost:9200'
+        self.app.elasticsearch = Elasticsearch([self.app.config['ELASTICSEARCH_URL']])
+        self.listener = self.app.extensions['log_listener'] = QueueListener(queue.Queue())
+        self.listener.start()
+
+    def tearDown(self):
+        gc.unfreeze()
+        stop_listener(self.app)
+
+    def test_prepare_and_after_fork(self):
+        client = self.app.elasticsearch
+        with self.app.app_context():
+            self.assertEqual(fan_out({'ping': (lambda request_timeout: 'pong',)}, 1), {'ping': 'pong'})
+        prepare(self.app)
+        self.assertEqual(len(self.app.jinja_env.cache), len(self.app.jinja_env.list_templates()))
+        self.assertIsNone(self.listener._thread)
+        self.assertEqual([t for t in threading.enumerate() if t.name.startswith('search')], [])
+        self.assertGreater(gc.get_freeze_count(), 0)
+
+        after_fork(self.app)
+        self.assertIsNot(self.app.elasticsearch, client)
+        self.assertTrue(self.listener._thread.is_alive())
+
+    def test_clear_metrics(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('123.json', 'keep.txt'):
+                open(os.path.join(directory, name), 'w').close()
+            clear_metrics(directory)
+            self.assertEqual(os.listdir(directory), ['keep.txt'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.fake = FakeElasticsearch().start()
+        self.app.elasticsearch = Elasticsearch([self.fake.url], max_retries=0)
+        insert_mapping('review')
+
+    def tearDown(self):
+        self.fake.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_review(self, nose, score, tags, user, whisky, timestamp):
+        author = User.query.filter_by(username=user).first() or User(username=user, email=f'{user}@example.com')
+        distillery = Distillery.query.filter_by(name='Ardbeg').first() or Distillery(name='Ardbeg')
+        review = Review(nose=nose, palate='', finish='', score=score, timestamp=timestamp, author=author,
+                        whisky=Whisky(name=whisky, distillery=distillery),
+                        tags=[Tag.query.filter_by(name=t).first() or Tag(name=t) for t in tags])
+        db.session.add(review)
+        db.session.commit()
+        return review.id
+
+    def test_query_index(self):
+        smoky = self.add_review('Peat smoke and smoke', 90, ['Peat', 'Smoke'], 'john', 'Uigeadail', datetime(2020, 1, 1))
+        sweet = self.add_review('Honey and smoke', 80, ['Honey'], 'susan', 'Ten', datetime(2021, 1, 1))
+        self.add_review('Vanilla', 70, ['Vanilla'], 'john', 'Corryvreckan', datetime(2019, 1, 1))
+
+        self.assertEqual(query_index('review', 'smoke', '', [], 1, 10, 'rel'), ([smoky, sweet], 2))
+        self.assertEqual(query_index('review', 'smoke', '', [], 1, 10, 'new'), ([sweet, smoky], 2))
+        self.assertEqual(query_index('review', 'smoke', 'honey', [], 1, 10, 'rel'), ([smoky], 1))
+        self.assertEqual(query_index('review', '', '', ['Honey'], 1, 10, 'rel'), ([sweet], 1))
+        self.assertEqual(query_index('review', 'smoke', '', [], 2, 1, 'rel'), ([sweet], 2))
+        self.assertEqual(query_advanced('review', None, 75, None, [], None, 'john', 1, 10, 'rel'), ([smoky], 1))
+        self.assertEqual(query_advanced('review', None, None, None, [], 'Uigedail', None, 1, 10, 'rel'), ([smoky], 1))
+
+        # Keywords match as typed, so a username is only found in its own case
+        masaki = self.add_review('Sherry', 85, [], 'Masaki', 'Ten', datetime(2021, 6, 1))
+        self.assertEqual(normalize_query('Masaki  @fresh_fruit -Oak'), 'Masaki -Oak @fresh_fruit')
+        self.assertEqual(query_index('review', 'Masaki', '', [], 1, 10, 'rel'), ([masaki], 1))
+        self.assertEqual(query_index('review', 'masaki', '', [], 1, 10, 'rel'), ([], 0))
+
+        # Deleting a review takes it out of the index after the commit
+        db.session.delete(Review.query.get(smoky))
+        db.session.commit()
+        self.assertEqual(query_index('review', 'smoke', '', [], 1, 10, 'rel'), ([sweet], 1))
+
+    def test_partitions(self):
+        old = self.add_review('Peat smoke', 90, ['Peat'], 'john', 'Uigeadail', datetime(2019, 5, 1))
+        middle = self.add_review('Smoke and honey', 80, ['Honey'], 'susan', 'Ten', datetime(2020, 5, 1))
+        new = self.add_review('Smoke and vanilla', 70, ['Vanilla'], 'john', 'Ten', datetime(2021, 5, 1))
+        engine = self.fake.engine
+        for year, id in ((2019, old), (2020, middle), (2021, new)):
+            self.assertEqual(list(engine.indices[f'review-{year}'].docs), [str(id)])
+            self.assertIn('review', engine.indices[f'review-{year}'].aliases)
+
+        # The newest page is filled from the newest partitions, this year's being empty, the others are only counted
+        self.assertEqual(query_index('review', 'smoke', '', [], 1, 1, 'new'), ([new], 3))
+        requests = self.fake.requests
+        query_index('review', 'smoke', '', [], 1, 1, 'new')
+        self.assertEqual(self.fake.requests - requests, 3)
+        self.assertEqual(query_index('review', 'smoke', '', [], 2, 1, 'new'), ([middle], 3))
+        self.assertEqual(query_index('review', 'smoke', '', [], 1, 2, 'old'), ([old, middle], 3))
+        self.assertEqual(query_index('review', 'smoke', '', [], 3, 1, 'old'), ([new], 3))
+
+        # A year range only searches the partitions it covers
+        requests = self.fake.requests
+        ids, total = query_advanced('review', 'smoke', None, None, [], None, None, 1, 10, 'rel', 2020, 2021)
+        self.assertEqual((sorted(ids), total), ([middle, new], 2))
+        self.assertEqual(self.fake.requests - requests, 1)
+        self.assertEqual(query_advanced('review', None, None, None, [], None, None, 1, 10, 'new', 2017, 2018),
+                         ([], 0))
+        self.assertEqual(self.fake.requests - requests, 1)
+        # The API takes the same advanced arguments
+        response = self.app.test_client().get('/api/v1/search?review=smoke&year_from=2020&year_to=2020&fields=id')
+        self.assertEqual(response.get_json()['items'], [{'id': middle}])
+
+        # Past years are made read-only, and open again when one of their reviews is edited
+        self.assertEqual(optimize('review', 2021), ['review-2020', 'review-2019'])
+        self.assertEqual(engine.indices['review-2019'].settings['index.blocks.write'], True)
+        self.assertEqual(engine.indices['review-2019'].forcemerges, 1)
+        review = Review.query.get(old)
+        review.nose = 'Peat smoke and brine'
+        db.session.commit()
+        self.assertEqual(query_index('review', 'brine', '', [], 1, 10, 'rel'), ([old], 1))
+        # The fields copied from related rows are indexed whatever changed the review
+        review.add_tag(Tag.query.filter_by(name='Honey').one())
+        db.session.commit()
+        source = engine.indices['review-2019'].docs[str(old)]
+        self.assertEqual((source['distillery_'], source['whisky_'], source['user_'], sorted(source['tags_'])),
+                         ('Ardbeg', 'Uigeadail', 'john', ['Honey', 'Peat']))
+        db.session.delete(Review.query.get(middle))
+        db.session.commit()
+        self.assertEqual(query_index('review', 'smoke', '', [], 1, 10, 'new'), ([new, old], 2))
+
+    def test_injected_failures(self):
+        self.fake.failure_rate = 1
+        with self.assertRaises(TransportError):
+            query_index('review', 'smoke', '', [], 1, 10, 'rel')
+        self.assertEqual(self.fake.failures, 1)
+
+        # Only a write block opens a partition for writes, other refusals are raised as they are
+        self.fake.failure_status = 403
+        with self.assertRaises(TransportError):
+            index_document('review', 1, {'nose': 'smoke', 'timestamp': '2020-01-01T00:00:00'})
+        self.assertEqual(self.fake.failures, 2)
+
+    def test_rebuild(self):
+        first = self.add_review('Peat smoke', 90, ['Peat'], 'john', 'Uigeadail', datetime(2019, 5, 1))
+        second = self.add_review('Smoke and honey', 80, ['Honey'], 'susan', 'Ten', datetime(2019, 6, 1))
+        third = self.add_review('Smoke and vanilla', 70, ['Vanilla'], 'john', 'Ten', datetime(2020, 5, 1))
+        self.assertEqual(rebuild('review'), {'review-2019': 2, 'review-2020': 1})
+
+        # Reviews refused by Elasticsearch are reported, after the others are indexed
+        client, bulk = self.app.elasticsearch, self.app.elasticsearch.bulk
+
+        def block_2019(body):
+            response = bulk(body=body)
+            client.indices.put_settings(index='review-2019', body={'index': {'blocks': {'write': True}}})
+            return response
+        client.bulk = block_2019
+        with self.assertRaises(IndexingError) as raised:
+            rebuild('review', batch_size=1)
+        self.assertEqual(list(raised.exception.failed), [str(second)])
+        self.assertIn('cluster_block_exception', raised.exception.failed[str(second)])
+        self.assertEqual(raised.exception.counts, {'review-2019': 1, 'review-2020': 1})
+        self.assertEqual(sorted(self.fake.engine.indices['review-2019'].docs), [str(first)])
+        self.assertEqual(list(self.fake.engine.indices['review-2020'].docs), [str(third)])
+
+    def test_search_benchmark(self):
+        generate(distilleries=2, whiskies=10, users=10, reviews=30)
+        report = search_latency(self.app, requests=2, warmup=0)
+        self.assertEqual(report['fake_elasticsearch']['documents'], 30)
+        self.assertEqual(report['routes']['tagged']['statuses'], {'200': 2})
+        self.assertGreater(report['routes']['simple']['es_p50_ms'], 0)
+        self.assertEqual(report['routes']['deep_page']['statuses'], {'200': 2})
+
+    def test_search_page(self):
+        smoky = self.add_review('Peat smoke and smoke', 90, ['Peat', 'Smoke'], 'john', 'Uigeadail', datetime(2020, 1, 1))
+        sweet = self.add_review('Honey and smoke', 80, ['Smoke', 'Fresh Fruit'], 'susan', 'Ten', datetime(2021, 1, 1))
+
+        self.assertEqual(parse_query('smok @fresh_fruit -vanilla'), ('smok', 'vanilla', ['Fresh Fruit']))
+        results = search_page('review', simple_query('smoke', '', []), 1, 10, 'rel', 'smok honey')
+        self.assertEqual((results.ids, results.total), ([smoky, sweet], 2))
+        self.assertEqual(results.facets[0], ('Smoke', 2))
+        self.assertEqual(sorted(results.facets[1:]), [('Fresh Fruit', 1), ('Peat', 1)])
+        self.assertEqual(results.corrections, {'smok': 'smoke'})
+        self.assertEqual(results.missing, [])
+
+        # The three searches run side by side
+        self.fake.latency = 0.2
+        start = time.perf_counter()
+        search_page('review', simple_query('smoke', '', []), 1, 10, 'rel', 'smoke')
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    def test_search_page_timeout(self):
+        self.add_review('Peat smoke', 90, ['Smoke'], 'john', 'Uigeadail', datetime(2020, 1, 1))
+        self.app.config['SEARCH_TIMEOUT'] = 0.1
+        self.fake.latency = 0.5
+        results = search_page('review', simple_query('smoke', '', []), 1, 10, 'rel', 'smoke')
+        self.assertEqual((results.ids, results.missing), ([], ['hits', 'facets', 'suggest']))
+
+        # The page still renders, with a notice instead of results
+        response = self.app.test_client().get('/search?q=smoke')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'taking too long', response.data)
+
+    def test_search_log_and_warm(self):
+        self.app.config.update(SEARCH_LOG_ENABLED=True, SEARCH_LOG_FLUSH_INTERVAL=60, SEARCH_CACHE_BACKEND='lru')
+        search_cache.init_app(self.app)
+        review = Review(nose='Peat smoke', palate='', finish='', score=90, timestamp=datetime(2020, 1, 1),
+                        author=User(username='john', email='john@example.com'),
+                        whisky=Whisky(name='Uigeadail', distillery=Distillery(name='Ardbeg')), tags=[Tag(name='Peat')])
+        db.session.add(review)
+        db.session.commit()
+        client = self.app.test_client()
+        for url in ('/search?q=smoke++@Peat', '/search?q=@peat+smoke', '/search?q=Smoke+@peat',
+                    '/search?review=smoke&tags=Peat', '/search?q=vanilla'):
+            self.assertEqual(client.get(url).status_code, 200)
+        # The second search was the first one written differently, and was answered from the cache. The third
+        # searches in another case, which keywords may match differently, so it is a search of its own
+        self.assertEqual(search_cache.stats.hits, 1)
+
+        self.assertEqual(search_log.flush(), 4)
+        queries = {query: row for kind, query, *row in top_queries()}
+        self.assertEqual(list(queries)[0], 'smoke @peat')
+        self.assertEqual(queries['smoke @peat'][0], 2)
+        self.assertEqual(queries['Smoke @peat'][0], 1)
+        self.assertGreater(queries['smoke @peat'][1], 0)
+        self.assertEqual(queries['review=smoke&tags=Peat'][0], 1)
+        self.assertEqual(queries['vanilla'][3], 1)
+        client.get('/search?q=smoke+@peat')
+        search_log.flush()
+        self.assertEqual(top_queries()[0][2], 3)
+
+        # Warming replays the searches as they were typed, so each of them is then a cache hit
+        self.app.extensions['search_cache'][0].clear()
+        self.assertEqual(warm(top=10), 4)
+        requests = self.fake.requests
+        client.get('/search?q=smoke+@peat')
+        client.get('/search?q=Smoke+@peat')
+        client.get('/search?review=smoke&tags=Peat')
+        self.assertEqual(self.fake.requests, requests)
+        search_log.flush()
+        self.assertEqual(top_queries()[0][2:4], (4, queries['smoke @peat'][1]))
+
+
+class ProfilerConfig(TestConfig):
+    ADMIN_ENABLED = True
+
+
+class ProfilerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(ProfilerConfig)
+        self.app.config['PROFILE_INTERVAL'] = 0.001
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        @self.app.route('/slow')
+        def slow():
+            time.sleep(0.05)
+            return 'done'
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_profile_with_token(self):
+        self.client.get('/slow')
+        self.client.get('/slow', headers={'X-Profile': 'forged'})
+        self.assertEqual(profiler.store.endpoints, {})
+
+        self.client.get('/slow', headers={'X-Profile': profiler.token()})
+        profile = profiler.store.endpoints['slow']
+        self.assertEqual(profile.requests, 1)
+        self.assertGreater(profile.samples, 0)
+        self.assertIn('tests.py:slow', profile.folded())
+        self.assertIn('tests.py:slow', [name for name, own, total in profile.functions()])
+
+        db.session.add(User(username='admin', email='admin@example.com'))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['user_id'] = '1'
+        self.assertIn(b'slow.folded', self.client.get('/admin/profiler/?name=slow&fsort=total').data)
+        response = self.client.get('/admin/profiler/folded/')
+        self.assertRegex(response.data, rb'^slow;flask/app.py:full_dispatch_request;.*tests.py:slow \d+$')
+
+        # Views read a copy, which requests still being profiled don't change
+        snapshot = profiler.store.snapshot()
+        profiler.store.add('slow', 0.1, {'a;b': 1})
+        self.assertEqual((snapshot['slow'].requests, snapshot['slow'].samples), (1, profile.samples - 1))
+
+    def test_sample_rate(self):
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.client.get('/slow')
+        self.client.get('/missing')
+        self.assertEqual(set(profiler.store.endpoints), {'slow', '[unmatched]'})
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics(self):
+        self.client.get('/explore')
+        self.client.get('/explore')
+        self.client.get('/missing')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('whisky_http_requests_total{endpoint="main.explore",method="GET",status="200"} 2', text)
+        self.assertIn('whisky_http_requests_total{endpoint="unmatched",method="GET",status="404"} 1', text)
+        self.assertIn('whisky_http_request_duration_seconds_bucket{endpoint="main.explore",le="+Inf"} 2', text)
+        self.assertIn('whisky_http_request_duration_seconds_count{endpoint="main.explore"} 2', text)
+        self.assertIn('whisky_db_queries_total{endpoint="main.explore"}', text)
+        self.assertIn('whisky_cache_misses_total{cache="page"}', text)
+        self.assertIn('# TYPE whisky_mail_queue_depth gauge', text)
+
+        # Outside debug and testing, the endpoint needs a token
+        self.app.testing = False
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_processes_add_up(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['METRICS_DIR'] = directory
+        # A worker that has exited: its counters still count, its gauges don't
+        with open(os.path.join(directory, '999999999.json'), 'w') as f:
+            json.dump([['whisky_http_requests_total', [['endpoint', 'main.explore'], ['method', 'GET'],
+                                                       ['status', '200']], 5],
+                       ['whisky_mail_queue_depth', [], 7]], f)
+        self.client.get('/explore')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('whisky_http_requests_total{endpoint="main.explore",method="GET",status="200"} 6', text)
+        self.assertIn('whisky_mail_queue_depth 0', text)
+        self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)